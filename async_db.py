@@ -0,0 +1,96 @@
+# async_db.py - نسخ غير حاجبة (awaitable) من دوال database.py
+#
+# المعالجات في hasan_bot.py تعمل داخل event loop واحد، فلو استدعت sqlite3 مباشرة
+# كل استعلام يوقف البوت عن خدمة باقي المستخدمين. هون كل الاستدعاءات تنتقل لخيط
+# مخصص لقاعدة البيانات (يملك اتصالاً مشتركاً واحداً)، والمعالج ينتظرها بـ await.
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+# خيط واحد لقاعدة البيانات: SQLite يسمح بكاتب واحد فقط، فالطابور يرتب الطلبات بدل التنافس على القفل
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hasan-db")
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """ينفذ دالة متزامنة من database.py على خيط قاعدة البيانات وينتظر نتيجتها."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+
+initialize_db = _awaitable(database.initialize_db)
+add_user = _awaitable(database.add_user)
+upsert_user = _awaitable(database.upsert_user)
+get_user = _awaitable(database.get_user)
+upsert_referred_user = _awaitable(database.upsert_referred_user)
+get_referral_leaderboard = _awaitable(database.get_referral_leaderboard)
+update_user_balance = _awaitable(database.update_user_balance)
+get_users_count = _awaitable(database.get_users_count)
+get_stats = _awaitable(database.get_stats)
+add_american_email = _awaitable(database.add_american_email)
+add_american_emails_bulk = _awaitable(database.add_american_emails_bulk)
+get_available_american_emails = _awaitable(database.get_available_american_emails)
+mark_emails_as_sold = _awaitable(database.mark_emails_as_sold)
+claim_american_emails = _awaitable(database.claim_american_emails)
+delete_american_email = _awaitable(database.delete_american_email)
+get_american_emails_counts = _awaitable(database.get_american_emails_counts)
+get_all_available_american_emails_for_admin = _awaitable(database.get_all_available_american_emails_for_admin)
+get_available_american_emails_page = _awaitable(database.get_available_american_emails_page)
+add_submitted_email = _awaitable(database.add_submitted_email)
+add_submitted_emails_bulk = _awaitable(database.add_submitted_emails_bulk)
+get_pending_submitted_emails = _awaitable(database.get_pending_submitted_emails)
+get_pending_review_page = _awaitable(database.get_pending_review_page)
+approve_seller_submissions = _awaitable(database.approve_seller_submissions)
+reject_seller_submissions = _awaitable(database.reject_seller_submissions)
+update_submitted_email_status = _awaitable(database.update_submitted_email_status)
+approve_submitted_email = _awaitable(database.approve_submitted_email)
+get_submitted_email_by_id = _awaitable(database.get_submitted_email_by_id)
+get_last_sold_emails_to_user = _awaitable(database.get_last_sold_emails_to_user)
+expire_stale_claims = _awaitable(database.expire_stale_claims)
+match_american_submissions = _awaitable(database.match_american_submissions)
+get_user_ids_after = _awaitable(database.get_user_ids_after)
+create_broadcast = _awaitable(database.create_broadcast)
+get_running_broadcasts = _awaitable(database.get_running_broadcasts)
+checkpoint_broadcast = _awaitable(database.checkpoint_broadcast)
+finish_broadcast = _awaitable(database.finish_broadcast)
+get_conversation_states = _awaitable(database.get_conversation_states)
+get_all_user_data = _awaitable(database.get_all_user_data)
+save_persistence_batch = _awaitable(database.save_persistence_batch)
+reconcile_balances = _awaitable(database.reconcile_balances)
+request_withdrawal = _awaitable(database.request_withdrawal)
+get_pending_withdrawals_page = _awaitable(database.get_pending_withdrawals_page)
+get_pending_withdrawal_ids = _awaitable(database.get_pending_withdrawal_ids)
+approve_withdrawals = _awaitable(database.approve_withdrawals)
+reject_withdrawals = _awaitable(database.reject_withdrawals)
+
+
+
+async def export_available_american_emails(file_obj, batch_size=1000):
+    """التصدير يفتح اتصاله الخاص، فيعمل على خيط منفصل ولا يوقف طابور قاعدة البيانات."""
+    return await asyncio.to_thread(database.export_available_american_emails, file_obj, batch_size)
+
+
+async def close():
+    """يغلق اتصال خيط قاعدة البيانات ويوقف الخيط (يُستدعى عند إيقاف البوت)."""
+    global _executor
+    if _executor is None:
+        return
+    await run_db(database.close_connection)
+    _executor.shutdown(wait=True)
+    _executor = None
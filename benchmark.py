@@ -0,0 +1,1121 @@
+# benchmark.py - قياس أداء طبقة قاعدة البيانات وتوجيه التحديثات
+#
+# التشغيل:
+#   python benchmark.py connections
+#   python benchmark.py claims
+#   python benchmark.py plans
+#   python benchmark.py start
+#   python benchmark.py dispatch
+#   python benchmark.py usercache
+#   python benchmark.py stats
+#   python benchmark.py ledger
+#   python benchmark.py withdrawals
+#   python benchmark.py expiry
+#   python benchmark.py matching
+#   python benchmark.py referrals
+#   python benchmark.py scaling [--sizes 1000 100000 1000000] [--save-baseline]
+#   python benchmark.py --database-url postgresql://... scaling --sizes 1000 10000 --baseline benchmark_baseline_postgres.json
+#   python benchmark.py migrate [--processes 8]
+#   python benchmark.py --database-url postgresql://... schema
+#
+# كل القياسات تعمل على ملف قاعدة بيانات مؤقت يُحذف في النهاية، ولا تلمس hasan_bot.db أبداً.
+# مع --database-url postgresql://... تعمل في schema جديد مؤقت على ذلك الخادم
+# (ما عدا connections و plans و usercache فهي خاصة بـ SQLite)، و schema يقارن مخطط SQLite مع مخطط ذلك الخادم.
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import database
+import storage
+
+
+# رابط PostgreSQL من --database-url (فارغ = ملف SQLite مؤقت)، و loadtest.py يضبطه من --database-url الخاص به
+DATABASE_URL = ""
+_temp_dirs = []   # المجلدات المؤقتة التي أنشأتها use_temp_db (تُحذف في remove_temp_dbs)
+
+
+def use_temp_db(initialize=True):
+    """
+    يحوّل database.py لملف مؤقت جديد (أو schema مؤقت في PostgreSQL) ويهيئ الجداول فيه، ويرجع مسار المجلد المؤقت.
+    loadtest.py يستخدمها أيضاً، مع initialize=False حين يترك التهيئة للبوت نفسه.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="hasan_bench_")
+    _temp_dirs.append(tmp_dir)
+    database.DB_NAME = os.path.join(tmp_dir, "bench.db")
+    if DATABASE_URL:
+        separator = "&" if "?" in DATABASE_URL else "?"
+        database.DATABASE_URL = f"{DATABASE_URL}{separator}schema={os.path.basename(tmp_dir)}"
+    if initialize:
+        database.initialize_db()
+    return tmp_dir
+
+
+def remove_temp_dbs():
+    """يحذف المجلدات المؤقتة وملفات قاعدة البيانات فيها، و schemas PostgreSQL المؤقتة بنفس أسمائها."""
+    database.close_connection()
+    if DATABASE_URL and _temp_dirs:
+        conn = storage.PostgresBackend(DATABASE_URL, []).connect()
+        try:
+            for tmp_dir in _temp_dirs:
+                conn.execute(f'DROP SCHEMA IF EXISTS "{os.path.basename(tmp_dir)}" CASCADE')
+        finally:
+            conn.close()
+    for tmp_dir in _temp_dirs:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    _temp_dirs.clear()
+
+
+def run_threads(worker, threads, calls_per_thread):
+    """يشغل worker بعدة خيوط متوازية (مثل المعالجات المتزامنة) ويرجع عدد الاستدعاءات في الثانية."""
+    barrier = threading.Barrier(threads)
+
+    def target(thread_index):
+        barrier.wait()
+        for i in range(calls_per_thread):
+            worker(thread_index, i)
+        database.close_connection()
+
+    pool = [threading.Thread(target=target, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return threads * calls_per_thread / elapsed
+
+
+# الطريقة القديمة: اتصال جديد وإغلاقه مع كل استدعاء
+def legacy_get_user(user_id):
+    conn = sqlite3.connect(database.DB_NAME, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, balance, role, referred_by, referral_count FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+
+def legacy_update_user_balance(user_id, amount):
+    conn = sqlite3.connect(database.DB_NAME, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+    conn.commit()
+    conn.close()
+
+
+def bench_connections(args):
+    use_temp_db()
+    database._user_cache.max_size = 0  # نقيس الاتصالات فقط، بدون كاش المستخدمين
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", [(i,) for i in range(args.users)])
+
+    # خليط قراءة/كتابة يشبه /start ومراجعة الإيميلات: 4 قراءات لكل كتابة
+    def legacy_worker(t, i):
+        user_id = (t * 7919 + i) % args.users
+        if i % 5 == 0:
+            legacy_update_user_balance(user_id, 1)
+        else:
+            legacy_get_user(user_id)
+
+    def pooled_worker(t, i):
+        user_id = (t * 7919 + i) % args.users
+        if i % 5 == 0:
+            database.update_user_balance(user_id, 1)
+        else:
+            database.get_user(user_id)
+
+    print(f"{'threads':>8} {'before (calls/s)':>18} {'after (calls/s)':>18} {'speedup':>8}")
+    for threads in args.threads:
+        before = run_threads(legacy_worker, threads, args.calls)
+        after = run_threads(pooled_worker, threads, args.calls)
+        print(f"{threads:>8} {before:>18.0f} {after:>18.0f} {after / before:>7.1f}x")
+
+
+def bench_claims(args):
+    """
+    اختبار ضغط: مئات عمليات الحجز المتزامنة (كل خيط باتصاله الخاص مثل عدة عمليات)،
+    ويفشل لو تم تسليم نفس الإيميل لأكثر من طلب.
+    """
+    use_temp_db()
+    with database.transaction() as cursor:
+        database._insert_rows(
+            cursor, "INSERT INTO american_emails (email, password) VALUES",
+            [(f"user{i}@example.com", "pw") for i in range(args.emails)]
+        )
+
+    results = [[] for _ in range(args.threads)]
+
+    def worker(t, i):
+        claimed = database.claim_american_emails(user_id=t * 100000 + i, count=args.count)
+        if claimed is None:
+            raise RuntimeError("claim_american_emails فشل")
+        results[t].extend(row["id"] for row in claimed)
+
+    rate = run_threads(worker, args.threads, args.claims)
+    handed_out = [email_id for ids in results for email_id in ids]
+    duplicates = len(handed_out) - len(set(handed_out))
+
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT COUNT(*) FROM american_emails WHERE status = 'sold'")
+    sold = cursor.fetchone()[0]
+
+    print(f"claims: {args.threads * args.claims} ({rate:.0f}/s), handed out: {len(handed_out)}, "
+          f"marked sold: {sold}, duplicates: {duplicates}")
+    if duplicates or sold != len(handed_out):
+        print("FAIL: تم تسليم نفس الإيميل أكثر من مرة")
+        sys.exit(1)
+    print("OK")
+
+
+def bench_start(args):
+    """زمن /start لمستخدمين جدد: المسار القديم (تهيئة الجداول + add_user + get_user) مقابل upsert_user."""
+    use_temp_db()
+
+    # المسار القديم كان ينشئ الجداول (CREATE TABLE IF NOT EXISTS) عند كل /start
+    create_tables = [statement for statement in database.get_backend().migrations[0]
+                     if "CREATE TABLE IF NOT EXISTS" in statement]
+
+    def legacy_start(user_id):
+        with database.transaction() as cursor:
+            for statement in create_tables:
+                cursor.execute(statement)
+        database.add_user(user_id)
+        return database.get_user(user_id)
+
+    for label, start in (("before", legacy_start), ("after", database.upsert_user)):
+        offset = 0 if label == "before" else args.users
+        timings = []
+        for user_id in range(offset, offset + args.users):
+            started = time.perf_counter()
+            start(user_id)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        p50 = timings[len(timings) // 2] * 1e6
+        p99 = timings[int(len(timings) * 0.99)] * 1e6
+        print(f"{label:>7}: {args.users / sum(timings):>8.0f} /start per second, p50 {p50:.0f}us, p99 {p99:.0f}us")
+
+
+# الدوال المتكررة في database.py: تُستدعى فعلاً ويُسجل كل استعلام تنفذه، ولازم كلها تستخدم فهرس
+# (لا مسح كامل للجدول). الفحص على نفس الاستعلامات التي ينفذها البوت، فأي تعديل فيها يُفحص تلقائياً.
+HOT_CALLS = {
+    "get_user": lambda: database.get_user(1),
+    "upsert_user": lambda: database.upsert_user(1000),
+    "upsert_referred_user": lambda: database.upsert_referred_user(1001, 1),
+    "update_user_balance": lambda: database.update_user_balance(2, 10),
+    "get_users_count": lambda: database.get_users_count(),
+    "get_stats": lambda: database.get_stats(),
+    "get_user_ids_after": lambda: database.get_user_ids_after(10, 20),
+    "claim_american_emails": lambda: database.claim_american_emails(3, 2),
+    "get_available_american_emails": lambda: database.get_available_american_emails(5),
+    "get_available_american_emails_page": lambda: database.get_available_american_emails_page(after_id=5),
+    "delete_american_email": lambda: database.delete_american_email("stock99@example.com"),
+    "get_last_sold_emails_to_user": lambda: database.get_last_sold_emails_to_user(1),
+    "expire_stale_claims": lambda: database.expire_stale_claims(),
+    "match_american_submissions": lambda: database.match_american_submissions(1, ["stock0@example.com", "x@example.com"]),
+    "add_submitted_emails_bulk": lambda: database.add_submitted_emails_bulk(4, [("new@example.com", "pw", None)], "american"),
+    "get_pending_submitted_emails": lambda: database.get_pending_submitted_emails(after_id=1),
+    "get_pending_review_page": lambda: database.get_pending_review_page(),
+    "get_submitted_email_by_id": lambda: database.get_submitted_email_by_id(1),
+    "approve_submitted_email": lambda: database.approve_submitted_email(2, 5),
+    "approve_seller_submissions": lambda: database.approve_seller_submissions(5, 1000, 5),
+    "reject_seller_submissions": lambda: database.reject_seller_submissions(6, 1000, "bench"),
+    "request_withdrawal": lambda: database.request_withdrawal(7, 10, "bench", "000"),
+    "get_pending_withdrawals_page": lambda: database.get_pending_withdrawals_page(after_id=1),
+    "get_pending_withdrawal_ids": lambda: database.get_pending_withdrawal_ids(0, 1000),
+    "approve_withdrawals": lambda: database.approve_withdrawals([1, 2]),
+    "reject_withdrawals": lambda: database.reject_withdrawals([3], "bench"),
+    "reconcile_balances": lambda: database.reconcile_balances(),
+    "get_referral_leaderboard": lambda: database.get_referral_leaderboard(),
+    "save_persistence_batch": lambda: database.save_persistence_batch([("conv", "[1, 1]", "1")], [(1, '{"a": 1}')]),
+    "get_conversation_states": lambda: database.get_conversation_states("conv"),
+}
+
+
+# جداول بعدد صفوف ثابت تقريباً (لا تكبر مع البيانات)، فقراءتها كاملة مقبولة
+SMALL_TABLES = {"stats_counters", "referral_leaderboard"}
+
+
+def fill_plan_tables():
+    """بيانات قليلة في كل جدول، حتى تصل كل دالة في HOT_CALLS لكل استعلاماتها."""
+    for user_id in range(1, 51):
+        database.upsert_user(user_id)
+        database.update_user_balance(user_id, 100)
+    database.add_american_emails_bulk([(f"stock{i}@example.com", "pw") for i in range(100)])
+    database.claim_american_emails(1, 5)
+    for seller_user_id in range(1, 11):
+        database.add_submitted_emails_bulk(
+            seller_user_id, [(f"sub{seller_user_id}_{k}@example.com", "pw", None) for k in range(3)], "american")
+    for user_id in range(1, 6):
+        database.request_withdrawal(user_id, 10, "bench", "000")
+
+
+def traced_statements(call):
+    """ينفذ call ويرجع الاستعلامات التي نفذها (بقيم المعاملات)، بدون جمل التحكم بالمعاملة."""
+    statements = []
+    conn = database.get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    # "--" بداية استعلامات داخل الـ triggers، وتُفحص مع الجملة التي شغّلتها
+    skipped = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA", "--")
+    return list(dict.fromkeys(s.strip() for s in statements if not s.lstrip().upper().startswith(skipped)))
+
+
+_TABLE_ALIAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+
+
+def full_scans(details, sql, tables):
+    """
+    "SCAN <اسم>" بدون "INDEX" لجدول حقيقي (بالاسم أو بالاسم المستعار في الاستعلام) يعني قراءته كاملاً.
+    مسح نتيجة استعلام فرعي أو CTE أو قائمة json_each ليس مسحاً لجدول.
+    """
+    aliases = {alias: table for table, alias in _TABLE_ALIAS.findall(sql) if alias}
+    scans = []
+    for d in details:
+        if d.startswith("SCAN") and "INDEX" not in d:
+            table = aliases.get(d.split()[1], d.split()[1])
+            if table in tables and table not in SMALL_TABLES:
+                scans.append(d)
+    return scans
+
+
+def bench_plans(args):
+    """
+    ينفذ كل دالة في HOT_CALLS ويسجل الاستعلامات التي نفذتها فعلاً (set_trace_callback)،
+    ثم يفحص خطة تنفيذ كل واحد (EXPLAIN QUERY PLAN) ويفشل لو رجع لمسح كامل.
+    """
+    use_temp_db()
+    # get_user من الكاش لا ينفذ أي استعلام
+    database._user_cache.max_size = 0
+    fill_plan_tables()
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in cursor.fetchall()}
+    failures = []
+    for name, call in HOT_CALLS.items():
+        statements = traced_statements(call)
+        if not statements:
+            print(f"FAIL  {name}: لم ينفذ أي استعلام")
+            failures.append(name)
+            continue
+        for sql in statements:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            details = [row[3] for row in cursor.fetchall()]
+            scans = full_scans(details, sql, tables)
+            print(f"{'FAIL' if scans else 'ok':>4}  {name}: {' | '.join(details) or '-'}")
+            if scans and name not in failures:
+                failures.append(name)
+    if failures:
+        print(f"FAIL: استعلامات بدون فهرس: {', '.join(failures)}")
+        sys.exit(1)
+    print("OK")
+
+
+def bench_usercache(args):
+    """
+    عدد استعلامات SQLite لكل تحديث بدون كاش المستخدمين ومعه، على خليط يشبه المعالجات:
+    /start (upsert_user)، بداية البيع/الإرسال (get_user)، المراجعة (get_user للبائع)،
+    والقبول (update_user_balance ثم get_user للرصيد الجديد). المستخدمون النشطون أقلية (80/20).
+    """
+    use_temp_db()
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", [(i,) for i in range(args.users)])
+
+    statements = [0]
+    database.get_connection().set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+    hot_users = max(1, args.users // 5)
+
+    def run_updates():
+        rng = random.Random(42)
+        statements[0] = 0
+        started = time.perf_counter()
+        for _ in range(args.updates):
+            user_id = rng.randrange(hot_users) if rng.random() < 0.8 else rng.randrange(args.users)
+            action = rng.random()
+            if action < 0.2:
+                database.upsert_user(user_id)
+            elif action < 0.6:
+                database.get_user(user_id)
+            elif action < 0.9:
+                database.get_user(user_id)
+                database.get_user(user_id)
+            else:
+                database.update_user_balance(user_id, 10)
+                database.get_user(user_id)
+        elapsed = time.perf_counter() - started
+        return statements[0] / args.updates, elapsed / args.updates * 1e6
+
+    cache_size = database._user_cache.max_size
+    database._user_cache.max_size = 0
+    database._user_cache.clear()
+    before_queries, before_us = run_updates()
+    database._user_cache.max_size = cache_size
+    database._user_cache.hits = database._user_cache.misses = 0
+    after_queries, after_us = run_updates()
+
+    stats = database.user_cache_stats()
+    print(f" before: {before_queries:.2f} queries/update, {before_us:.1f}us/update")
+    print(f"  after: {after_queries:.2f} queries/update, {after_us:.1f}us/update "
+          f"(hit rate {stats['hit_rate']:.0%}, {stats['size']} cached users)")
+
+
+def legacy_stats():
+    """الإحصائيات بالطريقة القديمة: COUNT و SUM و GROUP BY على الجداول كاملة."""
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users")
+    users, balance_total = cursor.fetchone()
+    stats = {"users": users, "balance_total": balance_total}
+    for table in ("american_emails", "submitted_emails", "withdrawal_requests"):
+        cursor.execute(f"SELECT status, COUNT(*) FROM {table} GROUP BY status")
+        stats[table] = dict(cursor.fetchall())
+    cursor.execute("SELECT status, SUM(amount) FROM withdrawal_requests GROUP BY status")
+    stats["withdrawal_amounts"] = dict(cursor.fetchall())
+    return stats
+
+
+def same_stats(expected, actual):
+    """مقارنة الإحصائيات مع تجاهل العدادات الصفرية (GROUP BY لا يرجع الحالات التي لم يبق منها شيء)."""
+    def nonzero(stats):
+        return {k: ({s: v for s, v in val.items() if v} if isinstance(val, dict) else val) for k, val in stats.items()}
+    return nonzero(expected) == nonzero(actual)
+
+
+def bench_stats(args):
+    """
+    زمن قراءة الإحصائيات (عدادات stats_counters مقابل التجميع على الجداول) مع كبر البيانات،
+    ثم خليط عشوائي من العمليات الحقيقية والتأكد أن العدادات تطابق التجميع الكامل بالضبط.
+    """
+    use_temp_db()
+    rng = random.Random(7)
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id, balance) VALUES",
+                              [(i, rng.randrange(100)) for i in range(args.rows // 10)])
+        database._insert_rows(cursor, "INSERT INTO american_emails (email, password) VALUES",
+                              [(f"stock{i}@example.com", "pw") for i in range(args.rows)])
+        database._insert_rows(cursor, "INSERT INTO submitted_emails (seller_user_id, email, password, type) VALUES",
+                              [(i % 1000, f"sub{i}@example.com", "pw", "random") for i in range(args.rows // 2)])
+
+    # خليط من العمليات الحقيقية التي تغيّر العدادات
+    for i in range(args.operations):
+        action = rng.random()
+        user_id = rng.randrange(args.rows // 10 + 100)
+        if action < 0.2:
+            database.upsert_user(user_id)
+        elif action < 0.4:
+            database.claim_american_emails(user_id, rng.randrange(1, 4))
+        elif action < 0.5:
+            database.delete_american_email(f"stock{rng.randrange(args.rows)}@example.com")
+        elif action < 0.7:
+            database.add_submitted_email(user_id, f"new{i}@example.com", "pw", "random")
+        elif action < 0.8:
+            database.approve_seller_submissions(rng.randrange(1000), args.rows, 5)
+        elif action < 0.9:
+            database.reject_seller_submissions(rng.randrange(1000), args.rows, "مرفوض")
+        else:
+            database.update_user_balance(user_id, rng.randrange(-5, 20))
+
+    for label, read in (("legacy (COUNT/GROUP BY)", legacy_stats), ("stats_counters", database.get_stats)):
+        started = time.perf_counter()
+        for _ in range(args.reads):
+            read()
+        print(f"{label:>24}: {(time.perf_counter() - started) / args.reads * 1000:.3f}ms per read")
+
+    expected, actual = legacy_stats(), database.get_stats()
+    if not same_stats(expected, actual):
+        print(f"FAIL: العدادات لا تطابق الجداول\n  expected: {expected}\n  actual:   {actual}")
+        sys.exit(1)
+    print(f"OK (counters match after {args.operations} operations)")
+
+
+def bench_ledger(args):
+    """
+    مطابقة الأرصدة على سجل حركات كبير: زمن المرور على كل المستخدمين بدفعات، والتأكد أنها تكشف
+    بالضبط الأرصدة التي عُدّلت خارج السجل.
+    """
+    use_temp_db()
+    rng = random.Random(3)
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", [(i,) for i in range(1, args.users + 1)])
+        cursor.executemany(
+            "INSERT INTO balance_ledger (user_id, amount, reason) VALUES (?, ?, 'submission_approved')",
+            ((rng.randint(1, args.users), rng.randrange(1, 50)) for _ in range(args.rows))
+        )
+        # الرصيد المحفوظ = مجموع الحركات (كما تحفظه _credit_user)
+        cursor.execute(
+            "UPDATE users SET balance = totals.total FROM "
+            "(SELECT user_id, SUM(amount) AS total FROM balance_ledger GROUP BY user_id) AS totals "
+            "WHERE totals.user_id = users.user_id"
+        )
+    # حركات حقيقية عبر الدوال، ثم تعديلات مباشرة خارج السجل يجب أن تُكشف
+    for _ in range(1000):
+        database.update_user_balance(rng.randint(1, args.users), rng.randrange(-10, 50))
+    tampered = sorted(rng.sample(range(1, args.users + 1), 3))
+    with database.transaction() as cursor:
+        cursor.executemany("UPDATE users SET balance = balance + 7 WHERE user_id = ?", [(u,) for u in tampered])
+
+    started = time.perf_counter()
+    after_user_id, checked, batches, mismatches = 0, 0, 0, []
+    while True:
+        result = database.reconcile_balances(after_user_id, args.batch_size)
+        if result["last_user_id"] is None:
+            break
+        batches += 1
+        checked += result["checked"]
+        mismatches.extend(m["user_id"] for m in result["mismatches"])
+        after_user_id = result["last_user_id"]
+    elapsed = time.perf_counter() - started
+
+    print(f"reconciled {checked} users / {args.rows} ledger rows in {elapsed:.2f}s "
+          f"({batches} batches, {elapsed / max(batches, 1) * 1000:.0f}ms per batch)")
+    print(f"mismatches: {mismatches}, tampered: {tampered}")
+    if mismatches != tampered:
+        print("FAIL: المطابقة لم تكشف التعديلات خارج السجل بالضبط")
+        sys.exit(1)
+    print("OK")
+
+
+def bench_withdrawals(args):
+    """
+    طابور من آلاف طلبات السحب: معالجة طلب بطلب (استدعاء ومعاملة لكل طلب) مقابل دفعات،
+    ثم التأكد أن الأرصدة تطابق سجل الحركات وأن العدادات تطابق الجداول.
+    """
+    use_temp_db()
+    users = max(1, args.requests // 4)
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", [(i,) for i in range(1, users + 1)])
+    for user_id in range(1, users + 1):
+        database.update_user_balance(user_id, 1000, 'opening_balance')
+
+    def make_requests():
+        started = time.perf_counter()
+        ids = [database.request_withdrawal(i % users + 1, 10, "سيرياتيل كاش", "0999999999")["request"]["id"]
+               for i in range(args.requests)]
+        return ids, time.perf_counter() - started
+
+    for label, chunk in (("one by one", 1), (f"batches of {args.batch_size}", args.batch_size)):
+        ids, elapsed = make_requests()
+        if chunk == 1:
+            print(f"request_withdrawal: {args.requests / elapsed:.0f} requests/s (hold + ledger in one transaction each)")
+        half = len(ids) // 2
+        started = time.perf_counter()
+        for i in range(0, half, chunk):
+            database.approve_withdrawals(ids[i:i + chunk])
+        for i in range(half, len(ids), chunk):
+            database.reject_withdrawals(ids[i:i + chunk], "رقم خاطئ")
+        elapsed = time.perf_counter() - started
+        transactions = -(-half // chunk) + -(-(len(ids) - half) // chunk)
+        print(f"{label:>18}: {len(ids)} requests in {elapsed:.2f}s ({transactions} transactions)")
+
+    after_user_id, mismatches = 0, []
+    while True:
+        result = database.reconcile_balances(after_user_id)
+        if result["last_user_id"] is None:
+            break
+        mismatches.extend(result["mismatches"])
+        after_user_id = result["last_user_id"]
+    if mismatches or not same_stats(legacy_stats(), database.get_stats()):
+        print(f"FAIL: mismatches: {mismatches[:5]}, stats: {database.get_stats()}")
+        sys.exit(1)
+    print("OK (balances match the ledger, counters match the tables)")
+
+
+def fill_sold_emails(rows):
+    """
+    يملأ american_emails بـ rows إيميل: النصف الأول مباع للمستخدمين 1..1000 بالتناوب
+    (الإيميل i للمستخدم i % 1000 + 1)، وأول خُمس منه أقدم من مهلة إعادة البيع. يرجع (المباع، المتأخر).
+    """
+    now = database.datetime.datetime.now()
+    sold = rows // 2
+    stale = sold // 5
+    values = []
+    for i in range(rows):
+        if i < sold:
+            age = database.RESALE_WINDOW + database.datetime.timedelta(minutes=i + 1) if i < stale \
+                else database.datetime.timedelta(minutes=i % 1000)
+            values.append((f"user{i}@example.com", "pw", "sold", i % 1000 + 1, (now - age).isoformat()))
+        else:
+            values.append((f"user{i}@example.com", "pw", "available", None, None))
+    with database.transaction() as cursor:
+        database._insert_rows(
+            cursor, "INSERT INTO american_emails (email, password, status, sold_to_user_id, sold_at) VALUES", values)
+        cursor.execute("ANALYZE")
+    return sold, stale
+
+
+def bench_expiry(args):
+    """
+    دورة إنهاء مهلة الـ 24 ساعة (expire_stale_claims) على جدول كبير: الزمن الكلي وعدد دفعات UPDATE
+    وأبطأها، ثم زمن دورة لا تجد شيئاً منتهياً، والتأكد أن المنتهية هي بالضبط الإيميلات الأقدم
+    من المهلة وأن عدادات الإحصائيات تطابقها. (مطابقة الإرسال المتأخر يقيسها matching.)
+    """
+    use_temp_db()
+    sold, stale = fill_sold_emails(args.rows)
+
+    durations, expired = [], 0
+    started = time.perf_counter()
+    while True:
+        batch_started = time.perf_counter()
+        count = database.expire_stale_claims(args.batch_size)
+        durations.append((time.perf_counter() - batch_started) * 1000)
+        expired += count
+        if count < args.batch_size:
+            break
+    elapsed = time.perf_counter() - started
+    print(f"sweep: {expired} of {sold} sold emails expired in {elapsed * 1000:.1f} ms "
+          f"({len(durations)} UPDATEs, max {max(durations):.1f} ms each)")
+
+    started = time.perf_counter()
+    empty = database.expire_stale_claims(args.batch_size)
+    print(f"idle sweep (nothing stale): {(time.perf_counter() - started) * 1000:.2f} ms")
+
+    stats = database.get_stats()["american_emails"]
+    if expired != stale or empty != 0 or stats.get("expired") != stale or stats.get("sold") != sold - stale:
+        print(f"FAIL: expired {expired}, expected {stale}, counters {stats}")
+        sys.exit(1)
+    print("OK (exactly the stale claims expired, counters match)")
+
+
+def legacy_match_submissions(user_id, emails, cutoff):
+    """مطابقة إيميل بإيميل (استعلام لكل سطر في الرسالة)، للمقارنة فقط."""
+    cursor = database.get_connection().cursor()
+    results = {}
+    for email in emails:
+        cursor.execute("SELECT status, sold_to_user_id, sold_at FROM american_emails WHERE email = ?", (email,))
+        row = cursor.fetchone()
+        if row is None:
+            results[email] = database.MATCH_UNKNOWN
+        elif row[1] != user_id or row[0] not in ("sold", "expired"):
+            results[email] = database.MATCH_NOT_SOLD_TO_USER
+        elif row[0] == "expired" or row[2] < cutoff:
+            results[email] = database.MATCH_LATE
+        else:
+            results[email] = database.MATCH_OK
+    return results
+
+
+def bench_matching(args):
+    """
+    مطابقة الإيميلات الأمريكية المرسلة للمراجعة مع المخزون: استعلام لكل إيميل مقابل استعلام واحد
+    لكل رسالة، والتأكد أن النتيجتين متطابقتان وأن كل نوع نتيجة يُكتشف.
+    """
+    use_temp_db()
+    sold, stale = fill_sold_emails(args.rows)
+    cutoff = (database.datetime.datetime.now() - database.RESALE_WINDOW).isoformat()
+
+    # كل مستخدم يرسل رسالة فيها: إيميلات متأخرة، وضمن المهلة، ومباعة لغيره، ومتاحة، وغير موجودة
+    submissions = []
+    for user_id in range(1, args.submissions + 1):
+        own = [f"user{user_id - 1 + 1000 * (k * (sold // 1000) // args.emails)}@example.com" for k in range(args.emails)]
+        others = [f"user{user_id % 1000 + 1000 * 60}@example.com", f"user{sold + user_id}@example.com",
+                  f"missing{user_id}@example.com"]
+        submissions.append((user_id, own + others))
+
+    results = {}
+    for label, match in (("per email", lambda u, e: legacy_match_submissions(u, e, cutoff)),
+                         ("per message", database.match_american_submissions)):
+        started = time.perf_counter()
+        results[label] = [match(user_id, emails) for user_id, emails in submissions]
+        elapsed = time.perf_counter() - started
+        queries = sum(len(emails) for _, emails in submissions) if label == "per email" else len(submissions)
+        print(f"{label:>12}: {len(submissions)} messages in {elapsed * 1000:.1f} ms "
+              f"({elapsed / len(submissions) * 1000:.3f} ms per message, {queries} queries)")
+
+    found = collections.Counter(r for message in results["per message"] for r in message.values())
+    print(f"results: {dict(found)}")
+    expected_kinds = {database.MATCH_OK, database.MATCH_LATE, database.MATCH_NOT_SOLD_TO_USER, database.MATCH_UNKNOWN}
+    if results["per email"] != results["per message"]:
+        print("FAIL: set-based matching differs from per-email matching")
+        sys.exit(1)
+    if set(found) != expected_kinds:
+        print(f"FAIL: expected every kind of result, got {sorted(found)}")
+        sys.exit(1)
+    print("OK (same results as per-email matching)")
+
+
+def bench_referrals(args):
+    """
+    تسجيل مستخدمين جدد عبر روابط دعوة (التسجيل + زيادة عدد الداعي بمعاملة واحدة)، ثم قراءة لوحة
+    المتصدرين من الجدول المحسوب مسبقاً مقابل ترتيب كل المستخدمين، والتأكد أن النتيجتين متطابقتان.
+    """
+    use_temp_db()
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", [(i,) for i in range(1, args.users + 1)])
+
+    # توزيع غير متساوٍ: قلة من الداعين يجلبون أغلب المستخدمين
+    rng = random.Random(1)
+    referrers = [int(args.users * rng.random() ** 3) + 1 for _ in range(args.joins)]
+    started = time.perf_counter()
+    for i, referrer_id in enumerate(referrers):
+        database.upsert_referred_user(args.users + 1 + i, referrer_id)
+    elapsed = time.perf_counter() - started
+    print(f"referral /start: {args.joins / elapsed:.0f} joins/s (insert + referrer count + leaderboard in one transaction)")
+
+    def legacy_leaderboard():
+        cursor = database.get_connection().cursor()
+        cursor.execute(
+            "SELECT user_id, referral_count FROM users WHERE referral_count > 0 "
+            "ORDER BY referral_count DESC, user_id LIMIT ?", (database.LEADERBOARD_SIZE,))
+        return [{"user_id": row[0], "referral_count": row[1]} for row in cursor.fetchall()]
+
+    results = {}
+    for label, read in (("ORDER BY over users", legacy_leaderboard), ("precomputed", database.get_referral_leaderboard)):
+        started = time.perf_counter()
+        for _ in range(args.reads):
+            results[label] = read()
+        print(f"{label:>20}: {(time.perf_counter() - started) / args.reads * 1000:.3f} ms per read")
+
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT SUM(referral_count), (SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL) FROM users")
+    counted, referred = cursor.fetchone()
+    # إعادة /start لمستخدم موجود (حتى برابط دعوة آخر) لا تُحتسب مرة ثانية
+    repeated = database.upsert_referred_user(args.users + 1, 1)["referrer_count"]
+    if results["ORDER BY over users"] != results["precomputed"] or counted != args.joins or referred != args.joins \
+            or repeated is not None:
+        print(f"FAIL: leaderboard {results}, counted {counted}, referred {referred}, repeated {repeated}")
+        sys.exit(1)
+    print("OK (leaderboard matches, every join counted exactly once)")
+
+
+# AFTER UPDATE OF x ON t  ->  "UPDATE"
+_TRIGGER_EVENT = re.compile(r"\b(?:AFTER|BEFORE)\s+(INSERT|DELETE|UPDATE)\b", re.IGNORECASE)
+
+
+def sqlite_schema(cursor):
+    """الجداول وأعمدتها، والفهارس (الجدول، الأعمدة، UNIQUE، جزئي)، والـ triggers (الجدول، الاسم، الحدث)."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = {}
+    indexes = set()
+    for (table,) in cursor.fetchall():
+        tables[table] = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+        for _, name, unique, origin, partial in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+            if origin == "pk":
+                continue
+            columns = tuple(row[2] for row in cursor.execute(f"PRAGMA index_info({name})").fetchall())
+            indexes.add((table, columns, bool(unique), bool(partial)))
+
+    triggers = set()
+    cursor.execute("SELECT tbl_name, name, sql FROM sqlite_master WHERE type = 'trigger'")
+    for table, name, sql in cursor.fetchall():
+        triggers.add((table, name, _TRIGGER_EVENT.search(sql).group(1).upper()))
+    return {"tables": tables, "indexes": indexes, "triggers": triggers}
+
+
+def postgres_schema(cursor):
+    """نفس وصف sqlite_schema من information_schema و pg_index (بدون جدول schema_version الخاص بالـ backend)."""
+    tables = collections.defaultdict(set)
+    cursor.execute(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name != 'schema_version'"
+    )
+    for table, column in cursor.fetchall():
+        tables[table].add(column)
+
+    cursor.execute(
+        """
+        SELECT t.relname, array_agg(a.attname ORDER BY k.position), x.indisunique, x.indpred IS NOT NULL
+        FROM pg_index x
+        JOIN pg_class t ON t.oid = x.indrelid
+        CROSS JOIN unnest(x.indkey) WITH ORDINALITY AS k(attnum, position)
+        JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE t.relnamespace = current_schema()::regnamespace AND NOT x.indisprimary AND t.relname != 'schema_version'
+        GROUP BY x.indexrelid, t.relname, x.indisunique, x.indpred
+        """
+    )
+    indexes = {(table, tuple(columns), unique, partial) for table, columns, unique, partial in cursor.fetchall()}
+
+    cursor.execute(
+        "SELECT event_object_table, trigger_name, event_manipulation FROM information_schema.triggers "
+        "WHERE trigger_schema = current_schema()"
+    )
+    triggers = set(cursor.fetchall())
+    return {"tables": dict(tables), "indexes": indexes, "triggers": triggers}
+
+
+def bench_schema(args):
+    """
+    يطبق MIGRATIONS على ملف SQLite مؤقت و POSTGRES_MIGRATIONS على schema مؤقت، ويقارن الناتج:
+    نفس الجداول بنفس الأعمدة، نفس الفهارس، ونفس الـ triggers بنفس الأسماء والأحداث
+    (ترحيل PostgreSQL مجمّع يدوياً من ترحيلات SQLite، فأي اختلاف بينهما خطأ). أعمدة UPDATE OF
+    لا تُقارن: triggers العدادات في PostgreSQL على مستوى الجملة، وهذه لا تقبل قائمة أعمدة.
+    """
+    use_temp_db()
+    postgres = postgres_schema(database.get_connection().cursor())
+    database.close_connection()
+    database.DATABASE_URL = ""   # نفس المجلد المؤقت من use_temp_db، بترحيلات SQLite
+    database.initialize_db()
+    sqlite = sqlite_schema(database.get_connection().cursor())
+
+    problems = []
+    for table in sorted(set(sqlite["tables"]) | set(postgres["tables"])):
+        missing = sqlite["tables"].get(table, set()) ^ postgres["tables"].get(table, set())
+        if missing:
+            problems.append(f"table {table}: columns only in one backend: {sorted(missing)}")
+    for kind in ("indexes", "triggers"):
+        for item in sorted(sqlite[kind] - postgres[kind]):
+            problems.append(f"{kind} only in SQLite: {item}")
+        for item in sorted(postgres[kind] - sqlite[kind]):
+            problems.append(f"{kind} only in PostgreSQL: {item}")
+
+    print(f"sqlite: {len(sqlite['tables'])} tables, {len(sqlite['indexes'])} indexes, {len(sqlite['triggers'])} triggers "
+          f"(schema version {len(database.MIGRATIONS)})")
+    print(f"postgresql: {len(postgres['tables'])} tables, {len(postgres['indexes'])} indexes, "
+          f"{len(postgres['triggers'])} triggers (schema version {len(database.POSTGRES_MIGRATIONS)})")
+    if problems:
+        print("FAIL:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+    print("OK (same tables, columns, indexes and triggers)")
+
+
+def initialize_in_process(database_url, db_name, barrier, errors):
+    database.DATABASE_URL = database_url
+    database.DB_NAME = db_name
+    barrier.wait()
+    try:
+        database.initialize_db()
+    except Exception as e:
+        errors.put(f"{type(e).__name__}: {e}")
+    finally:
+        database.close_connection()
+
+
+def bench_migrate(args):
+    """
+    عدة عمليات بوت تبدأ معاً على قاعدة بيانات جديدة وكلها تطبق الترحيلات. كل ترحيل يجب أن يُطبق مرة واحدة:
+    العملية التي تنتظر القفل تعيد قراءة رقم النسخة بعده ولا تعيد ترحيلاً طبقته عملية أخرى.
+    """
+    failures = []
+    for _ in range(args.rounds):
+        use_temp_db(initialize=False)
+        barrier = multiprocessing.Barrier(args.processes)
+        errors = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=initialize_in_process,
+                                    args=(database.DATABASE_URL, database.DB_NAME, barrier, errors))
+            for _ in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        while not errors.empty():
+            failures.append(errors.get())
+        version = database.get_schema_version()
+        if version != len(database.get_backend().migrations):
+            failures.append(f"schema version {version} after all processes finished")
+        database.close_connection()
+
+    print(f"{args.rounds} rounds x {args.processes} processes initializing the same new database: "
+          f"{len(failures)} failures")
+    if failures:
+        print("FAIL:\n  " + "\n  ".join(sorted(set(failures))))
+        sys.exit(1)
+    print("OK")
+
+
+# خط الأساس لقياس scaling: نمو زمن كل دالة مع حجم الجداول (الزمن عند كل حجم ÷ الزمن عند أصغر حجم)،
+# لا الأزمنة نفسها، فيصلح للمقارنة على أي جهاز. يُحدَّث بـ --save-baseline.
+# خطط PostgreSQL تختلف عن SQLite، فله خط أساس منفصل (benchmark_baseline_postgres.json) بالأحجام التي يقيسها CI
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+BASELINE_NOISE_FLOOR = 0.00002   # زيادة أقل من 20 ميكروثانية عن الزمن المتوقع تعتبر ضجيجاً لا تراجعاً
+SCALING_WARMUP_CALLS = 10         # استدعاءات غير محسوبة قبل القياس (كاش الاستعلامات المحضّرة والصفحات)
+
+
+def fill_scale_tables(rows):
+    """
+    يملأ users و american_emails و submitted_emails بـ rows صف لكل جدول: نصف الإيميلات الأمريكية
+    مباع للمستخدمين بالتناوب والنصف متاح، و1% من الإيميلات المرسلة معلق والباقي مقبول.
+    """
+    now = database.datetime.datetime.now()
+    with database.transaction() as cursor:
+        database._insert_rows(cursor, "INSERT INTO users (user_id) VALUES", ((i,) for i in range(1, rows + 1)))
+        database._insert_rows(
+            cursor, "INSERT INTO american_emails (email, password, status, sold_to_user_id, sold_at) VALUES",
+            ((f"scale{i}@example.com", "pw", "sold", i % rows + 1,
+              (now - database.datetime.timedelta(minutes=i % 1000)).isoformat()) if i < rows // 2
+             else (f"scale{i}@example.com", "pw", "available", None, None)
+             for i in range(rows)))
+        database._insert_rows(
+            cursor, "INSERT INTO submitted_emails (seller_user_id, email, password, type, status) VALUES",
+            ((i % rows + 1, f"submitted{i}@example.com", "pw", "american", "pending" if i % 100 == 0 else "approved")
+             for i in range(rows)))
+        cursor.execute("ANALYZE")
+
+
+def scaling_calls(rows):
+    """الدوال المقاسة: كل واحدة تأخذ رقم الاستدعاء i (لمستخدمين وإيميلات مختلفة في كل استدعاء)."""
+    def user(i):
+        return i % rows + 1
+
+    return {
+        # القراءة
+        "get_user": lambda i: database.get_user(user(i)),
+        "get_available_american_emails": lambda i: database.get_available_american_emails(5),
+        "get_available_american_emails_page": lambda i: database.get_available_american_emails_page(),
+        "get_last_sold_emails_to_user": lambda i: database.get_last_sold_emails_to_user(user(i)),
+        "get_pending_submitted_emails": lambda i: database.get_pending_submitted_emails(limit=5),
+        "get_pending_review_page": lambda i: database.get_pending_review_page(),
+        "get_submitted_email_by_id": lambda i: database.get_submitted_email_by_id(user(i)),
+        "get_american_emails_counts": lambda i: database.get_american_emails_counts(),
+        "get_stats": lambda i: database.get_stats(),
+        "match_american_submissions": lambda i: database.match_american_submissions(
+            user(i), [f"scale{(i * 7919 + k) % rows}@example.com" for k in range(5)]),
+        # الكتابة
+        "upsert_user": lambda i: database.upsert_user(rows + 1 + i),
+        "update_user_balance": lambda i: database.update_user_balance(user(i), 1),
+        "claim_american_emails": lambda i: database.claim_american_emails(user(i), 2),
+        "add_american_emails_bulk": lambda i: database.add_american_emails_bulk(
+            [(f"new{i}_{k}@example.com", "pw") for k in range(10)]),
+        "add_submitted_emails_bulk": lambda i: database.add_submitted_emails_bulk(
+            user(i), [(f"resubmitted{i}_{k}@example.com", "pw", None) for k in range(5)], "american"),
+        # يقبل ما أضافه add_submitted_emails_bulk لنفس البائع قبله
+        "approve_seller_submissions": lambda i: database.approve_seller_submissions(user(i), sys.maxsize, 1),
+    }
+
+
+def size_label(rows):
+    for unit, size in (("M", 1_000_000), ("k", 1000)):
+        if rows >= size and rows % size == 0:
+            return f"{rows // size}{unit}"
+    return str(rows)
+
+
+def bench_scaling(args):
+    """
+    زمن كل دالة في database.py (الوسيط لكل استدعاء) على جداول بأحجام مختلفة، بدون كاش المستخدمين،
+    وجدول يوضح كيف يكبر الزمن مع حجم الجداول. يفشل لو نما زمن أي دالة (مقارنة بزمنها عند أصغر حجم)
+    أكثر من نموه في خط الأساس المحفوظ بـ --tolerance مرة.
+    """
+    results = {}
+    for rows in args.sizes:
+        use_temp_db()
+        started = time.perf_counter()
+        fill_scale_tables(rows)
+        print(f"{size_label(rows)}: filled 3 x {rows} rows in {time.perf_counter() - started:.1f}s")
+        # الزمن الفعلي على قاعدة البيانات، لا إصابات الكاش
+        database._user_cache.max_size = 0
+        timings = {}
+        for name, call in scaling_calls(rows).items():
+            for i in range(args.calls, args.calls + SCALING_WARMUP_CALLS):
+                call(i)
+            durations = []
+            for i in range(args.calls):
+                started = time.perf_counter()
+                call(i)
+                durations.append(time.perf_counter() - started)
+            durations.sort()
+            timings[name] = durations[len(durations) // 2]
+        results[str(rows)] = timings
+        database.close_connection()
+
+    base_rows = min(args.sizes)
+    growth = {str(rows): {name: seconds / results[str(base_rows)][name] for name, seconds in timings.items()}
+              for rows, timings in results.items()}
+    labels = [size_label(rows) for rows in args.sizes]
+    print(f"\n{'function':>36} " + " ".join(f"{label:>10}" for label in labels) + "     growth")
+    for name in results[str(args.sizes[0])]:
+        times = [results[str(rows)][name] for rows in args.sizes]
+        print(f"{name:>36} " + " ".join(f"{t * 1e6:>8.1f}us" for t in times) + f" {times[-1] / times[0]:>9.1f}x")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"base_rows": base_rows, "growth": growth}, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline} (run with --save-baseline to create it)")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["base_rows"] != base_rows:
+        print(f"baseline growth is relative to {size_label(baseline['base_rows'])} rows; "
+              f"run with it as the smallest --sizes to compare")
+        return
+    # نمو أقل من 1 في خط الأساس ضجيج قياس (الدالة لا تصبح أسرع مع كبر الجداول)، فلا يُقارن بأقل من 1
+    expected = {rows: {name: max(ratio, 1.0) for name, ratio in ratios.items()}
+                for rows, ratios in baseline["growth"].items()}
+    # تراجع: النمو أكبر من نمو خط الأساس بـ tolerance مرة، والزيادة عن الزمن المتوقع (زمن أصغر حجم × نمو
+    # خط الأساس) ليست ضجيجاً
+    regressions = [
+        f"{name} @ {size_label(int(rows))}: growth {expected[rows][name]:.1f}x -> {ratio:.1f}x "
+        f"(vs {size_label(base_rows)})"
+        for rows, ratios in growth.items() if rows in expected
+        for name, ratio in ratios.items() if name in expected[rows]
+        and ratio > expected[rows][name] * args.tolerance
+        and results[rows][name] - results[str(base_rows)][name] * expected[rows][name] > BASELINE_NOISE_FLOOR
+    ]
+    compared = [rows for rows in growth if rows in expected and rows != str(base_rows)]
+    if not compared:
+        print(f"baseline has none of these sizes besides {size_label(base_rows)}; nothing to compare")
+        return
+    if regressions:
+        print("FAIL: regressions versus baseline:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print(f"OK (no function grew more than {args.tolerance}x its baseline growth at "
+          f"{', '.join(size_label(int(rows)) for rows in compared)})")
+
+
+def bench_dispatch(args):
+    """
+    تكلفة توجيه رسالة نصية لمعالجها مع زيادة عدد الأزرار: سلسلة MessageHandler بـ filters.Regex
+    (كل معالج يُفحص بالترتيب) مقابل معالج واحد بـ filters.Text وجدول (نص الزر -> الدالة).
+    """
+    from telegram import Update
+    from telegram.ext import MessageHandler, filters
+
+    async def handler(update, context):
+        pass
+
+    def make_update(text):
+        return Update.de_json({
+            "update_id": 1,
+            "message": {
+                "message_id": 1, "date": 0, "text": text,
+                "chat": {"id": 1, "type": "private"},
+                "from": {"id": 1, "is_bot": False, "first_name": "User"},
+            },
+        }, None)
+
+    def per_update_us(dispatch, update):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            dispatch(update)
+        return (time.perf_counter() - started) / args.iterations * 1e6
+
+    print(f"{'handlers':>8} {'regex last (us)':>16} {'regex miss (us)':>16} {'table hit (us)':>15} {'table miss (us)':>16}")
+    for count in args.handlers:
+        buttons = [f"زر رقم {i}" for i in range(count)]
+        regex_chain = [MessageHandler(filters.Regex(f"^{re.escape(b)}$"), handler) for b in buttons]
+        table = dict.fromkeys(buttons, handler)
+        table_handler = MessageHandler(filters.Text(table), handler)
+
+        def regex_dispatch(update):
+            for h in regex_chain:
+                if h.check_update(update):
+                    return h.callback
+            return None
+
+        def table_dispatch(update):
+            return table[update.message.text] if table_handler.check_update(update) else None
+
+        # أسوأ حالة للسلسلة: آخر زر، أو نص حر (إيميلات، أرقام) يمر على كل المعالجات بدون تطابق
+        last, miss = make_update(buttons[-1]), make_update("user@example.com:password")
+        print(f"{count:>8} {per_update_us(regex_dispatch, last):>16.2f} {per_update_us(regex_dispatch, miss):>16.2f} "
+              f"{per_update_us(table_dispatch, last):>15.2f} {per_update_us(table_dispatch, miss):>16.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس أداء قاعدة بيانات البوت")
+    parser.add_argument("--database-url", default="", help="رابط postgresql:// للقياس على PostgreSQL بدل SQLite")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("connections", help="مقارنة اتصال لكل استدعاء مع الاتصال المشترك")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--calls", type=int, default=2000, help="عدد الاستدعاءات لكل خيط")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8])
+    p.set_defaults(func=bench_connections)
+
+    p = sub.add_parser("claims", help="اختبار ضغط لحجز الإيميلات الأمريكية بشكل متزامن")
+    p.add_argument("--emails", type=int, default=3000)
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--claims", type=int, default=50, help="عدد عمليات الحجز لكل خيط")
+    p.add_argument("--count", type=int, default=5, help="عدد الإيميلات في كل حجز")
+    p.set_defaults(func=bench_claims)
+
+    p = sub.add_parser("plans", help="التأكد أن الاستعلامات المتكررة تستخدم الفهارس")
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser("start", help="زمن تسجيل المستخدم عند /start")
+    p.add_argument("--users", type=int, default=5000)
+    p.set_defaults(func=bench_start)
+
+    p = sub.add_parser("usercache", help="استعلامات قاعدة البيانات لكل تحديث مع كاش المستخدمين وبدونه")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--updates", type=int, default=50000)
+    p.set_defaults(func=bench_usercache)
+
+    p = sub.add_parser("stats", help="الإحصائيات من العدادات مقابل التجميع على الجداول، مع التحقق من صحتها")
+    p.add_argument("--rows", type=int, default=200000, help="عدد الإيميلات الأمريكية (والباقي بالنسبة)")
+    p.add_argument("--operations", type=int, default=5000)
+    p.add_argument("--reads", type=int, default=50)
+    p.set_defaults(func=bench_stats)
+
+    p = sub.add_parser("ledger", help="مطابقة الأرصدة مع سجل الحركات على بيانات كبيرة")
+    p.add_argument("--users", type=int, default=50000)
+    p.add_argument("--rows", type=int, default=1000000, help="عدد حركات الرصيد")
+    p.add_argument("--batch-size", type=int, default=5000)
+    p.set_defaults(func=bench_ledger)
+
+    p = sub.add_parser("withdrawals", help="معالجة طابور طلبات السحب: طلب بطلب مقابل دفعات")
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=bench_withdrawals)
+
+    p = sub.add_parser("expiry", help="إنهاء مهلة الإيميلات المباعة على دفعات، وزمن الدورة الفارغة، وصحة العدادات")
+    p.add_argument("--rows", type=int, default=500000, help="عدد الإيميلات الأمريكية (نصفها مباع)")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=bench_expiry)
+
+    p = sub.add_parser("matching", help="مطابقة الإيميلات المرسلة مع المخزون: استعلام لكل إيميل مقابل استعلام لكل رسالة")
+    p.add_argument("--rows", type=int, default=200000, help="عدد الإيميلات الأمريكية (نصفها مباع)")
+    p.add_argument("--submissions", type=int, default=1000, help="عدد الرسائل (مستخدم لكل رسالة)")
+    p.add_argument("--emails", type=int, default=20, help="عدد إيميلات المستخدم نفسه في كل رسالة")
+    p.set_defaults(func=bench_matching)
+
+    p = sub.add_parser("referrals", help="التسجيل عبر روابط الدعوة ولوحة المتصدرين المحسوبة مسبقاً")
+    p.add_argument("--users", type=int, default=200000, help="عدد المستخدمين الموجودين (الداعين المحتملين)")
+    p.add_argument("--joins", type=int, default=20000, help="عدد المستخدمين الجدد عبر روابط الدعوة")
+    p.add_argument("--reads", type=int, default=50)
+    p.set_defaults(func=bench_referrals)
+
+    p = sub.add_parser("scaling", help="زمن كل دالة في database.py مع كبر الجداول، ومقارنة نموه بخط الأساس المحفوظ")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="عدد الصفوف في كل جدول")
+    p.add_argument("--calls", type=int, default=200, help="عدد الاستدعاءات لكل دالة في كل حجم")
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--tolerance", type=float, default=2.0, help="أقصى نسبة مسموحة لنمو الزمن مقارنة بنموه في خط الأساس")
+    p.add_argument("--save-baseline", action="store_true", help="حفظ النتائج كخط أساس جديد بدل المقارنة")
+    p.set_defaults(func=bench_scaling)
+
+    p = sub.add_parser("migrate", help="عدة عمليات تهيئ نفس قاعدة البيانات الجديدة في نفس الوقت، وكل ترحيل يُطبق مرة واحدة")
+    p.add_argument("--processes", type=int, default=8)
+    p.add_argument("--rounds", type=int, default=5)
+    p.set_defaults(func=bench_migrate)
+
+    p = sub.add_parser("schema", help="مقارنة الجداول والفهارس والـ triggers بين ترحيلات SQLite و PostgreSQL (يتطلب --database-url)")
+    p.set_defaults(func=bench_schema)
+
+    p = sub.add_parser("dispatch", help="تكلفة توجيه الرسائل: سلسلة Regex مقابل جدول الأزرار")
+    p.add_argument("--handlers", type=int, nargs="+", default=[5, 20, 50, 200])
+    p.add_argument("--iterations", type=int, default=20000)
+    p.set_defaults(func=bench_dispatch)
+
+    args = parser.parse_args()
+    if args.database_url:
+        # usercache: كاش المستخدمين معطل مع PostgreSQL (عدة عمليات تكتب في نفس البيانات)
+        if args.command in ("connections", "plans", "usercache"):
+            parser.error(f"{args.command} خاص بـ SQLite ولا يعمل مع --database-url")
+        global DATABASE_URL
+        DATABASE_URL = args.database_url
+    elif args.command == "schema":
+        parser.error("schema يقارن مع PostgreSQL ويتطلب --database-url")
+    try:
+        args.func(args)
+    finally:
+        remove_temp_dbs()
+
+
+if __name__ == "__main__":
+    main()
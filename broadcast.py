@@ -0,0 +1,72 @@
+# broadcast.py - محرك الرسائل الجماعية
+#
+# المستخدمون يُقرأون من جدول users على دفعات (لا نحمل كل القائمة في الذاكرة)، وكل دفعة
+# ترسلها مجموعة عمال متوازية بأقصى سرعة يسمح بها OutboundRateLimiter. بعد كل دفعة تُحفظ
+# نقطة التقدم في جدول broadcasts، فلو توقف البوت يكمل الإرسال من آخر دفعة عند التشغيل التالي.
+
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from async_db import get_user_ids_after, checkpoint_broadcast, finish_broadcast
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CHUNK_SIZE = 200   # عدد المستخدمين في كل دفعة (وهو أقصى ما قد يُعاد إرساله بعد توقف مفاجئ)
+BROADCAST_WORKERS = 30       # عدد العمال المتوازيين (يكفي لتشبيع حد تيليجرام العام 30 رسالة/ثانية)
+
+
+async def _send_chunk(bot, text, user_ids, workers):
+    """يرسل النص لدفعة من المستخدمين بعدة عمال، ويرجع عدادات (وصل، محظور، فشل)."""
+    queue = asyncio.Queue()
+    for user_id in user_ids:
+        queue.put_nowait(user_id)
+    counts = {"delivered": 0, "blocked": 0, "failed": 0}
+
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await bot.send_message(chat_id=user_id, text=text)
+                counts["delivered"] += 1
+            except Forbidden:
+                # المستخدم حظر البوت أو حذف حسابه
+                counts["blocked"] += 1
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    counts["blocked"] += 1
+                else:
+                    counts["failed"] += 1
+                    logger.warning(f"فشل إرسال الرسالة الجماعية للمستخدم {user_id}: {e}")
+            except TelegramError as e:
+                counts["failed"] += 1
+                logger.warning(f"فشل إرسال الرسالة الجماعية للمستخدم {user_id}: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(user_ids)))))
+    return counts
+
+
+async def run_broadcast(bot, broadcast, chunk_size=BROADCAST_CHUNK_SIZE, workers=BROADCAST_WORKERS):
+    """
+    يرسل الرسالة الجماعية لكل المستخدمين بدءاً من نقطة التقدم المحفوظة،
+    ويرجع سجل الرسالة النهائي (مع عدادات وصل/محظور/فشل).
+    """
+    broadcast_id = broadcast["id"]
+    last_user_id = broadcast["last_user_id"]
+    logger.info(f"بدء/استكمال الرسالة الجماعية {broadcast_id} بعد المستخدم {last_user_id}.")
+
+    while True:
+        user_ids = await get_user_ids_after(last_user_id, chunk_size)
+        if not user_ids:
+            break
+        counts = await _send_chunk(bot, broadcast["text"], user_ids, workers)
+        last_user_id = user_ids[-1]
+        await checkpoint_broadcast(broadcast_id, last_user_id, counts["delivered"], counts["blocked"], counts["failed"])
+
+    result = await finish_broadcast(broadcast_id)
+    logger.info(f"انتهت الرسالة الجماعية {broadcast_id}: {result}")
+    return result
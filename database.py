@@ -1,23 +1,157 @@
-import sqlite3
+import itertools
+import json
 import logging
 import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import storage
+from storage import DATABASE_ERRORS, INTEGRITY_ERRORS
 
 logger = logging.getLogger(__name__)
 
 # اسم ملف قاعدة البيانات
 DB_NAME = 'hasan_bot.db'
 
+# رابط قاعدة بيانات بديلة (storage.py): فارغ = ملف SQLite في DB_NAME،
+# أو postgresql://... لتشارك عدة عمليات بوت نفس البيانات
+DATABASE_URL = ""
+
+# كاش بيانات المستخدمين (get_user)
+USER_CACHE_SIZE = 10000       # أقصى عدد مستخدمين في الكاش (الأقدم استخداماً يُحذف أولاً)
+USER_CACHE_TTL = 300          # ثواني صلاحية كل عنصر (حد أعلى لقدم البيانات لو عدّلها برنامج آخر)
+
+# مهلة إعادة بيع الإيميلات الأمريكية بعد استلامها من البوت
+RESALE_WINDOW = datetime.timedelta(hours=24)
+
+# عدد أصحاب أكثر الدعوات في لوحة المتصدرين (جدول referral_leaderboard لا يحتفظ بأكثر منهم)
+LEADERBOARD_SIZE = 10
+
+# كل خيط (thread) عنده اتصال واحد طويل العمر بدل فتح اتصال جديد مع كل استدعاء
+_local = threading.local()
+_backend = None
+
+def get_backend():
+    """الـ backend الحالي حسب DATABASE_URL و DB_NAME (يُنشأ من جديد إذا تغيّرا، كما تفعل أدوات القياس)."""
+    global _backend
+    key = DATABASE_URL or DB_NAME
+    if _backend is None or _backend.key != key:
+        _backend = storage.open_backend(DATABASE_URL, DB_NAME, MIGRATIONS, POSTGRES_MIGRATIONS)
+        # مع قاعدة بيانات مشتركة تكتب فيها عمليات أخرى، كاش المستخدمين داخل العملية قد يصبح قديماً
+        _user_cache.max_size = 0 if _backend.shared else USER_CACHE_SIZE
+        _user_cache.clear()
+    return _backend
+
 def connect_db():
-    """يتصل بقاعدة البيانات ويرجع كائن الاتصال."""
-    return sqlite3.connect(DB_NAME)
+    """يفتح اتصالاً جديداً بقاعدة البيانات مع إعدادات الأداء ويرجعه."""
+    return get_backend().connect()
 
-def initialize_db():
-    """يهيئ قاعدة البيانات وينشئ الجداول إذا لم تكن موجودة."""
-    conn = connect_db()
-    cursor = conn.cursor()
+def get_connection():
+    """يرجع الاتصال المشترك الخاص بالخيط الحالي، ويفتحه أول مرة فقط."""
+    conn = getattr(_local, 'conn', None)
+    backend = get_backend()
+    if conn is None or _local.backend is not backend:
+        if conn is not None:
+            conn.close()
+        conn = backend.connect()
+        _local.conn = conn
+        _local.backend = backend
+    return conn
+
+def close_connection():
+    """يغلق الاتصال المشترك للخيط الحالي (عند إيقاف البوت مثلاً)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    يفتح معاملة صريحة على الاتصال المشترك ويرجع cursor.
+    يعمل commit عند النجاح و rollback عند أي خطأ.
+    """
+    conn = get_connection()
+    conn.execute(get_backend().begin_sql(immediate))
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+class LRUCache:
+    """كاش LRU محدود الحجم مع مدة صلاحية لكل عنصر، مع عدادات إصابة/إخفاق."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()   # key -> (value, وقت الانتهاء)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[1] > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                del self._items[key]
+            self.misses += 1
+            return None
 
-    # جدول المستخدمين
-    cursor.execute('''
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# كل كتابة على جدول users تحدّث الكاش أو تحذف المستخدم منه بعد نجاحها (write-through).
+# دوال database.py كلها تعمل على خيط قاعدة البيانات الواحد (async_db)، فلا تتسابق قراءة قديمة مع كتابة.
+_user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def _user_cache_key(user_id):
+    # قاعدة البيانات ضمن المفتاح: أدوات القياس تبدّل DB_NAME لملفات مؤقتة
+    return (DATABASE_URL or DB_NAME, user_id)
+
+def user_cache_stats():
+    return _user_cache.stats()
+
+# ترحيلات قاعدة البيانات (Migrations)
+# كل عنصر في القائمة هو نسخة من المخطط، ورقمه (يبدأ من 1) يُخزن في PRAGMA user_version (SQLite).
+# لا تعدّل ترحيلاً قديماً أبداً، أضف ترحيلاً جديداً في آخر القائمة.
+MIGRATIONS = [
+    # 1: الجداول الأساسية
+    [
+        # جدول المستخدمين
+        '''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             balance INTEGER DEFAULT 0,
@@ -25,10 +159,9 @@ def initialize_db():
             referred_by INTEGER,
             referral_count INTEGER DEFAULT 0
         )
-    ''')
-
-    # جدول الإيميلات الأمريكية
-    cursor.execute('''
+        ''',
+        # جدول الإيميلات الأمريكية
+        '''
         CREATE TABLE IF NOT EXISTS american_emails (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT NOT NULL UNIQUE,
@@ -37,10 +170,9 @@ def initialize_db():
             sold_to_user_id INTEGER,
             sold_at TEXT
         )
-    ''')
-
-    # جدول الإيميلات التي أرسلها المستخدمون للمراجعة (سواء أمريكية بعد الـ 24 ساعة أو عشوائية)
-    cursor.execute('''
+        ''',
+        # جدول الإيميلات التي أرسلها المستخدمون للمراجعة (سواء أمريكية بعد الـ 24 ساعة أو عشوائية)
+        '''
         CREATE TABLE IF NOT EXISTS submitted_emails (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             seller_user_id INTEGER NOT NULL,
@@ -51,10 +183,9 @@ def initialize_db():
             rejection_reason TEXT,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-
-    # جدول طلبات السحب
-    cursor.execute('''
+        ''',
+        # جدول طلبات السحب
+        '''
         CREATE TABLE IF NOT EXISTS withdrawal_requests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -66,166 +197,886 @@ def initialize_db():
             requested_at TEXT DEFAULT CURRENT_TIMESTAMP,
             processed_at TEXT
         )
-    ''')
+        ''',
+    ],
+    # 2: فهارس للاستعلامات المتكررة حتى لا تتحول لمسح كامل للجداول مع كبر البيانات
+    [
+        # الإيميلات المتاحة مرتبة بالـ id (الحجز) وعدّ الإيميلات حسب الحالة
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_status ON american_emails (status, id)",
+        # آخر الإيميلات المباعة لمستخدم معين (get_last_sold_emails_to_user)
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_sold_to ON american_emails (sold_to_user_id, sold_at)",
+        # الإيميلات المعلقة للمراجعة فقط (فهرس جزئي صغير)
+        "CREATE INDEX IF NOT EXISTS idx_submitted_emails_pending ON submitted_emails (id) WHERE status = 'pending'",
+    ],
+    # 3: طابور المراجعة مجمّع حسب البائع
+    [
+        "CREATE INDEX IF NOT EXISTS idx_submitted_emails_pending_seller ON submitted_emails (seller_user_id, id) WHERE status = 'pending'",
+    ],
+    # 4: الرسائل الجماعية مع نقطة التقدم (حتى يكمل الإرسال بعد إعادة التشغيل بدل أن يعيد من البداية)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+        ''',
+    ],
+    # 5: حالة المحادثات و user_data (persistence.py)، حتى لا تضيع المحادثات المفتوحة عند إعادة التشغيل
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+        ''',
+    ],
+    # 6: عدادات الإحصائيات تحدّثها triggers بنفس معاملة كل كتابة، فقراءتها O(1) بدل COUNT/SUM على الجداول
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        # القيم الابتدائية من البيانات الموجودة
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users",
+        "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users.balance', COALESCE(SUM(balance), 0) FROM users",
+        "INSERT OR REPLACE INTO stats_counters (name, value) "
+        "SELECT 'american_emails.' || status, COUNT(*) FROM american_emails GROUP BY status",
+        "INSERT OR REPLACE INTO stats_counters (name, value) "
+        "SELECT 'submitted_emails.' || status, COUNT(*) FROM submitted_emails GROUP BY status",
+        "INSERT OR REPLACE INTO stats_counters (name, value) "
+        "SELECT 'withdrawal_requests.' || status, COUNT(*) FROM withdrawal_requests GROUP BY status",
+        "INSERT OR REPLACE INTO stats_counters (name, value) "
+        "SELECT 'withdrawal_requests.' || status || '.amount', SUM(amount) FROM withdrawal_requests GROUP BY status",
+        # المستخدمون ومجموع الأرصدة
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value + COALESCE(NEW.balance, 0) WHERE name = 'users.balance';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value - COALESCE(OLD.balance, 0) WHERE name = 'users.balance';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_balance AFTER UPDATE OF balance ON users
+        WHEN OLD.balance IS NOT NEW.balance BEGIN
+            UPDATE stats_counters SET value = value + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0)
+            WHERE name = 'users.balance';
+        END
+        ''',
+        # عدد الإيميلات الأمريكية حسب الحالة
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_american_emails_stats_insert AFTER INSERT ON american_emails BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('american_emails.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_american_emails_stats_delete AFTER DELETE ON american_emails BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'american_emails.' || OLD.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_american_emails_stats_status AFTER UPDATE OF status ON american_emails
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'american_emails.' || OLD.status;
+            INSERT INTO stats_counters (name, value) VALUES ('american_emails.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        # عدد إيميلات البيع حسب الحالة (معلقة، مقبولة، مرفوضة)
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_submitted_emails_stats_insert AFTER INSERT ON submitted_emails BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('submitted_emails.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_submitted_emails_stats_delete AFTER DELETE ON submitted_emails BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'submitted_emails.' || OLD.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_submitted_emails_stats_status AFTER UPDATE OF status ON submitted_emails
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'submitted_emails.' || OLD.status;
+            INSERT INTO stats_counters (name, value) VALUES ('submitted_emails.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        # طلبات السحب: العدد والمبلغ حسب الحالة
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_withdrawal_requests_stats_insert AFTER INSERT ON withdrawal_requests BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('withdrawal_requests.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_counters (name, value) VALUES ('withdrawal_requests.' || NEW.status || '.amount', NEW.amount)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_withdrawal_requests_stats_delete AFTER DELETE ON withdrawal_requests BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'withdrawal_requests.' || OLD.status;
+            UPDATE stats_counters SET value = value - OLD.amount WHERE name = 'withdrawal_requests.' || OLD.status || '.amount';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_withdrawal_requests_stats_status AFTER UPDATE OF status ON withdrawal_requests
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'withdrawal_requests.' || OLD.status;
+            UPDATE stats_counters SET value = value - OLD.amount WHERE name = 'withdrawal_requests.' || OLD.status || '.amount';
+            INSERT INTO stats_counters (name, value) VALUES ('withdrawal_requests.' || NEW.status, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_counters (name, value) VALUES ('withdrawal_requests.' || NEW.status || '.amount', NEW.amount)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+    ],
+    # 7: سجل حركات الرصيد (لا يُعدّل ولا يُحذف منه)، و users.balance هو مجموعه المحفوظ مسبقاً
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # فهرس يغطي مجموع حركات كل مستخدم (المطابقة تقرأه بدون الرجوع للجدول)
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, amount)",
+        # الأرصدة الموجودة قبل السجل تصبح حركة افتتاحية، فيبدأ السجل مطابقاً للأرصدة
+        "INSERT INTO balance_ledger (user_id, amount, reason) SELECT user_id, balance, 'opening_balance' FROM users WHERE balance != 0",
+    ],
+    # 8: طابور طلبات السحب (الأقدم أولاً) وطلبات كل مستخدم
+    [
+        "CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_status ON withdrawal_requests (status, requested_at)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_user ON withdrawal_requests (user_id, requested_at)",
+    ],
+    # 9: الإيميلات حسب الحالة مرتبة بوقت البيع، لإنهاء مهلة الـ 24 ساعة بدون مسح الجدول
+    [
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_sold_at ON american_emails (status, sold_at)",
+    ],
+    # 10: نتيجة المطابقة التلقائية لكل إيميل أمريكي مرسل للمراجعة (NULL للإيميلات العشوائية)
+    [
+        "ALTER TABLE submitted_emails ADD COLUMN match_status TEXT",
+    ],
+    # 11: لوحة متصدري الدعوات محسوبة مسبقاً: أعلى LEADERBOARD_SIZE فقط، ويحدّثها trigger مع كل زيادة
+    # في referral_count (العدد لا ينقص، فمن هو خارج اللوحة لا يدخلها إلا عند زيادة عدده)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS referral_leaderboard (
+            user_id INTEGER PRIMARY KEY,
+            referral_count INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR REPLACE INTO referral_leaderboard (user_id, referral_count) "
+        "SELECT user_id, referral_count FROM users WHERE referral_count > 0 "
+        f"ORDER BY referral_count DESC, user_id LIMIT {LEADERBOARD_SIZE}",
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_users_referral_leaderboard AFTER UPDATE OF referral_count ON users
+        WHEN NEW.referral_count > COALESCE(OLD.referral_count, 0) BEGIN
+            INSERT INTO referral_leaderboard (user_id, referral_count) VALUES (NEW.user_id, NEW.referral_count)
+            ON CONFLICT (user_id) DO UPDATE SET referral_count = excluded.referral_count;
+            DELETE FROM referral_leaderboard WHERE user_id NOT IN (
+                SELECT user_id FROM referral_leaderboard ORDER BY referral_count DESC, user_id LIMIT {LEADERBOARD_SIZE}
+            );
+        END
+        ''',
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# ترحيلات PostgreSQL (storage.PostgresBackend): نفس جداول وفهارس وعدادات MIGRATIONS أعلاه
+# (حتى الترحيل 11) بلهجة PostgreSQL، ورقم النسخة في جدول schema_version.
+# أي ترحيل جديد في MIGRATIONS يحتاج ترحيلاً مقابلاً هنا.
+# الأوقات نصوص بنفس صيغة SQLite، فمقارنتها ومعالجتها في الدوال أدناه لا تتغير.
+_NOW_TEXT = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+
+POSTGRES_MIGRATIONS = [
+    # 1: المخطط الكامل
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            balance INTEGER DEFAULT 0,
+            role TEXT DEFAULT 'user',
+            referred_by BIGINT,
+            referral_count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS american_emails (
+            id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            status TEXT DEFAULT 'available',
+            sold_to_user_id BIGINT,
+            sold_at TEXT
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS submitted_emails (
+            id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            seller_user_id BIGINT NOT NULL,
+            email TEXT NOT NULL,
+            password TEXT NOT NULL,
+            type TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            rejection_reason TEXT,
+            created_at TEXT DEFAULT {_NOW_TEXT},
+            match_status TEXT
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS withdrawal_requests (
+            id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            phone_number TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            rejection_reason TEXT,
+            requested_at TEXT DEFAULT {_NOW_TEXT},
+            processed_at TEXT
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT {_NOW_TEXT},
+            finished_at TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id BIGINT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id BIGINT,
+            created_at TEXT DEFAULT {_NOW_TEXT}
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS referral_leaderboard (
+            user_id BIGINT PRIMARY KEY,
+            referral_count INTEGER NOT NULL
+        )
+        ''',
+        # الفهارس
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_status ON american_emails (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_sold_to ON american_emails (sold_to_user_id, sold_at)",
+        "CREATE INDEX IF NOT EXISTS idx_american_emails_sold_at ON american_emails (status, sold_at)",
+        "CREATE INDEX IF NOT EXISTS idx_submitted_emails_pending ON submitted_emails (id) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_submitted_emails_pending_seller ON submitted_emails (seller_user_id, id) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_status ON withdrawal_requests (status, requested_at)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_user ON withdrawal_requests (user_id, requested_at)",
+        # عدادات الإحصائيات (نفس أسماء العدادات في SQLite)
+        "INSERT INTO stats_counters (name, value) VALUES ('users', 0), ('users.balance', 0) ON CONFLICT DO NOTHING",
+        '''
+        CREATE OR REPLACE FUNCTION bump_stats_counter(counter TEXT, delta BIGINT) RETURNS void AS $$
+            INSERT INTO stats_counters (name, value) VALUES (counter, delta)
+            ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + excluded.value;
+        $$ LANGUAGE sql
+        ''',
+        # triggers العدادات على مستوى الجملة (transition tables): تحديث واحد لكل عداد في كل جملة.
+        # trigger لكل صف يحدّث نفس سطر العداد مرة لكل صف، وفي معاملة كبيرة (استيراد آلاف الإيميلات،
+        # دفعة إنهاء المهلة) يطول سجل نسخ ذلك السطر مع كل تحديث فيصبح الزمن تربيعياً.
+        # UPDATE بدون قائمة أعمدة (PostgreSQL لا يسمح بها مع transition tables)، والعداد لا يُكتب إذا لم يتغير
+        '''
+        CREATE OR REPLACE FUNCTION trg_users_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stats_counter('users', COUNT(*)), bump_stats_counter('users.balance', COALESCE(SUM(balance), 0))
+                FROM new_rows HAVING COUNT(*) > 0;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM bump_stats_counter('users', -COUNT(*)), bump_stats_counter('users.balance', -COALESCE(SUM(balance), 0))
+                FROM old_rows HAVING COUNT(*) > 0;
+            ELSE
+                PERFORM bump_stats_counter('users.balance', delta) FROM (
+                    SELECT (SELECT COALESCE(SUM(balance), 0) FROM new_rows) - (SELECT COALESCE(SUM(balance), 0) FROM old_rows) AS delta
+                ) AS changes WHERE delta != 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trg_users_stats_insert AFTER INSERT ON users
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_users_stats()
+        ''',
+        '''
+        CREATE TRIGGER trg_users_stats_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_users_stats()
+        ''',
+        '''
+        CREATE TRIGGER trg_users_stats_balance AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_users_stats()
+        ''',
+        # عدد الصفوف حسب الحالة لأي جدول فيه status (والمبلغ أيضاً لطلبات السحب)
+        '''
+        CREATE OR REPLACE FUNCTION trg_status_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status, COUNT(*)) FROM new_rows GROUP BY status;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status, -COUNT(*)) FROM old_rows GROUP BY status;
+            ELSE
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status, SUM(delta)) FROM (
+                    SELECT status, 1 AS delta FROM new_rows UNION ALL SELECT status, -1 FROM old_rows
+                ) AS changes GROUP BY status HAVING SUM(delta) != 0;
+            END IF;
+            IF TG_TABLE_NAME != 'withdrawal_requests' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status || '.amount', SUM(amount)) FROM new_rows GROUP BY status;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status || '.amount', -SUM(amount)) FROM old_rows GROUP BY status;
+            ELSE
+                PERFORM bump_stats_counter(TG_TABLE_NAME || '.' || status || '.amount', SUM(delta)) FROM (
+                    SELECT status, amount AS delta FROM new_rows UNION ALL SELECT status, -amount FROM old_rows
+                ) AS changes GROUP BY status HAVING SUM(delta) != 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        *(
+            statement
+            for table in ("american_emails", "submitted_emails", "withdrawal_requests")
+            for statement in (
+                f'''
+                CREATE TRIGGER trg_{table}_stats_insert AFTER INSERT ON {table}
+                REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_status_stats()
+                ''',
+                f'''
+                CREATE TRIGGER trg_{table}_stats_delete AFTER DELETE ON {table}
+                REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_status_stats()
+                ''',
+                f'''
+                CREATE TRIGGER trg_{table}_stats_status AFTER UPDATE ON {table}
+                REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION trg_status_stats()
+                ''',
+            )
+        ),
+        # لوحة متصدري الدعوات (نفس منطق trigger SQLite: الأعلى فقط، والعدد لا ينقص)
+        f'''
+        CREATE OR REPLACE FUNCTION trg_users_referral_leaderboard() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO referral_leaderboard (user_id, referral_count) VALUES (NEW.user_id, NEW.referral_count)
+            ON CONFLICT (user_id) DO UPDATE SET referral_count = excluded.referral_count;
+            DELETE FROM referral_leaderboard WHERE user_id NOT IN (
+                SELECT user_id FROM referral_leaderboard ORDER BY referral_count DESC, user_id LIMIT {LEADERBOARD_SIZE}
+            );
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER trg_users_referral_leaderboard AFTER UPDATE OF referral_count ON users
+        FOR EACH ROW WHEN (NEW.referral_count > COALESCE(OLD.referral_count, 0))
+        EXECUTE FUNCTION trg_users_referral_leaderboard()
+        ''',
+    ],
+]
+
+
+def get_schema_version():
+    backend = get_backend()
+    return backend.get_schema_version(get_connection().cursor())
+
+def initialize_db():
+    """يهيئ قاعدة البيانات ويطبق الترحيلات التي لم تُطبق بعد."""
+    backend = get_backend()
+    migrations = backend.migrations
+    version = get_schema_version()
+    if version == len(migrations):
+        # المسار السريع: المخطط محدّث، لا داعي لأي استعلام إضافي
+        return
+    for target_version in range(version + 1, len(migrations) + 1):
+        # كل ترحيل مع تحديث رقم النسخة بمعاملة واحدة، فإما يُطبق كاملاً أو لا يُطبق
+        with transaction(immediate=True) as cursor:
+            # القراءة الأولى كانت قبل القفل: عملية أخرى بدأت معنا ربما طبقت هذا الترحيل ونحن ننتظر القفل
+            if backend.get_schema_version(cursor) >= target_version:
+                continue
+            for statement in migrations[target_version - 1]:
+                cursor.execute(statement)
+            backend.set_schema_version(cursor, target_version)
+        logger.info(f"تم تطبيق ترحيل قاعدة البيانات رقم {target_version} ({backend.name}).")
 
-    conn.commit()
-    conn.close()
     logger.info("تم تهيئة قاعدة البيانات والجداول بنجاح.")
 
 # دوال التعامل مع قاعدة البيانات
 def add_user(user_id, role='user', referred_by=None):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT OR IGNORE INTO users (user_id, role, referred_by) VALUES (?, ?, ?)",
                        (user_id, role, referred_by))
-        conn.commit()
+        _user_cache.invalidate(_user_cache_key(user_id))
         logger.info(f"تم إضافة/تحديث المستخدم {user_id} بالدور {role}.")
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في إضافة المستخدم {user_id}: {e}")
-    finally:
-        conn.close()
 
-def get_user(user_id):
-    conn = connect_db()
+def _user_from_row(row):
+    return {
+        "user_id": row[0],
+        "balance": row[1],
+        "role": row[2],
+        "referred_by": row[3],
+        "referral_count": row[4]
+    }
+
+def upsert_user(user_id, role='user', referred_by=None):
+    """
+    يضيف المستخدم إذا لم يكن موجوداً ويرجع بياناته، كل ذلك باستعلام واحد.
+    مثل add_user: لا يغيّر دور أو بيانات مستخدم موجود مسبقاً. يرجع None عند الخطأ.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT user_id, balance, role, referred_by, referral_count FROM users WHERE user_id = ?", (user_id,))
-    user_data = cursor.fetchone()
-    conn.close()
-    if user_data:
-        return {
-            "user_id": user_data[0],
-            "balance": user_data[1],
-            "role": user_data[2],
-            "referred_by": user_data[3],
-            "referral_count": user_data[4]
-        }
-    return None
+    try:
+        cursor.execute(
+            """
+            INSERT INTO users (user_id, role, referred_by) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET role = users.role
+            RETURNING user_id, balance, role, referred_by, referral_count
+            """,
+            (user_id, role, referred_by)
+        )
+        user = _user_from_row(cursor.fetchone())
+        _user_cache.put(_user_cache_key(user_id), user)
+        return dict(user)
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إضافة/جلب المستخدم {user_id}: {e}")
+        return None
 
-def update_user_balance(user_id, amount):
-    conn = connect_db()
+def upsert_referred_user(user_id, referrer_id, role='user'):
+    """
+    مثل upsert_user لمستخدم دخل من رابط دعوة (/start ref_<referrer_id>). إذا كان المستخدم جديداً
+    والداعي موجوداً (وليس هو نفسه) يُسجل referred_by ويزيد referral_count للداعي بنفس المعاملة.
+    يرجع {"user", "referrer_count"}، و referrer_count = None إذا لم تُحتسب الدعوة. يرجع None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (referrer_id,))
+            if referrer_id == user_id or cursor.fetchone() is None:
+                referrer_id = None
+            cursor.execute(
+                """
+                INSERT INTO users (user_id, role, referred_by) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id, balance, role, referred_by, referral_count
+                """,
+                (user_id, role, referrer_id)
+            )
+            row = cursor.fetchone()
+            referrer_count = None
+            if row is None:
+                # مستخدم قديم: الدعوة لا تُحتسب
+                cursor.execute("SELECT user_id, balance, role, referred_by, referral_count FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+            elif referrer_id is not None:
+                cursor.execute(
+                    "UPDATE users SET referral_count = COALESCE(referral_count, 0) + 1 WHERE user_id = ? RETURNING referral_count",
+                    (referrer_id,)
+                )
+                referrer_count = cursor.fetchone()[0]
+        user = _user_from_row(row)
+        _user_cache.put(_user_cache_key(user_id), user)
+        if referrer_count is not None:
+            _user_cache.invalidate(_user_cache_key(referrer_id))
+            logger.info(f"المستخدم {user_id} انضم عبر دعوة {referrer_id} (دعوات الداعي: {referrer_count}).")
+        return {"user": dict(user), "referrer_count": referrer_count}
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في تسجيل المستخدم {user_id} عبر دعوة {referrer_id}: {e}")
+        return None
+
+def get_referral_leaderboard():
+    """أصحاب أكثر الدعوات من الجدول المحسوب مسبقاً (LEADERBOARD_SIZE صف على الأكثر، بدون ترتيب كل المستخدمين)."""
+    conn = get_connection()
     cursor = conn.cursor()
+    cursor.execute("SELECT user_id, referral_count FROM referral_leaderboard ORDER BY referral_count DESC, user_id")
+    return [{"user_id": row[0], "referral_count": row[1]} for row in cursor.fetchall()]
+
+def get_user(user_id):
+    """بيانات المستخدم من الكاش إن وجدت، وإلا من قاعدة البيانات. يرجع نسخة يمكن تعديلها بأمان."""
+    key = _user_cache_key(user_id)
+    user = _user_cache.get(key)
+    if user is None:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, balance, role, referred_by, referral_count FROM users WHERE user_id = ?", (user_id,))
+        user_data = cursor.fetchone()
+        if not user_data:
+            return None
+        user = _user_from_row(user_data)
+        _user_cache.put(key, user)
+    return dict(user)
+
+def _credit_user(cursor, user_id, amount, reason, ref_id=None):
+    """
+    حركة رصيد داخل معاملة مفتوحة: سطر في balance_ledger وتعديل users.balance معاً.
+    كل تغيير للرصيد يجب أن يمر من هنا. يرجع بيانات المستخدم بعد التعديل، أو None لو غير موجود.
+    """
+    cursor.execute(
+        "UPDATE users SET balance = balance + ? WHERE user_id = ? "
+        "RETURNING user_id, balance, role, referred_by, referral_count",
+        (amount, user_id)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute(
+        "INSERT INTO balance_ledger (user_id, amount, reason, ref_id) VALUES (?, ?, ?, ?)",
+        (user_id, amount, reason, ref_id)
+    )
+    return _user_from_row(row)
+
+def _credit_users_bulk(cursor, entries):
+    """
+    مثل _credit_user لعدة حركات دفعة واحدة: entries قائمة (user_id, amount, reason, ref_id).
+    سطر في السجل لكل حركة، وتعديل رصيد واحد لكل مستخدم. يرجع معرفات المستخدمين المتأثرين.
+    """
+    cursor.executemany(
+        "INSERT INTO balance_ledger (user_id, amount, reason, ref_id) VALUES (?, ?, ?, ?)", entries
+    )
+    totals = {}
+    for user_id, amount, _, _ in entries:
+        totals[user_id] = totals.get(user_id, 0) + amount
+    cursor.executemany(
+        "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+        [(amount, user_id) for user_id, amount in totals.items()]
+    )
+    return set(totals)
+
+def _insert_rows(cursor, insert_sql, rows, chunk_size=500):
+    """
+    ينفذ insert_sql (جملة INSERT تنتهي بـ VALUES) لكل الصفوف بجمل متعددة الصفوف، chunk_size صف في كل جملة،
+    بدل جملة لكل صف (executemany). في PostgreSQL تحدّث triggers الإضافة العدادات مرة لكل جملة لا لكل صف.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        row_placeholders = "(" + ", ".join("?" * len(chunk[0])) + ")"
+        cursor.execute(f"{insert_sql} {', '.join([row_placeholders] * len(chunk))}",
+                       [value for row in chunk for value in row])
+
+def update_user_balance(user_id, amount, reason='adjustment', ref_id=None):
     try:
-        cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
-        conn.commit()
-        logger.info(f"تم تحديث رصيد المستخدم {user_id} بـ {amount}.")
+        with transaction(immediate=True) as cursor:
+            user = _credit_user(cursor, user_id, amount, reason, ref_id)
+        if user:
+            _user_cache.put(_user_cache_key(user_id), user)
+        logger.info(f"تم تحديث رصيد المستخدم {user_id} بـ {amount} ({reason}).")
         return True
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في تحديث رصيد المستخدم {user_id}: {e}")
         return False
-    finally:
-        conn.close()
 
 def add_american_email(email, password):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO american_emails (email, password) VALUES (?, ?)", (email, password))
-        conn.commit()
         logger.info(f"تم إضافة الإيميل الأمريكي: {email}.")
         return True
-    except sqlite3.IntegrityError: # لو الإيميل موجود مسبقا (UNIQUE)
+    except INTEGRITY_ERRORS: # لو الإيميل موجود مسبقا (UNIQUE)
         logger.warning(f"الإيميل {email} موجود مسبقاً في قاعدة البيانات.")
         return False
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في إضافة الإيميل الأمريكي {email}: {e}")
         return False
-    finally:
-        conn.close()
+
+def add_american_emails_bulk(emails, chunk_size=500):
+    """
+    يضيف قائمة (email, password) دفعة واحدة بمعاملة واحدة بدل إيميل بإيميل.
+    يرجع قاموس فيه عدد المضاف وقائمة الإيميلات الموجودة مسبقاً، أو None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            # نعرف الموجود مسبقاً (للتقرير) ضمن نفس المعاملة، على دفعات حتى لا نتجاوز حد المتغيرات
+            existing = set()
+            for start in range(0, len(emails), chunk_size):
+                chunk = [email for email, _ in emails[start:start + chunk_size]]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f"SELECT email FROM american_emails WHERE email IN ({placeholders})", chunk)
+                existing.update(row[0] for row in cursor.fetchall())
+            new_emails = [(email, password) for email, password in emails if email not in existing]
+            _insert_rows(cursor, "INSERT OR IGNORE INTO american_emails (email, password) VALUES", new_emails, chunk_size)
+        logger.info(f"تم إضافة {len(new_emails)} إيميل أمريكي دفعة واحدة ({len(existing)} موجود مسبقاً).")
+        return {"added": len(new_emails), "duplicates": sorted(existing)}
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إضافة الإيميلات الأمريكية دفعة واحدة: {e}")
+        return None
 
 def get_available_american_emails(count):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     # نختار الإيميلات المتاحة فقط
     cursor.execute("SELECT id, email, password FROM american_emails WHERE status = 'available' LIMIT ?", (count,))
     emails = cursor.fetchall()
-    conn.close()
     # نرجعها كقائمة من القواميس لسهولة التعامل
     return [{"id": row[0], "email": row[1], "password": row[2]} for row in emails]
 
 def mark_emails_as_sold(email_ids, user_id):
-    conn = connect_db()
-    cursor = conn.cursor()
     try:
         now = datetime.datetime.now().isoformat() # الوقت الحالي بصيغة ISO
-        # نحدّث حالة الإيميلات المحددة ونسجل مين اللي اشتراها ومتى
-        for email_id in email_ids:
-            cursor.execute(
+        # نحدّث حالة الإيميلات المحددة ونسجل مين اللي اشتراها ومتى (بمعاملة واحدة)
+        with transaction() as cursor:
+            cursor.executemany(
                 "UPDATE american_emails SET status = 'sold', sold_to_user_id = ?, sold_at = ? WHERE id = ?",
-                (user_id, now, email_id)
+                [(user_id, now, email_id) for email_id in email_ids]
             )
-        conn.commit()
         logger.info(f"تم تحديث حالة الإيميلات {email_ids} كـ 'مباع' للمستخدم {user_id}.")
         return True
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في تحديث حالة الإيميلات كـ 'مباع': {e}")
         return False
-    finally:
-        conn.close()
+
+def claim_american_emails(user_id, count):
+    """
+    يحجز حتى count إيميل متاح للمستخدم ويرجعها، بمعاملة واحدة.
+    BEGIN IMMEDIATE ياخذ قفل الكتابة من البداية، فلا يمكن لطلبين متزامنين يستلموا نفس الإيميل.
+    يرجع None عند حدوث خطأ.
+    """
+    try:
+        now = datetime.datetime.now().isoformat()
+        with transaction(immediate=True) as cursor:
+            cursor.execute(
+                """
+                UPDATE american_emails SET status = 'sold', sold_to_user_id = ?, sold_at = ?
+                WHERE id IN (SELECT id FROM american_emails WHERE status = 'available' ORDER BY id LIMIT ?)
+                RETURNING id, email, password
+                """,
+                (user_id, now, count)
+            )
+            emails = cursor.fetchall()
+        emails.sort()
+        logger.info(f"تم حجز {len(emails)} إيميل أمريكي للمستخدم {user_id}.")
+        return [{"id": row[0], "email": row[1], "password": row[2]} for row in emails]
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في حجز الإيميلات الأمريكية للمستخدم {user_id}: {e}")
+        return None
 
 def delete_american_email(email):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("DELETE FROM american_emails WHERE email = ?", (email,))
-        conn.commit()
         if cursor.rowcount > 0: # إذا تم حذف سطر واحد على الأقل
             logger.info(f"تم حذف الإيميل الأمريكي: {email}.")
             return True
         else:
             logger.warning(f"لم يتم العثور على الإيميل {email} للحذف.")
             return False
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في حذف الإيميل الأمريكي {email}: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_american_emails_counts():
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT status, COUNT(*) FROM american_emails GROUP BY status")
-    counts = cursor.fetchall()
-    conn.close()
-
-    status_counts = {row[0]: row[1] for row in counts}
+    status_counts = get_stats()["american_emails"]
     return {
         'available': status_counts.get('available', 0),
         'sold': status_counts.get('sold', 0),
+        'expired': status_counts.get('expired', 0),
         'total': sum(status_counts.values())
     }
 
+def get_users_count():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM stats_counters WHERE name = 'users'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def get_stats():
+    """
+    كل الإحصائيات من جدول stats_counters (عدد صفوفه ثابت تقريباً، فالقراءة O(1) مهما كبرت الجداول):
+    {"users", "balance_total", "american_emails": {الحالة: العدد}, "submitted_emails": {...},
+     "withdrawal_requests": {...}, "withdrawal_amounts": {الحالة: المبلغ}}
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, value FROM stats_counters")
+    stats = {
+        "users": 0, "balance_total": 0,
+        "american_emails": {}, "submitted_emails": {}, "withdrawal_requests": {}, "withdrawal_amounts": {}
+    }
+    for name, value in cursor.fetchall():
+        if name == "users":
+            stats["users"] = value
+        elif name == "users.balance":
+            stats["balance_total"] = value
+        else:
+            table, _, status = name.partition(".")
+            if table == "withdrawal_requests" and status.endswith(".amount"):
+                stats["withdrawal_amounts"][status[:-len(".amount")]] = value
+            elif table in stats:
+                stats[table][status] = value
+    return stats
+
 def get_all_available_american_emails_for_admin():
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT email, password FROM american_emails WHERE status = 'available'")
     emails = cursor.fetchall()
-    conn.close()
     return [{"email": row[0], "password": row[1]} for row in emails]
 
-def add_submitted_email(seller_user_id, email, password, email_type):
+def get_available_american_emails_page(after_id=None, before_id=None, limit=20):
+    """
+    صفحة من الإيميلات المتاحة بالترقيم حسب المفتاح (keyset) على id بدل OFFSET،
+    فتكلفة أي صفحة ثابتة مهما كبر المخزون.
+    after_id: الصفحة التالية بعد هذا الـ id، before_id: الصفحة السابقة قبل هذا الـ id.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    if before_id is not None:
+        cursor.execute(
+            "SELECT id, email, password FROM american_emails WHERE status = 'available' AND id < ? ORDER BY id DESC LIMIT ?",
+            (before_id, limit + 1)
+        )
+        rows = cursor.fetchall()
+        has_more_before = len(rows) > limit
+        rows = rows[:limit][::-1]
+    else:
+        cursor.execute(
+            "SELECT id, email, password FROM american_emails WHERE status = 'available' AND id > ? ORDER BY id LIMIT ?",
+            (after_id or 0, limit + 1)
+        )
+        rows = cursor.fetchall()
+        has_more_after = len(rows) > limit
+        rows = rows[:limit]
+
+    emails = [{"id": row[0], "email": row[1], "password": row[2]} for row in rows]
+    if not emails:
+        return {"emails": [], "has_prev": False, "has_next": False}
+
+    # الاتجاه الثاني نعرفه بفحص وجود سطر واحد فقط (بحث بالفهرس)
+    if before_id is not None:
+        cursor.execute("SELECT 1 FROM american_emails WHERE status = 'available' AND id > ? LIMIT 1", (emails[-1]["id"],))
+        return {"emails": emails, "has_prev": has_more_before, "has_next": cursor.fetchone() is not None}
+    cursor.execute("SELECT 1 FROM american_emails WHERE status = 'available' AND id < ? LIMIT 1", (emails[0]["id"],))
+    return {"emails": emails, "has_prev": cursor.fetchone() is not None, "has_next": has_more_after}
+
+def export_available_american_emails(file_obj, batch_size=1000):
+    """
+    يكتب كل الإيميلات المتاحة (email:password سطر لكل إيميل) في file_obj على دفعات
+    بدون تحميلها كلها في الذاكرة، ويرجع عددها.
+    يستخدم اتصالاً منفصلاً للقراءة (WAL يسمح بذلك) حتى لا يحجز الاتصال المشترك طول مدة التصدير.
+    """
     conn = connect_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT email, password FROM american_emails WHERE status = 'available' ORDER BY id")
+        count = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            file_obj.write("".join(f"{email}:{password}\n" for email, password in rows).encode('utf-8'))
+            count += len(rows)
+        return count
+    finally:
+        conn.close()
+
+def add_submitted_email(seller_user_id, email, password, email_type):
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
             "INSERT INTO submitted_emails (seller_user_id, email, password, type, status) VALUES (?, ?, ?, ?, ?)",
             (seller_user_id, email, password, email_type, 'pending')
         )
-        conn.commit()
         logger.info(f"تم إضافة الإيميل المرسل للمراجعة: {email} من المستخدم {seller_user_id} نوع {email_type}.")
         return True
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في إضافة الإيميل المرسل للمراجعة {email}: {e}")
         return False
-    finally:
-        conn.close()
 
-def get_pending_submitted_emails():
-    conn = connect_db()
+def add_submitted_emails_bulk(seller_user_id, entries, email_type):
+    """
+    يضيف قائمة (email, password, match_status) للمراجعة بمعاملة واحدة بدل إيميل بإيميل.
+    يرجع عدد المضاف، أو None عند الخطأ.
+    """
+    try:
+        with transaction() as cursor:
+            _insert_rows(
+                cursor,
+                "INSERT INTO submitted_emails (seller_user_id, email, password, type, status, match_status) VALUES",
+                [(seller_user_id, email, password, email_type, 'pending', match_status)
+                 for email, password, match_status in entries]
+            )
+        logger.info(f"تم إضافة {len(entries)} إيميل للمراجعة من المستخدم {seller_user_id} نوع {email_type}.")
+        return len(entries)
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إضافة الإيميلات المرسلة للمراجعة من المستخدم {seller_user_id}: {e}")
+        return None
+
+def get_pending_submitted_emails(after_id=0, limit=100):
+    """
+    دفعة من الإيميلات المعلقة بعد after_id مرتبة حسب id (ترقيم بالمفتاح على الفهرس الجزئي للمعلق)،
+    فتكلفة كل دفعة ثابتة مهما كبر الطابور. للدفعة التالية: after_id = id آخر إيميل في هذه الدفعة.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, seller_user_id, email, password, type, created_at FROM submitted_emails WHERE status = 'pending'")
+    cursor.execute(
+        "SELECT id, seller_user_id, email, password, type, created_at FROM submitted_emails "
+        "WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+        (after_id, limit)
+    )
     emails = cursor.fetchall()
-    conn.close()
     return [{
         "id": row[0],
         "seller_user_id": row[1],
@@ -235,8 +1086,102 @@ def get_pending_submitted_emails():
         "created_at": row[5]
     } for row in emails]
 
+def get_pending_review_page(after_seller_id=0, sellers_limit=5, emails_per_seller=10):
+    """
+    صفحة من طابور المراجعة مجمّعة حسب البائع، باستعلام واحد مع بيانات البائع (بدل get_user لكل سطر).
+    لكل بائع: أول emails_per_seller إيميل معلق، والعدد الكلي، وأكبر id (لتحديد نطاق "قبول/رفض الكل")،
+    وعدد الإيميلات المطابقة للمخزون (لـ "قبول المطابقة").
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        WITH sellers AS (
+            SELECT DISTINCT seller_user_id FROM submitted_emails
+            WHERE status = 'pending' AND seller_user_id > ?
+            ORDER BY seller_user_id LIMIT ?
+        ), ranked AS (
+            SELECT s.id, s.seller_user_id, s.email, s.password, s.type, s.created_at, s.match_status,
+                   ROW_NUMBER() OVER (PARTITION BY s.seller_user_id ORDER BY s.id) AS position,
+                   COUNT(*) OVER (PARTITION BY s.seller_user_id) AS pending_count,
+                   MAX(s.id) OVER (PARTITION BY s.seller_user_id) AS max_id,
+                   SUM(CASE WHEN s.match_status = ? THEN 1 ELSE 0 END) OVER (PARTITION BY s.seller_user_id) AS matched_count
+            FROM submitted_emails s JOIN sellers USING (seller_user_id)
+            WHERE s.status = 'pending'
+        )
+        SELECT r.id, r.seller_user_id, r.email, r.password, r.type, r.created_at,
+               r.pending_count, r.max_id, u.balance, r.match_status, r.matched_count
+        FROM ranked r LEFT JOIN users u ON u.user_id = r.seller_user_id
+        WHERE r.position <= ?
+        ORDER BY r.seller_user_id, r.id
+        """,
+        (after_seller_id, sellers_limit + 1, MATCH_OK, emails_per_seller)
+    )
+    groups = []
+    for row in cursor.fetchall():
+        if not groups or groups[-1]["seller_user_id"] != row[1]:
+            groups.append({
+                "seller_user_id": row[1],
+                "balance": row[8],
+                "pending_count": row[6],
+                "max_id": row[7],
+                "matched_count": row[10] or 0,
+                "emails": []
+            })
+        groups[-1]["emails"].append({
+            "id": row[0],
+            "email": row[2],
+            "password": row[3],
+            "type": row[4],
+            "created_at": row[5],
+            "match_status": row[9]
+        })
+    return {"sellers": groups[:sellers_limit], "has_next": len(groups) > sellers_limit}
+
+def approve_seller_submissions(seller_user_id, max_id, amount_per_email, matched_only=False):
+    """
+    يقبل كل الإيميلات المعلقة للبائع (حتى max_id) ويضيف رصيدها، بمعاملة واحدة.
+    مع matched_only يقبل فقط الإيميلات المطابقة للمخزون ويترك الباقي للمراجعة اليدوية.
+    يرجع عدد الإيميلات المقبولة، أو None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            cursor.execute(
+                "UPDATE submitted_emails SET status = 'approved' WHERE seller_user_id = ? AND status = 'pending' AND id <= ?"
+                + (" AND match_status = ?" if matched_only else ""),
+                (seller_user_id, max_id, MATCH_OK) if matched_only else (seller_user_id, max_id)
+            )
+            approved = cursor.rowcount
+            if approved:
+                _credit_user(cursor, seller_user_id, approved * amount_per_email, 'submissions_approved', max_id)
+        _user_cache.invalidate(_user_cache_key(seller_user_id))
+        logger.info(f"تم قبول {approved} إيميل للبائع {seller_user_id} وإضافة {approved * amount_per_email} لرصيده.")
+        return approved
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في قبول إيميلات البائع {seller_user_id}: {e}")
+        return None
+
+def reject_seller_submissions(seller_user_id, max_id, rejection_reason):
+    """
+    يرفض كل الإيميلات المعلقة للبائع (حتى max_id) بنفس السبب، باستعلام واحد.
+    يرجع عدد الإيميلات المرفوضة، أو None عند الخطأ.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE submitted_emails SET status = 'rejected', rejection_reason = ? "
+            "WHERE seller_user_id = ? AND status = 'pending' AND id <= ?",
+            (rejection_reason, seller_user_id, max_id)
+        )
+        logger.info(f"تم رفض {cursor.rowcount} إيميل للبائع {seller_user_id}. السبب: {rejection_reason}")
+        return cursor.rowcount
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في رفض إيميلات البائع {seller_user_id}: {e}")
+        return None
+
 def update_submitted_email_status(email_id, status, rejection_reason=None):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         if rejection_reason:
@@ -245,21 +1190,41 @@ def update_submitted_email_status(email_id, status, rejection_reason=None):
         else:
             cursor.execute("UPDATE submitted_emails SET status = ? WHERE id = ?",
                            (status, email_id))
-        conn.commit()
         logger.info(f"تم تحديث حالة الإيميل المرسل {email_id} إلى {status}.")
         return True
-    except sqlite3.Error as e:
+    except DATABASE_ERRORS as e:
         logger.error(f"خطأ في تحديث حالة الإيميل المرسل {email_id}: {e}")
         return False
-    finally:
-        conn.close()
+
+def approve_submitted_email(email_id, amount):
+    """
+    يقبل إيميلاً معلقاً ويضيف رصيده للبائع بمعاملة واحدة (إما الاثنان أو لا شيء).
+    يرجع بيانات البائع بعد إضافة الرصيد، أو None لو الإيميل لم يعد معلقاً أو عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            cursor.execute(
+                "UPDATE submitted_emails SET status = 'approved' WHERE id = ? AND status = 'pending' RETURNING seller_user_id",
+                (email_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                logger.warning(f"الإيميل المرسل {email_id} ليس معلقاً، لم يتم قبوله.")
+                return None
+            seller = _credit_user(cursor, row[0], amount, 'submission_approved', email_id)
+        if seller:
+            _user_cache.put(_user_cache_key(seller["user_id"]), seller)
+        logger.info(f"تم قبول الإيميل المرسل {email_id} وإضافة {amount} للبائع {row[0]}.")
+        return dict(seller) if seller else None
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في قبول الإيميل المرسل {email_id}: {e}")
+        return None
 
 def get_submitted_email_by_id(email_id):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, seller_user_id, email, password, type, status, created_at FROM submitted_emails WHERE id = ?", (email_id,))
+    cursor.execute("SELECT id, seller_user_id, email, password, type, status, created_at, match_status FROM submitted_emails WHERE id = ?", (email_id,))
     email_data = cursor.fetchone()
-    conn.close()
     if email_data:
         return {
             "id": email_data[0],
@@ -268,22 +1233,352 @@ def get_submitted_email_by_id(email_id):
             "password": email_data[3],
             "type": email_data[4],
             "status": email_data[5],
-            "created_at": email_data[6]
+            "created_at": email_data[6],
+            "match_status": email_data[7]
         }
     return None
 
 # ## هنا دالة get_last_sold_emails_to_user اللي كانت مفقودة ##
 def get_last_sold_emails_to_user(user_id, count=5):
-    conn = connect_db()
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT email, password FROM american_emails WHERE sold_to_user_id = ? ORDER BY sold_at DESC LIMIT ?",
         (user_id, count)
     )
     emails = cursor.fetchall()
-    conn.close()
     return [{"email": row[0], "password": row[1]} for row in emails]
 
+def _resale_cutoff():
+    # sold_at محفوظ كنص ISO بنفس الصيغة دائماً، فمقارنة النصوص تطابق مقارنة الأوقات
+    return (datetime.datetime.now() - RESALE_WINDOW).isoformat()
+
+def expire_stale_claims(batch_size=1000):
+    """
+    ينهي دفعة من الإيميلات المباعة التي مرت عليها مهلة إعادة البيع (status = 'expired')،
+    الأقدم أولاً من الفهرس (status, sold_at). يرجع عدد الإيميلات المنتهية، أو None عند حدوث خطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            cursor.execute(
+                """
+                UPDATE american_emails SET status = 'expired'
+                WHERE id IN (
+                    SELECT id FROM american_emails WHERE status = 'sold' AND sold_at < ? ORDER BY sold_at LIMIT ?
+                )
+                """,
+                (_resale_cutoff(), batch_size)
+            )
+            return cursor.rowcount
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إنهاء مهلة الإيميلات المباعة: {e}")
+        return None
+
+# نتائج مطابقة الإيميلات الأمريكية المرسلة للمراجعة مع المخزون
+MATCH_OK = 'match'                        # باعه البوت لنفس المستخدم وضمن المهلة
+MATCH_LATE = 'late'                       # باعه البوت لنفس المستخدم لكن المهلة انتهت
+MATCH_NOT_SOLD_TO_USER = 'not_sold_to_user'  # موجود في المخزون لكنه لم يُبع لهذا المستخدم
+MATCH_UNKNOWN = 'unknown'                 # غير موجود في المخزون أصلاً
+
+def match_american_submissions(user_id, emails):
+    """
+    يطابق إيميلات يرسلها المستخدم للمراجعة مع american_emails (الإيميل، المشتري، ووقت البيع ضمن المهلة)
+    ويرجع {الإيميل: نتيجة المطابقة}. استعلام واحد لكل الدفعة على فهرس email UNIQUE
+    (LEFT JOIN يبدأ من القائمة المرسلة: بحث واحد لكل إيميل، بدل المرور على كل ما اشتراه المستخدم).
+    الإيميلات المنتهية مهلتها تُكتشف حتى لو لم تصل لها دورة الإنهاء بعد.
+    """
+    if not emails:
+        return {}
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT j.value,
+               CASE
+                   WHEN a.id IS NULL THEN ?
+                   WHEN a.sold_to_user_id IS NOT ? OR a.status NOT IN ('sold', 'expired') THEN ?
+                   WHEN a.status = 'expired' OR a.sold_at < ? THEN ?
+                   ELSE ?
+               END
+        FROM json_each(?) j
+        LEFT JOIN american_emails a ON a.email = j.value
+        """,
+        (MATCH_UNKNOWN, user_id, MATCH_NOT_SOLD_TO_USER, _resale_cutoff(), MATCH_LATE, MATCH_OK,
+         json.dumps(list(emails)))
+    )
+    return dict(cursor.fetchall())
+
+# دوال الرسائل الجماعية
+def get_user_ids_after(after_user_id, limit):
+    """دفعة من معرفات المستخدمين بعد after_user_id مرتبة (ترقيم بالمفتاح على PRIMARY KEY)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+def _broadcast_from_row(row):
+    return {
+        "id": row[0],
+        "text": row[1],
+        "status": row[2],
+        "last_user_id": row[3],
+        "delivered": row[4],
+        "blocked": row[5],
+        "failed": row[6]
+    }
+
+def create_broadcast(text):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "INSERT INTO broadcasts (text) VALUES (?) RETURNING id, text, status, last_user_id, delivered, blocked, failed",
+            (text,)
+        )
+        broadcast = _broadcast_from_row(cursor.fetchone())
+        logger.info(f"تم إنشاء الرسالة الجماعية {broadcast['id']}.")
+        return broadcast
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إنشاء الرسالة الجماعية: {e}")
+        return None
+
+def get_running_broadcasts():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, text, status, last_user_id, delivered, blocked, failed FROM broadcasts WHERE status = 'running'")
+    return [_broadcast_from_row(row) for row in cursor.fetchall()]
+
+def checkpoint_broadcast(broadcast_id, last_user_id, delivered, blocked, failed):
+    """يحفظ نقطة التقدم بعد كل دفعة: آخر مستخدم تمت معالجته وزيادة العدادات."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE broadcasts SET last_user_id = ?, delivered = delivered + ?, blocked = blocked + ?, failed = failed + ? WHERE id = ?",
+            (last_user_id, delivered, blocked, failed, broadcast_id)
+        )
+        return True
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في حفظ تقدم الرسالة الجماعية {broadcast_id}: {e}")
+        return False
+
+def finish_broadcast(broadcast_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? "
+            "RETURNING id, text, status, last_user_id, delivered, blocked, failed",
+            (datetime.datetime.now().isoformat(), broadcast_id)
+        )
+        return _broadcast_from_row(cursor.fetchone())
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إنهاء الرسالة الجماعية {broadcast_id}: {e}")
+        return None
+
+# دوال حفظ حالة المحادثات و user_data (القيم نصوص JSON يرمّزها persistence.py)
+def get_conversation_states(name):
+    """كل حالات محادثة معينة: {مفتاح JSON: حالة JSON}."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT key, state FROM conversation_states WHERE name = ?", (name,))
+    return dict(cursor.fetchall())
+
+def get_all_user_data():
+    """كل user_data المحفوظة: {user_id: نص JSON}."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, data FROM user_data")
+    return dict(cursor.fetchall())
+
+def save_persistence_batch(conversations, user_data):
+    """
+    يكتب دفعة التغييرات المتراكمة في معاملة واحدة.
+    conversations: قائمة (name, key, state) و user_data: قائمة (user_id, data)، والقيمة None تعني حذف السجل.
+    """
+    try:
+        with transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO conversation_states (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                [row for row in conversations if row[2] is not None]
+            )
+            cursor.executemany(
+                "DELETE FROM conversation_states WHERE name = ? AND key = ?",
+                [row[:2] for row in conversations if row[2] is None]
+            )
+            cursor.executemany(
+                "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                [row for row in user_data if row[1] is not None]
+            )
+            cursor.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [row[:1] for row in user_data if row[1] is None]
+            )
+        return True
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في حفظ حالة المحادثات: {e}")
+        return False
+
+# دوال طلبات السحب
+WITHDRAWAL_COLUMNS = "id, user_id, amount, method, phone_number, status, requested_at"
+
+def _withdrawal_from_row(row):
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "amount": row[2],
+        "method": row[3],
+        "phone_number": row[4],
+        "status": row[5],
+        "requested_at": row[6]
+    }
+
+def request_withdrawal(user_id, amount, method, phone_number):
+    """
+    ينشئ طلب سحب ويحجز المبلغ من رصيد المستخدم بنفس المعاملة (حركة 'withdrawal_hold' في السجل).
+    يرجع {"request": ..., "balance": الرصيد بعد الحجز}، أو False لو الرصيد لا يكفي، أو None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            # BEGIN IMMEDIATE يمنع أي كتابة أخرى حتى نهاية المعاملة، فالرصيد لا يتغير بين الفحص والحجز
+            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            if row is None or row[0] < amount:
+                return False
+            cursor.execute(
+                f"INSERT INTO withdrawal_requests (user_id, amount, method, phone_number) VALUES (?, ?, ?, ?) "
+                f"RETURNING {WITHDRAWAL_COLUMNS}",
+                (user_id, amount, method, phone_number)
+            )
+            request = _withdrawal_from_row(cursor.fetchone())
+            user = _credit_user(cursor, user_id, -amount, 'withdrawal_hold', request["id"])
+        _user_cache.put(_user_cache_key(user_id), user)
+        logger.info(f"طلب سحب جديد {request['id']} من المستخدم {user_id} بمبلغ {amount}.")
+        return {"request": request, "balance": user["balance"]}
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في إنشاء طلب سحب للمستخدم {user_id}: {e}")
+        return None
+
+def _after_withdrawal_sql(after_id):
+    """شرط "بعد الطلب after_id" بترتيب الطابور (requested_at, id)، أو لا شرط للصفحة الأولى."""
+    if not after_id:
+        return "", ()
+    # بدون OR حتى يبحث SQLite في الفهرس مباشرة من نقطة البداية بدل المرور على كل ما قبلها
+    return " AND (requested_at, id) > (SELECT requested_at, id FROM withdrawal_requests WHERE id = ?)", (after_id,)
+
+def get_pending_withdrawals_page(after_id=0, limit=20):
+    """
+    صفحة من طلبات السحب المعلقة، الأقدم أولاً (ترقيم بالمفتاح على (requested_at, id) بعد الطلب after_id).
+    يرجع {"requests": [...], "has_next": bool}.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    after_sql, after_params = _after_withdrawal_sql(after_id)
+    cursor.execute(
+        f"SELECT {WITHDRAWAL_COLUMNS} FROM withdrawal_requests WHERE status = 'pending'{after_sql} "
+        f"ORDER BY requested_at, id LIMIT ?",
+        after_params + (limit + 1,)
+    )
+    rows = cursor.fetchall()
+    return {"requests": [_withdrawal_from_row(row) for row in rows[:limit]], "has_next": len(rows) > limit}
+
+def get_pending_withdrawal_ids(after_id, last_id):
+    """معرفات الطلبات المعلقة في صفحة معروضة (بعد after_id وحتى last_id)، للقبول/الرفض الجماعي."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    after_sql, after_params = _after_withdrawal_sql(after_id)
+    cursor.execute(
+        f"SELECT id FROM withdrawal_requests WHERE status = 'pending'{after_sql} "
+        f"AND (requested_at, id) <= (SELECT requested_at, id FROM withdrawal_requests WHERE id = ?) "
+        f"ORDER BY requested_at, id",
+        after_params + (last_id,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def approve_withdrawals(request_ids):
+    """
+    يقبل (تم الدفع) كل الطلبات المعلقة من request_ids بتحديث واحد. المبلغ محجوز مسبقاً فلا يتغير الرصيد.
+    يرجع قائمة الطلبات التي قُبلت فعلاً (لإشعار أصحابها)، أو None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            # json_each: كل المعرفات كمعامل واحد، مهما كان عددها
+            cursor.execute(
+                f"""
+                UPDATE withdrawal_requests SET status = 'approved', processed_at = ?
+                WHERE status = 'pending' AND id IN (SELECT CAST(ids.value AS INTEGER) FROM json_each(?) ids)
+                RETURNING {WITHDRAWAL_COLUMNS}
+                """,
+                (datetime.datetime.now().isoformat(), json.dumps(list(request_ids)))
+            )
+            approved = [_withdrawal_from_row(row) for row in cursor.fetchall()]
+        logger.info(f"تم قبول {len(approved)} طلب سحب.")
+        return approved
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في قبول طلبات السحب: {e}")
+        return None
+
+def reject_withdrawals(request_ids, rejection_reason):
+    """
+    يرفض كل الطلبات المعلقة من request_ids ويعيد المبالغ المحجوزة لأرصدة أصحابها، بمعاملة واحدة.
+    يرجع قائمة الطلبات التي رُفضت فعلاً، أو None عند الخطأ.
+    """
+    try:
+        with transaction(immediate=True) as cursor:
+            cursor.execute(
+                f"""
+                UPDATE withdrawal_requests SET status = 'rejected', rejection_reason = ?, processed_at = ?
+                WHERE status = 'pending' AND id IN (SELECT CAST(ids.value AS INTEGER) FROM json_each(?) ids)
+                RETURNING {WITHDRAWAL_COLUMNS}
+                """,
+                (rejection_reason, datetime.datetime.now().isoformat(), json.dumps(list(request_ids)))
+            )
+            rejected = [_withdrawal_from_row(row) for row in cursor.fetchall()]
+            refunded_users = _credit_users_bulk(
+                cursor, [(r["user_id"], r["amount"], 'withdrawal_refund', r["id"]) for r in rejected]
+            )
+        for user_id in refunded_users:
+            _user_cache.invalidate(_user_cache_key(user_id))
+        logger.info(f"تم رفض {len(rejected)} طلب سحب وإعادة المبالغ. السبب: {rejection_reason}")
+        return rejected
+    except DATABASE_ERRORS as e:
+        logger.error(f"خطأ في رفض طلبات السحب: {e}")
+        return None
+
+# مطابقة الأرصدة مع سجل الحركات
+def reconcile_balances(after_user_id=0, batch_size=5000):
+    """
+    يطابق دفعة من المستخدمين (بعد after_user_id) بين users.balance ومجموع حركاتهم في balance_ledger.
+    يرجع {"checked", "last_user_id", "mismatches": [{"user_id", "balance", "ledger_total"}]}،
+    و last_user_id = None يعني انتهاء كل المستخدمين.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT MAX(user_id), COUNT(*) FROM (SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?) batch",
+        (after_user_id, batch_size)
+    )
+    last_user_id, checked = cursor.fetchone()
+    if last_user_id is None:
+        return {"checked": 0, "last_user_id": None, "mismatches": []}
+    # مجموع حركات الدفعة من الفهرس المغطي (user_id, amount)، ثم مقارنته بالرصيد المحفوظ
+    cursor.execute(
+        """
+        SELECT u.user_id, u.balance, COALESCE(l.total, 0)
+        FROM users u
+        LEFT JOIN (
+            SELECT user_id, SUM(amount) AS total FROM balance_ledger
+            WHERE user_id > ? AND user_id <= ? GROUP BY user_id
+        ) l ON l.user_id = u.user_id
+        WHERE u.user_id > ? AND u.user_id <= ? AND u.balance IS NOT COALESCE(l.total, 0)
+        """,
+        (after_user_id, last_user_id, after_user_id, last_user_id)
+    )
+    mismatches = [{"user_id": row[0], "balance": row[1], "ledger_total": row[2]} for row in cursor.fetchall()]
+    return {"checked": checked, "last_user_id": last_user_id, "mismatches": mismatches}
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
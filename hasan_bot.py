@@ -8,16 +8,36 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler
 )
+from telegram.warnings import PTBUserWarning
+import csv
+import io
 import logging
-from config import BOT_TOKEN, DEVELOPER_CHAT_ID, CHANNEL_LINK
-from database import (
-    initialize_db, add_user, get_user, update_user_balance,
-    add_american_email, get_available_american_emails, mark_emails_as_sold,
-    delete_american_email, get_american_emails_counts, get_all_available_american_emails_for_admin,
-    add_submitted_email, get_pending_submitted_emails, update_submitted_email_status, get_submitted_email_by_id,
-    get_last_sold_emails_to_user,
-    connect_db
+import tempfile
+import time
+import warnings
+from config import (
+    BOT_TOKEN, DEVELOPER_CHAT_ID, CHANNEL_LINK,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN,
+    DATABASE_URL, WORKER_COUNT, BACKGROUND_JOBS, METRICS_PORT
 )
+import async_db
+import database
+import metrics
+from outbox import GLOBAL_RATE, OutboundRateLimiter, start_notifier, stop_notifier, notify
+from async_db import (
+    initialize_db, add_user, upsert_user, upsert_referred_user, get_referral_leaderboard, get_user, get_users_count, get_stats,
+    add_american_emails_bulk, claim_american_emails,
+    delete_american_email, get_american_emails_counts, get_available_american_emails_page,
+    export_available_american_emails,
+    add_submitted_emails_bulk, get_pending_review_page, approve_seller_submissions, reject_seller_submissions,
+    update_submitted_email_status, approve_submitted_email, get_submitted_email_by_id, reconcile_balances,
+    match_american_submissions, expire_stale_claims, create_broadcast, get_running_broadcasts,
+    request_withdrawal, get_pending_withdrawals_page, get_pending_withdrawal_ids, approve_withdrawals, reject_withdrawals
+)
+from database import MATCH_OK, MATCH_LATE, MATCH_NOT_SOLD_TO_USER, MATCH_UNKNOWN
+from broadcast import run_broadcast
+from update_processor import PerChatUpdateProcessor
+from persistence import SQLitePersistence
 
 # إعدادات التسجيل (Logging)
 logging.basicConfig(
@@ -26,6 +46,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# محادثات المراجعة تخلط أزرار inline ورسائل نصية وتُتتبع لكل (محادثة، مستخدم) عمداً (per_message=False)،
+# و PTB يحذر من ذلك حتى مع تمرير per_message=False صراحة
+warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
+
 # حالات ConversationHandler لإضافة الإيميلات الأمريكية (للمشرف)
 ADD_AMERICAN_EMAILS_STATE = 1
     
@@ -46,6 +70,31 @@ SUBMIT_EMAILS_TYPE_CHOICE = 7
 REVIEW_EMAIL_CHOICE = 8
 REJECT_EMAIL_REASON = 9
 ACCEPT_EMAIL_BALANCE_ADJUST = 10
+ACCEPT_ALL_BALANCE = 12 # قبول كل إيميلات بائع معين دفعة واحدة
+REJECT_ALL_REASON = 13 # رفض كل إيميلات بائع معين دفعة واحدة
+
+# حالات ConversationHandler للرسالة الجماعية (للمشرف)
+BROADCAST_TEXT = 14
+BROADCAST_CONFIRM = 15
+
+# حالات ConversationHandler لسحب الأرباح (للمستخدم العادي)
+WITHDRAW_AMOUNT = 16
+WITHDRAW_METHOD = 17
+WITHDRAW_PHONE = 18
+
+# حالات ConversationHandler لمراجعة طلبات السحب (للمشرف)
+WITHDRAWAL_REJECT_REASON = 19
+
+# علامات نتيجة مطابقة الإيميلات الأمريكية المرسلة مع المخزون (تظهر للمشرف)
+MATCH_FLAGS = {
+    MATCH_OK: "✅ مطابق",
+    MATCH_LATE: "⌛ انتهت المهلة",
+    MATCH_NOT_SOLD_TO_USER: "⚠️ لم يُبع لهذا المستخدم",
+    MATCH_UNKNOWN: "❓ غير موجود في المخزون",
+}
+
+# أنواع التحديثات التي يعالجها البوت فقط، فلا يرسل تيليجرام غيرها (تعديل الرسائل، القنوات، ...)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 
 # دوال لوحات المفاتيح (Keyboards)
@@ -54,7 +103,7 @@ def get_user_keyboard():
     keyboard = [
         [KeyboardButton("بيع إيميلات"), KeyboardButton("إرسال الإيميلات")],
         [KeyboardButton("الرصيد"), KeyboardButton("سحب الأرباح")],
-        [KeyboardButton("إحصائيات البوت")]
+        [KeyboardButton("إحصائيات البوت"), KeyboardButton("دعوة الأصدقاء")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
@@ -78,18 +127,31 @@ def get_post_receive_american_emails_keyboard():
 
 
 # دالة الرد على أمر /start
+# روابط الدعوة: https://t.me/<البوت>?start=ref_<user_id>
+REFERRAL_PREFIX = "ref_"
+
+def parse_referral_payload(args):
+    """يرجع معرف الداعي من وسيط /start (ref_<user_id>)، أو None إذا لم يكن رابط دعوة صالحاً."""
+    if not args or not args[0].startswith(REFERRAL_PREFIX):
+        return None
+    referrer_id = args[0][len(REFERRAL_PREFIX):]
+    return int(referrer_id) if referrer_id.isdigit() else None
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name if update.effective_user else "يا صديقي"
 
-    initialize_db()
-
-    if user_id == DEVELOPER_CHAT_ID:
-        add_user(user_id, role='admin')
-        user_data = get_user(user_id)
+    # تسجيل المستخدم وجلب بياناته بخطوة واحدة (المخطط يتهيأ مرة واحدة في post_init)
+    role = 'admin' if user_id == DEVELOPER_CHAT_ID else 'user'
+    referrer_id = parse_referral_payload(context.args)
+    if referrer_id is not None:
+        # دخل من رابط دعوة: التسجيل واحتساب الدعوة للداعي بمعاملة واحدة
+        result = await upsert_referred_user(user_id, referrer_id, role=role)
+        user_data = result["user"] if result else None
+        if result and result["referrer_count"] is not None:
+            notify(referrer_id, f"🎉 انضم مستخدم جديد عبر رابط دعوتك! عدد دعواتك الآن: {result['referrer_count']}")
     else:
-        add_user(user_id, role='user')
-        user_data = get_user(user_id)
+        user_data = await upsert_user(user_id, role=role)
 
     if user_data:
         role = user_data["role"]
@@ -126,41 +188,92 @@ async def add_american_emails_start(update: Update, context: ContextTypes.DEFAUL
     await update.message.reply_text(
         "أدخل الإيميلات الأمريكية مع كلمات السر، كل إيميل على سطر جديد. "
         "مثال:\nemail1@example.com:password123\nemail2@example.com:password456\n\n"
+        "يمكنك أيضاً إرسال ملف .txt أو .csv (email,password) للكميات الكبيرة.\n"
         "أرسل /cancel للإلغاء."
     )
     return ADD_AMERICAN_EMAILS_STATE
 
-async def receive_american_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_input = update.message.text
-    emails_added_count = 0
-    
-    lines = user_input.split('\n')
+def parse_email_lines(lines):
+    """
+    يحلل أسطر email:password (أو email,password من ملفات CSV) بمرور واحد.
+    يرجع (قائمة الأزواج الصحيحة بدون تكرار، قائمة الأسطر المرفوضة مع السبب).
+    """
+    valid = []
+    rejected = []
+    seen = set()
     for line in lines:
         line = line.strip()
         if not line:
             continue
-        
-        if ':' in line:
-            parts = line.split(':', 1)
-            email = parts[0].strip()
-            password = parts[1].strip()
-            if email and password:
-                if add_american_email(email, password):
-                    emails_added_count += 1
-                else:
-                    await update.message.reply_text(f"لم يتم إضافة الإيميل {email} (قد يكون موجوداً مسبقاً أو هناك خطأ).")
-            else:
-                await update.message.reply_text(f"تنسيق خاطئ في السطر: {line}. يجب أن يكون: email:password")
+
+        separator = ':' if ':' in line else ','
+        email, _, password = line.partition(separator)
+        email = email.strip()
+        password = password.strip()
+        if not (separator in line and email and password):
+            rejected.append((line, "تنسيق خاطئ"))
+        elif email in seen:
+            rejected.append((line, "مكرر في نفس القائمة"))
         else:
-            await update.message.reply_text(f"تنسيق خاطئ في السطر: {line}. يجب أن يكون: email:password")
+            seen.add(email)
+            valid.append((email, password))
+    return valid, rejected
 
-    if emails_added_count > 0:
-        await update.message.reply_text(f"تم إضافة {emails_added_count} إيميل أمريكي بنجاح.", reply_markup=get_admin_keyboard())
-    else:
-        await update.message.reply_text("لم يتم إضافة أي إيميل. يرجى التأكد من التنسيق الصحيح (email:password كل سطر).", reply_markup=get_admin_keyboard())
+async def import_american_emails(update: Update, lines) -> int:
+    """
+    يضيف الإيميلات دفعة واحدة ويرسل تقريراً واحداً (مع ملف بالأسطر المرفوضة إن وجدت)
+    بدل رسالة لكل سطر.
+    """
+    valid, rejected = parse_email_lines(lines)
+    malformed_count = len(rejected)
+
+    result = await add_american_emails_bulk(valid) if valid else {"added": 0, "duplicates": []}
+    if result is None:
+        await update.message.reply_text("حدث خطأ أثناء إضافة الإيميلات. لم يتم إضافة أي إيميل، يرجى المحاولة مرة أخرى.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
 
+    rejected.extend((email, "موجود مسبقاً في قاعدة البيانات") for email in result["duplicates"])
+    await update.message.reply_text(
+        f"📥 نتيجة إضافة الإيميلات الأمريكية:\n"
+        f"   - تمت الإضافة: {result['added']}\n"
+        f"   - موجود مسبقاً: {len(result['duplicates'])}\n"
+        f"   - أسطر مرفوضة (تنسيق خاطئ أو مكرر): {malformed_count}",
+        reply_markup=get_admin_keyboard()
+    )
+    if rejected:
+        report = "\n".join(f"{line}\t{reason}" for line, reason in rejected)
+        await update.message.reply_document(
+            document=io.BytesIO(report.encode('utf-8')),
+            filename="rejected_emails.txt",
+            caption=f"الأسطر التي لم تتم إضافتها ({len(rejected)})."
+        )
+    logger.info(f"المشرف {update.effective_user.id} أضاف {result['added']} إيميل أمريكي، ورُفض {len(rejected)} سطر.")
     return ConversationHandler.END
 
+async def receive_american_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل الإيميلات الملصوقة كنص من المشرف ويخزنها في قاعدة البيانات.
+    """
+    return await import_american_emails(update, update.message.text.split('\n'))
+
+async def receive_american_emails_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل ملف .txt أو .csv من المشرف فيه الإيميلات ويخزنها في قاعدة البيانات.
+    """
+    document = update.message.document
+    telegram_file = await document.get_file()
+    content = (await telegram_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+
+    if document.file_name and document.file_name.lower().endswith('.csv'):
+        rows = list(csv.reader(io.StringIO(content)))
+        # نتجاهل سطر العناوين إن وجد
+        if rows and rows[0] and rows[0][0].strip().lower() == 'email':
+            rows = rows[1:]
+        lines = [f"{row[0]}:{row[1]}" if len(row) >= 2 else ",".join(row) for row in rows]
+    else:
+        lines = content.splitlines()
+    return await import_american_emails(update, lines)
+
 async def cancel_add_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     يلغي عملية إضافة الإيميلات.
@@ -175,7 +288,7 @@ async def sell_emails_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     يبدأ عملية بيع الإيميلات ويعرض خيارات (أمريكية/عشوائية).
     """
     user_id = update.effective_user.id
-    user_data = get_user(user_id)
+    user_data = await get_user(user_id)
     if not user_data or user_data['role'] != 'user':
         await update.message.reply_text("عذراً، هذا القسم مخصص للمستخدمين العاديين.")
         return ConversationHandler.END
@@ -212,33 +325,33 @@ async def receive_american_emails_count(update: Update, context: ContextTypes.DE
             await update.message.reply_text("العدد يجب أن يكون بين 1 و 5. يرجى المحاولة مرة أخرى أو أرسل /cancel.")
             return SELL_AMERICAN_COUNT
             
-        available_emails = get_available_american_emails(count)
-        
-        if not available_emails:
+        # الحجز والتسليم بخطوة واحدة، حتى ما ينعطى نفس الإيميل لمستخدمين اثنين
+        claimed_emails = await claim_american_emails(user_id, count)
+
+        if claimed_emails is None:
+            await update.message.reply_text("حدث خطأ في معالجة طلبك. يرجى المحاولة مرة أخرى.", reply_markup=get_user_keyboard())
+            logger.error(f"فشل في حجز الإيميلات الأمريكية للمستخدم {user_id}.")
+            return ConversationHandler.END
+
+        if not claimed_emails:
             await update.message.reply_text("عذراً، لا توجد إيميلات أمريكية متاحة حالياً بهذا العدد. يرجى المحاولة لاحقاً.", reply_markup=get_user_keyboard())
             return ConversationHandler.END
 
-        if len(available_emails) < count:
-            await update.message.reply_text(f"عذراً، لم نتمكن من توفير {count} إيميل. تم توفير {len(available_emails)} إيميل فقط.", reply_markup=get_user_keyboard())
-            count = len(available_emails)
+        if len(claimed_emails) < count:
+            await update.message.reply_text(f"عذراً، لم نتمكن من توفير {count} إيميل. تم توفير {len(claimed_emails)} إيميل فقط.", reply_markup=get_user_keyboard())
+            count = len(claimed_emails)
             
         emails_to_send = []
-        email_ids_to_mark_sold = []
-        for email_data in available_emails:
+        for email_data in claimed_emails:
             emails_to_send.append(f"• الإيميل: `{email_data['email']}`\nكلمة السر: `{email_data['password']}`")
-            email_ids_to_mark_sold.append(email_data['id'])
         
-        if mark_emails_as_sold(email_ids_to_mark_sold, user_id):
-            response_text = "تم توفير الإيميلات الأمريكية المطلوبة:\n\n" + "\n\n".join(emails_to_send)
-            response_text += "\n\n"
-            response_text += "🔴 ملاحظة هامة: لديك 24 ساعة لبيع هذه الإيميلات وقبولها من المشرف. بعد 24 ساعة لن يتم قبول الإيميلات."
-            
-            # ## تعديل ## إرسال لوحة مفاتيح خاصة بعد استلام الإيميلات
-            await update.message.reply_text(response_text, parse_mode='Markdown', reply_markup=get_post_receive_american_emails_keyboard())
-            logger.info(f"المستخدم {user_id} استلم {count} إيميل أمريكي.")
-        else:
-            await update.message.reply_text("حدث خطأ في معالجة طلبك. يرجى المحاولة مرة أخرى.", reply_markup=get_user_keyboard())
-            logger.error(f"فشل في تحديث حالة الإيميلات كـ 'مباع' للمستخدم {user_id}.")
+        response_text = "تم توفير الإيميلات الأمريكية المطلوبة:\n\n" + "\n\n".join(emails_to_send)
+        response_text += "\n\n"
+        response_text += "🔴 ملاحظة هامة: لديك 24 ساعة لبيع هذه الإيميلات وقبولها من المشرف. بعد 24 ساعة لن يتم قبول الإيميلات."
+        
+        # ## تعديل ## إرسال لوحة مفاتيح خاصة بعد استلام الإيميلات
+        await update.message.reply_text(response_text, parse_mode='Markdown', reply_markup=get_post_receive_american_emails_keyboard())
+        logger.info(f"المستخدم {user_id} استلم {count} إيميل أمريكي.")
 
     except ValueError:
         await update.message.reply_text("الرجاء إدخال رقم صحيح للعدد. يرجى المحاولة مرة أخرى أو أرسل /cancel.")
@@ -266,7 +379,7 @@ async def submit_emails_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     يبدأ عملية إرسال الإيميلات للمراجعة ويطلب من المستخدم إدخالها.
     """
     user_id = update.effective_user.id
-    user_data = get_user(user_id)
+    user_data = await get_user(user_id)
     if not user_data or user_data['role'] != 'user':
         await update.message.reply_text("عذراً، هذا القسم مخصص للمستخدمين العاديين.")
         return ConversationHandler.END
@@ -318,6 +431,7 @@ async def receive_submitted_emails(update: Update, context: ContextTypes.DEFAULT
     submitted_count = 0
     all_submitted_emails_text = []
 
+    entries = []
     lines = user_input.split('\n')
     for line in lines:
         line = line.strip()
@@ -330,16 +444,34 @@ async def receive_submitted_emails(update: Update, context: ContextTypes.DEFAULT
             password = parts[1].strip()
             
             if email and password:
-                if add_submitted_email(user_id, email, password, submission_type):
-                    submitted_count += 1
-                    all_submitted_emails_text.append(f"• الإيميل: `{email}`\nكلمة السر: `{password}`")
-                else:
-                    await update.message.reply_text(f"لم يتم إضافة الإيميل {email} للمراجعة (قد يكون هناك خطأ).")
+                entries.append((email, password))
             else:
                 await update.message.reply_text(f"تنسيق خاطئ في السطر: {line}. يجب أن يكون: email:password")
         else:
             await update.message.reply_text(f"تنسيق خاطئ في السطر: {line}. يجب أن يكون: email:password")
 
+    # مطابقة الإيميلات الأمريكية مع المخزون (استعلام واحد لكل الرسالة)،
+    # والتي مرت عليها مهلة الـ 24 ساعة لا تُقبل
+    matches = {}
+    if submission_type == "إيميل أمريكي (من البوت)" and entries:
+        matches = await match_american_submissions(user_id, [email for email, _ in entries])
+        late_emails = sorted({email for email, result in matches.items() if result == MATCH_LATE})
+        if late_emails:
+            entries = [(email, password) for email, password in entries if matches[email] != MATCH_LATE]
+            await update.message.reply_text(
+                "لم يتم قبول هذه الإيميلات لأن مهلة الـ 24 ساعة انتهت:\n" + "\n".join(f"• {email}" for email in late_emails)
+            )
+            logger.info(f"رفض {len(late_emails)} إيميل أمريكي متأخر من المستخدم {user_id}.")
+
+    if entries:
+        if await add_submitted_emails_bulk(user_id, [(email, password, matches.get(email)) for email, password in entries], submission_type):
+            submitted_count = len(entries)
+            for email, password in entries:
+                flag = f" — {MATCH_FLAGS[matches[email]]}" if email in matches else ""
+                all_submitted_emails_text.append(f"• الإيميل: `{email}`\nكلمة السر: `{password}`{flag}")
+        else:
+            await update.message.reply_text("لم يتم إضافة الإيميلات للمراجعة (حدث خطأ). يرجى المحاولة مرة أخرى.")
+
     if submitted_count > 0:
         await update.message.reply_text(
             f"تم إرسال {submitted_count} إيميل للمراجعة بنجاح. سيتم إشعارك بالقبول أو الرفض خلال 24 ساعة.",
@@ -347,30 +479,23 @@ async def receive_submitted_emails(update: Update, context: ContextTypes.DEFAULT
         )
         logger.info(f"المستخدم {user_id} أرسل {submitted_count} إيميل للمراجعة.")
 
-        # جلب آخر 5 إيميلات باعها البوت للمستخدم
-        last_sold_emails = get_last_sold_emails_to_user(user_id, count=5)
-        last_sold_emails_text = ""
-        if last_sold_emails:
-            last_sold_emails_text = "\n\n**آخر 5 إيميلات تم توفيرها من البوت لهذا المستخدم (للتحقق):**\n"
-            for i, email_data in enumerate(last_sold_emails):
-                last_sold_emails_text += f"• `{email_data['email']}` : `{email_data['password']}`\n"
-        else:
-            last_sold_emails_text = "\n\n*(لم يتم توفير أي إيميلات أمريكية من البوت لهذا المستخدم بعد.)*"
-
+        # ملخص المطابقة مع المخزون بدل مقارنة المشرف اليدوية مع آخر الإيميلات المباعة
+        match_summary_text = ""
+        if matches:
+            matched_count = sum(1 for email, _ in entries if matches[email] == MATCH_OK)
+            match_summary_text = f"\n\n**المطابقة مع المخزون:** {matched_count} من {submitted_count} مطابق"
 
         # إرسال إشعار للمشرف
         admin_notification_text = (
             f"🔔 طلب مراجعة إيميلات جديد من المستخدم: {user_name} (ID: {user_id})\n"
             f"النوع: **{submission_type}**\n"
-            f"الإيميلات المرسلة للمراجعة:\n" + "\n\n".join(all_submitted_emails_text) + "\n" + last_sold_emails_text + "\n\n"
-            f"يرجى مراجعتها في قسم 'مراجعة إيميلات البيع'."
+            "الإيميلات المرسلة للمراجعة:\n" + "\n\n".join(all_submitted_emails_text) + match_summary_text + "\n\n"
+            "يرجى مراجعتها في قسم 'مراجعة إيميلات البيع'."
         )
-        try:
-            await context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=admin_notification_text, parse_mode='Markdown')
-            logger.info(f"تم إرسال إشعار مراجعة الإيميلات للمشرف.")
-        except Exception as e:
-            logger.error(f"فشل إرسال إشعار مراجعة الإيميلات للمشرف: {e}")
-            
+        # عبر طابور الإشعارات: لا ننتظر تيليجرام، وعدة طلبات متتالية تُدمج في رسالة واحدة للمشرف
+        notify(DEVELOPER_CHAT_ID, admin_notification_text, parse_mode='Markdown')
+        logger.info("تم وضع إشعار مراجعة الإيميلات للمشرف في طابور الإرسال.")
+
     else:
         await update.message.reply_text("لم يتم إرسال أي إيميل للمراجعة. يرجى التأكد من التنسيق الصحيح.", reply_markup=get_user_keyboard())
 
@@ -393,11 +518,12 @@ async def manage_american_emails_start(update: Update, context: ContextTypes.DEF
         await update.message.reply_text("عذراً، هذا الأمر مخصص للمشرفين فقط.")
         return ConversationHandler.END
 
-    counts = get_american_emails_counts()
+    counts = await get_american_emails_counts()
     response_text = (
         f"🔴 إحصائيات الإيميلات الأمريكية:\n"
         f"   - المتاح: {counts['available']} إيميل\n"
         f"   - المباع: {counts['sold']} إيميل\n"
+        f"   - انتهت مهلتها: {counts['expired']} إيميل\n"
         f"   - الإجمالي: {counts['total']} إيميل\n\n"
         "اختر العملية:"
     )
@@ -405,7 +531,7 @@ async def manage_american_emails_start(update: Update, context: ContextTypes.DEF
     keyboard = [
         [KeyboardButton("عرض الإيميلات المتاحة")],
         [KeyboardButton("حذف إيميل أمريكي")],
-        [KeyboardButton("رجوع للقائمة الرئيسية \\(إدارة الإيميلات\\)")]
+        [KeyboardButton("رجوع للقائمة الرئيسية (إدارة الإيميلات)")]
     ]
     await update.message.reply_text(
         response_text,
@@ -413,20 +539,71 @@ async def manage_american_emails_start(update: Update, context: ContextTypes.DEF
     )
     return MANAGE_AMERICAN_EMAILS_CHOICE
 
+AMERICAN_EMAILS_PAGE_SIZE = 20
+
+def build_american_emails_page(page):
+    """يبني نص صفحة الإيميلات المتاحة وأزرار التنقل الخاصة بها."""
+    response_text = "الإيميلات الأمريكية المتاحة:\n\n"
+    for email_data in page['emails']:
+        response_text += f"#{email_data['id']}. الإيميل: `{email_data['email']}`\n   كلمة السر: `{email_data['password']}`\n"
+
+    navigation = []
+    if page['has_prev']:
+        navigation.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"amer_page_prev_{page['emails'][0]['id']}"))
+    if page['has_next']:
+        navigation.append(InlineKeyboardButton("التالي ➡️", callback_data=f"amer_page_next_{page['emails'][-1]['id']}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("📄 تصدير الكل كملف", callback_data="amer_export")])
+    return response_text, InlineKeyboardMarkup(keyboard)
+
 async def display_available_american_emails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    يعرض جميع الإيميلات الأمريكية المتاحة للمشرف.
+    يعرض الصفحة الأولى من الإيميلات الأمريكية المتاحة للمشرف مع أزرار التنقل.
     """
-    emails = get_all_available_american_emails_for_admin()
-    if emails:
-        response_text = "الإيميلات الأمريكية المتاحة:\n\n"
-        for i, email_data in enumerate(emails):
-            response_text += f"{i+1}. الإيميل: `{email_data['email']}`\n   كلمة السر: `{email_data['password']}`\n"
-        await update.message.reply_text(response_text, parse_mode='Markdown', reply_markup=get_admin_keyboard())
+    page = await get_available_american_emails_page(limit=AMERICAN_EMAILS_PAGE_SIZE)
+    if page['emails']:
+        await update.message.reply_text("جاري عرض الإيميلات المتاحة:", reply_markup=get_admin_keyboard())
+        response_text, reply_markup = build_american_emails_page(page)
+        await update.message.reply_text(response_text, parse_mode='Markdown', reply_markup=reply_markup)
     else:
         await update.message.reply_text("لا توجد إيميلات أمريكية متاحة حالياً.", reply_markup=get_admin_keyboard())
     return ConversationHandler.END
 
+async def handle_american_emails_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    يعالج أزرار التنقل بين صفحات الإيميلات المتاحة وزر التصدير كملف.
+    """
+    query = update.callback_query
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await query.answer("هذا الأمر مخصص للمشرفين فقط.")
+        return
+    await query.answer()
+
+    if query.data == "amer_export":
+        # الملف يُكتب على دفعات في ملف مؤقت (على القرص إذا كبر) بدل بناء نص كامل في الذاكرة
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as export_file:
+            count = await export_available_american_emails(export_file)
+            export_file.seek(0)
+            await query.message.reply_document(
+                document=export_file,
+                filename="available_american_emails.txt",
+                caption=f"كل الإيميلات الأمريكية المتاحة ({count})."
+            )
+        logger.info(f"المشرف {update.effective_user.id} صدّر {count} إيميل أمريكي متاح.")
+        return
+
+    _, _, direction, email_id = query.data.split('_')
+    if direction == "next":
+        page = await get_available_american_emails_page(after_id=int(email_id), limit=AMERICAN_EMAILS_PAGE_SIZE)
+    else:
+        page = await get_available_american_emails_page(before_id=int(email_id), limit=AMERICAN_EMAILS_PAGE_SIZE)
+
+    if not page['emails']:
+        await query.edit_message_text("لا توجد إيميلات أمريكية متاحة في هذه الصفحة.")
+        return
+    response_text, reply_markup = build_american_emails_page(page)
+    await query.edit_message_text(response_text, parse_mode='Markdown', reply_markup=reply_markup)
+
 async def delete_american_email_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     يطلب من المشرف إدخال الإيميل المراد حذفه.
@@ -443,7 +620,7 @@ async def process_delete_american_email(update: Update, context: ContextTypes.DE
     يستقبل الإيميل من المشرف ويحذفه من قاعدة البيانات.
     """
     email_to_delete = update.message.text.strip()
-    if delete_american_email(email_to_delete):
+    if await delete_american_email(email_to_delete):
         await update.message.reply_text(f"تم حذف الإيميل {email_to_delete} بنجاح.", reply_markup=get_admin_keyboard())
     else:
         await update.message.reply_text(f"لم يتم العثور على الإيميل {email_to_delete} أو حدث خطأ أثناء الحذف.", reply_markup=get_admin_keyboard())
@@ -458,62 +635,136 @@ async def cancel_manage_emails(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 # دوال مراجعة إيميلات البيع (للمشرف)
+REVIEW_SELLERS_PER_PAGE = 5
+REVIEW_EMAILS_PER_SELLER = 10
+
+async def send_review_page(message, after_seller_id=0) -> None:
+    """
+    يرسل صفحة من طابور المراجعة: رسالة واحدة لكل بائع فيها إيميلاته المعلقة
+    مع أزرار قبول/رفض لكل إيميل وأزرار "قبول الكل/رفض الكل" لهذا البائع.
+    """
+    page = await get_pending_review_page(after_seller_id, REVIEW_SELLERS_PER_PAGE, REVIEW_EMAILS_PER_SELLER)
+
+    if not page['sellers']:
+        await message.reply_text("لا توجد إيميلات معلقة للمراجعة حالياً.", reply_markup=get_admin_keyboard())
+        return
+
+    for seller in page['sellers']:
+        seller_user_id = seller['seller_user_id']
+        balance = seller['balance'] if seller['balance'] is not None else 'غير مسجل'
+        message_text = (
+            f"🔔 طلبات مراجعة من المستخدم: {seller_user_id} (الرصيد: {balance})\n"
+            f"   - عدد الإيميلات المعلقة: {seller['pending_count']}\n\n"
+        )
+        keyboard = []
+        for email_data in seller['emails']:
+            flag = f" — {MATCH_FLAGS[email_data['match_status']]}" if email_data['match_status'] in MATCH_FLAGS else ""
+            message_text += (
+                f"#{email_data['id']} — **{email_data['type']}**{flag}\n"
+                f"   `{email_data['email']}` : `{email_data['password']}`\n"
+                f"   {email_data['created_at']}\n"
+            )
+            keyboard.append([
+                InlineKeyboardButton(f"✅ #{email_data['id']}", callback_data=f"accept_{email_data['id']}"),
+                InlineKeyboardButton(f"❌ #{email_data['id']}", callback_data=f"reject_{email_data['id']}")
+            ])
+        if seller['pending_count'] > len(seller['emails']):
+            message_text += f"\n... و {seller['pending_count'] - len(seller['emails'])} إيميل آخر."
+        keyboard.append([
+            InlineKeyboardButton(f"✅ قبول الكل ({seller['pending_count']})", callback_data=f"acceptall_{seller_user_id}_{seller['max_id']}"),
+            InlineKeyboardButton("❌ رفض الكل", callback_data=f"rejectall_{seller_user_id}_{seller['max_id']}")
+        ])
+        # قبول سريع للإيميلات المطابقة للمخزون فقط، والباقي يبقى للمراجعة اليدوية
+        if 0 < seller['matched_count'] < seller['pending_count']:
+            keyboard.append([
+                InlineKeyboardButton(f"⚡ قبول المطابقة فقط ({seller['matched_count']})", callback_data=f"acceptmatched_{seller_user_id}_{seller['max_id']}")
+            ])
+        await message.reply_text(message_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+    if page['has_next']:
+        last_seller_id = page['sellers'][-1]['seller_user_id']
+        await message.reply_text(
+            "يوجد بائعون آخرون في طابور المراجعة.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("الصفحة التالية ➡️", callback_data=f"review_page_{last_seller_id}")]])
+        )
+    else:
+        await message.reply_text("تم عرض كل الإيميلات المعلقة للمراجعة. يرجى استخدام الأزرار للتعامل معها.", reply_markup=get_admin_keyboard())
+    logger.info(f"تم عرض صفحة مراجعة فيها {len(page['sellers'])} بائع للمشرف.")
+
 async def review_emails_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    يبدأ عملية مراجعة الإيميلات ويعرض الإيميلات المعلقة.
+    يبدأ عملية مراجعة الإيميلات ويعرض الصفحة الأولى من الإيميلات المعلقة.
     """
     user_id = update.effective_user.id
     if user_id != DEVELOPER_CHAT_ID:
         await update.message.reply_text("عذراً، هذا الأمر مخصص للمشرفين فقط.")
         return ConversationHandler.END
 
-    pending_emails = get_pending_submitted_emails()
+    await send_review_page(update.message)
+    return ConversationHandler.END
 
-    if not pending_emails:
-        await update.message.reply_text("لا توجد إيميلات معلقة للمراجعة حالياً.", reply_markup=get_admin_keyboard())
+async def handle_review_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    يعرض الصفحة التالية من طابور المراجعة.
+    """
+    query = update.callback_query
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await query.answer("هذا الأمر مخصص للمشرفين فقط.")
+        return
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=None)
+    await send_review_page(query.message, after_seller_id=int(query.data.split('_')[-1]))
+
+async def handle_review_bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يعالج ضغط المشرف على "قبول الكل" أو "رفض الكل" لبائع معين.
+    """
+    query = update.callback_query
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await query.answer("هذا الأمر مخصص للمشرفين فقط.")
         return ConversationHandler.END
-    
-    for email_data in pending_emails:
-        seller_user_data = get_user(email_data['seller_user_id'])
-        seller_name = seller_user_data['user_id'] if not seller_user_data else f"{seller_user_data['user_id']} ({seller_user_data.get('username', 'N/A')})"
+    await query.answer()
 
-        keyboard = [
-            [InlineKeyboardButton("✅ قبول", callback_data=f"accept_{email_data['id']}"),
-             InlineKeyboardButton("❌ رفض", callback_data=f"reject_{email_data['id']}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    action, seller_user_id, max_id = query.data.split('_')
+    context.user_data['bulk_seller_user_id'] = int(seller_user_id)
+    context.user_data['bulk_max_id'] = int(max_id)
+    context.user_data['bulk_matched_only'] = action == "acceptmatched"
 
-        message_text = (
-            f"🔔 طلب مراجعة إيميل:\n"
-            f"   - من المستخدم: {seller_name}\n"
-            f"   - نوع الإيميل: **{email_data['type']}**\n"
-            f"   - الإيميل: `{email_data['email']}`\n"
-            f"   - كلمة السر: `{email_data['password']}`\n"
-            f"   - تاريخ الإرسال: {email_data['created_at']}"
+    if action in ("acceptall", "acceptmatched"):
+        scope = "الإيميلات المطابقة للمخزون" if action == "acceptmatched" else "كل الإيميلات المعلقة"
+        await query.message.reply_text(
+            f"قبول {scope} للمستخدم {seller_user_id}.\n"
+            f"أدخل الرصيد الذي سيتم إضافته عن كل إيميل:\nأرسل /cancel للإلغاء."
         )
-        await update.message.reply_text(message_text, parse_mode='Markdown', reply_markup=reply_markup)
-        logger.info(f"تم عرض إيميل {email_data['id']} للمراجعة للمشرف {user_id}.")
+        return ACCEPT_ALL_BALANCE
 
-    await update.message.reply_text("تم عرض جميع الإيميلات المعلقة للمراجعة. يرجى استخدام الأزرار أدناه للتعامل معها.", reply_markup=get_admin_keyboard())
-    return ConversationHandler.END
+    await query.message.reply_text(
+        f"رفض كل الإيميلات المعلقة للمستخدم {seller_user_id}.\n"
+        f"أدخل سبب الرفض:\nأرسل /cancel للإلغاء."
+    )
+    return REJECT_ALL_REASON
 
 async def handle_review_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     يعالج ضغط المشرف على زر "قبول" أو "رفض" لإيميل معين.
     """
     query = update.callback_query
+    # نقطة دخول لمحادثة المراجعة: بدون هذا الفحص أي مستخدم يرسل accept_<id> يصل لإضافة الرصيد
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await query.answer("هذا الأمر مخصص للمشرفين فقط.")
+        return ConversationHandler.END
     await query.answer()
 
     action, email_id = query.data.split('_')
     email_id = int(email_id)
 
-    email_data = get_submitted_email_by_id(email_id)
+    email_data = await get_submitted_email_by_id(email_id)
     if not email_data:
         await query.edit_message_text("عذراً، هذا الإيميل لم يعد موجوداً أو تم التعامل معه مسبقاً.")
         return ConversationHandler.END
 
     seller_user_id = email_data['seller_user_id']
-    seller_user_data = get_user(seller_user_id)
+    seller_user_data = await get_user(seller_user_id)
     seller_name = seller_user_data['user_id'] if not seller_user_data else f"{seller_user_data['user_id']} ({seller_user_data.get('username', 'N/A')})"
 
     if action == "accept":
@@ -521,7 +772,8 @@ async def handle_review_callback(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data['current_seller_user_id'] = seller_user_id
         context.user_data['current_email_type'] = email_data['type']
         
-        await query.edit_message_text(f"تم قبول الإيميل:\n   - الإيميل: `{email_data['email']}`\n   - كلمة السر: `{email_data['password']}`\n\nأدخل الرصيد الذي سيتم إضافته للمستخدم {seller_name} (ID: {seller_user_id}):\nأرسل /cancel للإلغاء.")
+        match_text = f"\n   - المطابقة: {MATCH_FLAGS[email_data['match_status']]}" if email_data['match_status'] in MATCH_FLAGS else ""
+        await query.edit_message_text(f"تم قبول الإيميل:\n   - الإيميل: `{email_data['email']}`\n   - كلمة السر: `{email_data['password']}`{match_text}\n\nأدخل الرصيد الذي سيتم إضافته للمستخدم {seller_name} (ID: {seller_user_id}):\nأرسل /cancel للإلغاء.")
         return ACCEPT_EMAIL_BALANCE_ADJUST
         
     elif action == "reject":
@@ -542,11 +794,11 @@ async def process_rejection_reason(update: Update, context: ContextTypes.DEFAULT
     rejection_reason = update.message.text.strip()
 
     if email_id and seller_user_id:
-        if update_submitted_email_status(email_id, 'rejected', rejection_reason):
+        if await update_submitted_email_status(email_id, 'rejected', rejection_reason):
             await update.message.reply_text("تم رفض الإيميل وإرسال الإشعار للمستخدم.", reply_markup=get_admin_keyboard())
-            await context.bot.send_message(
-                chat_id=seller_user_id,
-                text=f"🔴 تم رفض الإيميل الذي أرسلته للمراجعة.\nالسبب: {rejection_reason}\n\nيرجى بيعه في خانة الإيميلات العشوائية أو تغيير كلمة سره لحمايتك.",
+            notify(
+                seller_user_id,
+                f"🔴 تم رفض الإيميل الذي أرسلته للمراجعة.\nالسبب: {rejection_reason}\n\nيرجى بيعه في خانة الإيميلات العشوائية أو تغيير كلمة سره لحمايتك.",
                 reply_markup=ReplyKeyboardMarkup([
                     [KeyboardButton("بيع كإيميل عشوائي")],
                     [KeyboardButton("رجوع للقائمة الرئيسية")]
@@ -562,43 +814,445 @@ async def process_rejection_reason(update: Update, context: ContextTypes.DEFAULT
 
 async def process_accepted_email_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    يستقبل مبلغ الرصيد من المشرف، يحدث رصيد المستخدم، ويشعر المستخدم بالقبول.
+    يستقبل مبلغ الرصيد من المشرف، يقبل الإيميل ويضيف الرصيد للمستخدم بمعاملة واحدة، ويشعر المستخدم بالقبول.
     """
-    email_id = context.user_data.pop('current_email_id_to_accept', None)
-    seller_user_id = context.user_data.pop('current_seller_user_id', None)
-    email_type = context.user_data.pop('current_email_type', None)
-    
     try:
         amount_to_add = int(update.message.text.strip())
-
-        if email_id and seller_user_id:
-            if update_submitted_email_status(email_id, 'approved') and update_user_balance(seller_user_id, amount_to_add):
-                await update.message.reply_text(f"تم قبول الإيميل وإضافة {amount_to_add} ليرة لرصيد المستخدم {seller_user_id}.", reply_markup=get_admin_keyboard())
-                await context.bot.send_message(
-                    chat_id=seller_user_id,
-                    text=f"✅ تم إضافة الرصيد إلى حسابك! مبلغ: {amount_to_add} ليرة.\n"
-                         f"رصيدك الحالي: {get_user(seller_user_id)['balance']} ليرة."
-                )
-                logger.info(f"الإيميل {email_id} تم قبوله. تم إضافة {amount_to_add} للمستخدم {seller_user_id}.")
-            else:
-                await update.message.reply_text("حدث خطأ أثناء قبول الإيميل أو تعديل الرصيد.", reply_markup=get_admin_keyboard())
-        else:
-            await update.message.reply_text("خطأ في معالجة طلب القبول.", reply_markup=get_admin_keyboard())
-            
     except ValueError:
         await update.message.reply_text("الرجاء إدخال رقم صحيح للمبلغ. يرجى المحاولة مرة أخرى أو أرسل /cancel.", reply_markup=get_admin_keyboard())
         return ACCEPT_EMAIL_BALANCE_ADJUST
-    
+
+    email_id = context.user_data.pop('current_email_id_to_accept', None)
+    seller_user_id = context.user_data.pop('current_seller_user_id', None)
+    context.user_data.pop('current_email_type', None)
+
+    if not (email_id and seller_user_id):
+        await update.message.reply_text("خطأ في معالجة طلب القبول.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    seller = await approve_submitted_email(email_id, amount_to_add)
+    if seller:
+        await update.message.reply_text(f"تم قبول الإيميل وإضافة {amount_to_add} ليرة لرصيد المستخدم {seller_user_id}.", reply_markup=get_admin_keyboard())
+        notify(
+            seller_user_id,
+            f"✅ تم إضافة الرصيد إلى حسابك! مبلغ: {amount_to_add} ليرة.\n"
+            f"رصيدك الحالي: {seller['balance']} ليرة."
+        )
+        logger.info(f"الإيميل {email_id} تم قبوله. تم إضافة {amount_to_add} للمستخدم {seller_user_id}.")
+    else:
+        await update.message.reply_text("تعذر قبول الإيميل (ربما تمت مراجعته مسبقاً أو حدث خطأ).", reply_markup=get_admin_keyboard())
+
+    return ConversationHandler.END
+
+
+async def process_accept_all_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل الرصيد لكل إيميل، يقبل كل إيميلات البائع ويضيف الرصيد بمعاملة واحدة، ويشعر البائع مرة واحدة.
+    """
+    try:
+        amount_per_email = int(update.message.text.strip())
+    except ValueError:
+        await update.message.reply_text("الرجاء إدخال رقم صحيح للمبلغ. يرجى المحاولة مرة أخرى أو أرسل /cancel.")
+        return ACCEPT_ALL_BALANCE
+
+    seller_user_id = context.user_data.pop('bulk_seller_user_id', None)
+    max_id = context.user_data.pop('bulk_max_id', None)
+    matched_only = context.user_data.pop('bulk_matched_only', False)
+    if not seller_user_id:
+        await update.message.reply_text("خطأ في معالجة طلب القبول.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    approved = await approve_seller_submissions(seller_user_id, max_id, amount_per_email, matched_only)
+    if approved is None:
+        await update.message.reply_text("حدث خطأ أثناء قبول الإيميلات أو تعديل الرصيد.", reply_markup=get_admin_keyboard())
+    elif approved == 0:
+        await update.message.reply_text("لا توجد إيميلات معلقة لهذا المستخدم (ربما تم التعامل معها مسبقاً).", reply_markup=get_admin_keyboard())
+    else:
+        total = approved * amount_per_email
+        await update.message.reply_text(f"تم قبول {approved} إيميل وإضافة {total} ليرة لرصيد المستخدم {seller_user_id}.", reply_markup=get_admin_keyboard())
+        notify(seller_user_id, f"✅ تم قبول {approved} إيميل وإضافة {total} ليرة إلى حسابك!")
+    return ConversationHandler.END
+
+async def process_reject_all_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل سبب الرفض، يرفض كل إيميلات البائع دفعة واحدة، ويشعر البائع مرة واحدة.
+    """
+    seller_user_id = context.user_data.pop('bulk_seller_user_id', None)
+    max_id = context.user_data.pop('bulk_max_id', None)
+    context.user_data.pop('bulk_matched_only', None)
+    rejection_reason = update.message.text.strip()
+    if not seller_user_id:
+        await update.message.reply_text("خطأ في معالجة طلب الرفض.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    rejected = await reject_seller_submissions(seller_user_id, max_id, rejection_reason)
+    if rejected is None:
+        await update.message.reply_text("حدث خطأ أثناء رفض الإيميلات.", reply_markup=get_admin_keyboard())
+    elif rejected == 0:
+        await update.message.reply_text("لا توجد إيميلات معلقة لهذا المستخدم (ربما تم التعامل معها مسبقاً).", reply_markup=get_admin_keyboard())
+    else:
+        await update.message.reply_text(f"تم رفض {rejected} إيميل وإرسال الإشعار للمستخدم.", reply_markup=get_admin_keyboard())
+        notify(
+            seller_user_id,
+            f"🔴 تم رفض {rejected} إيميل أرسلتها للمراجعة.\nالسبب: {rejection_reason}\n\nيرجى بيعها في خانة الإيميلات العشوائية أو تغيير كلمات سرها لحمايتك."
+        )
+    return ConversationHandler.END
+
+
+# دوال سحب الأرباح (للمستخدم العادي)
+WITHDRAWAL_METHODS = ["سيرياتيل كاش", "MTN كاش"]
+
+async def withdraw_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يبدأ طلب سحب: يعرض الرصيد ويطلب المبلغ.
+    """
+    user_data = await get_user(update.effective_user.id)
+    if not user_data or user_data['role'] != 'user':
+        await update.message.reply_text("عذراً، هذا القسم مخصص للمستخدمين العاديين.")
+        return ConversationHandler.END
+    if user_data['balance'] <= 0:
+        await update.message.reply_text("رصيدك الحالي 0 ليرة، لا يمكنك طلب سحب.", reply_markup=get_user_keyboard())
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        f"رصيدك الحالي: {user_data['balance']} ليرة.\n"
+        "أدخل المبلغ الذي تريد سحبه:\nأرسل /cancel للإلغاء.",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return WITHDRAW_AMOUNT
+
+async def receive_withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        amount = int(update.message.text.strip())
+        if amount <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("الرجاء إدخال مبلغ صحيح (رقم أكبر من 0) أو أرسل /cancel.")
+        return WITHDRAW_AMOUNT
+
+    user_data = await get_user(update.effective_user.id)
+    if amount > user_data['balance']:
+        await update.message.reply_text(f"المبلغ أكبر من رصيدك ({user_data['balance']} ليرة). أدخل مبلغاً أصغر أو أرسل /cancel.")
+        return WITHDRAW_AMOUNT
+
+    context.user_data['withdraw_amount'] = amount
+    await update.message.reply_text(
+        "اختر طريقة السحب:",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton(m)] for m in WITHDRAWAL_METHODS], resize_keyboard=True, one_time_keyboard=True)
+    )
+    return WITHDRAW_METHOD
+
+async def receive_withdraw_method(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.message.text not in WITHDRAWAL_METHODS:
+        await update.message.reply_text("يرجى اختيار طريقة السحب من الأزرار أو أرسل /cancel.")
+        return WITHDRAW_METHOD
+    context.user_data['withdraw_method'] = update.message.text
+    await update.message.reply_text("أدخل رقم الهاتف الذي سيتم التحويل إليه:\nأرسل /cancel للإلغاء.", reply_markup=ReplyKeyboardRemove())
+    return WITHDRAW_PHONE
+
+async def receive_withdraw_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل رقم الهاتف وينشئ طلب السحب، والمبلغ يُحجز من الرصيد بنفس المعاملة.
+    """
+    phone_number = update.message.text.strip().replace(" ", "")
+    if not phone_number.lstrip("+").isdigit() or not 9 <= len(phone_number.lstrip("+")) <= 15:
+        await update.message.reply_text("رقم الهاتف غير صالح. أدخل رقماً صحيحاً أو أرسل /cancel.")
+        return WITHDRAW_PHONE
+
+    user_id = update.effective_user.id
+    amount = context.user_data.pop('withdraw_amount', None)
+    method = context.user_data.pop('withdraw_method', None)
+    if not amount or not method:
+        await update.message.reply_text("خطأ في معالجة طلب السحب. حاول مرة أخرى.", reply_markup=get_user_keyboard())
+        return ConversationHandler.END
+
+    result = await request_withdrawal(user_id, amount, method, phone_number)
+    if result is False:
+        await update.message.reply_text("رصيدك لا يكفي لهذا المبلغ.", reply_markup=get_user_keyboard())
+    elif result is None:
+        await update.message.reply_text("حدث خطأ أثناء تسجيل طلب السحب. حاول لاحقاً.", reply_markup=get_user_keyboard())
+    else:
+        request = result['request']
+        await update.message.reply_text(
+            f"✅ تم تسجيل طلب السحب #{request['id']} بمبلغ {amount} ليرة ({method}).\n"
+            f"تم حجز المبلغ من رصيدك، ورصيدك الحالي: {result['balance']} ليرة.\n"
+            "سيتم إشعارك عند تنفيذ الطلب.",
+            reply_markup=get_user_keyboard()
+        )
+        notify(DEVELOPER_CHAT_ID, f"💸 طلب سحب جديد #{request['id']} من المستخدم {user_id}: {amount} ليرة ({method}).")
+    return ConversationHandler.END
+
+async def cancel_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.pop('withdraw_amount', None)
+    context.user_data.pop('withdraw_method', None)
+    await update.message.reply_text("تم إلغاء طلب السحب.", reply_markup=get_user_keyboard())
+    return ConversationHandler.END
+
+
+# دوال مراجعة طلبات السحب (للمشرف)
+WITHDRAWALS_PAGE_SIZE = 20
+
+async def send_withdrawals_page(message, after_id=0) -> None:
+    """
+    يرسل صفحة من طلبات السحب المعلقة (الأقدم أولاً) مع أزرار قبول/رفض لكل طلب،
+    وأزرار "قبول الكل/رفض الكل" للطلبات المعروضة في الصفحة.
+    """
+    page = await get_pending_withdrawals_page(after_id, WITHDRAWALS_PAGE_SIZE)
+    if not page['requests']:
+        await message.reply_text("لا توجد طلبات سحب معلقة حالياً.", reply_markup=get_admin_keyboard())
+        return
+
+    message_text = "💸 طلبات السحب المعلقة:\n\n"
+    keyboard = []
+    for request in page['requests']:
+        message_text += (
+            f"#{request['id']} — المستخدم {request['user_id']} — {request['amount']} ليرة\n"
+            f"   {request['method']}: `{request['phone_number']}`\n"
+            f"   {request['requested_at']}\n"
+        )
+        keyboard.append([
+            InlineKeyboardButton(f"✅ #{request['id']}", callback_data=f"wd_approve_{request['id']}"),
+            InlineKeyboardButton(f"❌ #{request['id']}", callback_data=f"wd_reject_{request['id']}")
+        ])
+    # الصفحة تُحدد بأول وآخر طلب فيها، فالقبول الجماعي لا يشمل طلبات لم يرها المشرف
+    last_id = page['requests'][-1]['id']
+    total = sum(r['amount'] for r in page['requests'])
+    keyboard.append([
+        InlineKeyboardButton(f"✅ قبول الكل ({len(page['requests'])}، {total} ليرة)", callback_data=f"wd_approveall_{after_id}_{last_id}"),
+        InlineKeyboardButton("❌ رفض الكل", callback_data=f"wd_rejectall_{after_id}_{last_id}")
+    ])
+    if page['has_next']:
+        keyboard.append([InlineKeyboardButton("الصفحة التالية ➡️", callback_data=f"wd_page_{last_id}")])
+    await message.reply_text(message_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def withdrawals_review_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await update.message.reply_text("عذراً، هذا الأمر مخصص للمشرفين فقط.")
+        return ConversationHandler.END
+    await send_withdrawals_page(update.message)
+    return ConversationHandler.END
+
+def notify_withdrawals_processed(requests, approved, rejection_reason=None):
+    """إشعار واحد لكل طلب (الإشعارات المتتالية لنفس المستخدم تُدمج في outbox)."""
+    for request in requests:
+        if approved:
+            text = f"✅ تم تنفيذ طلب السحب #{request['id']} بمبلغ {request['amount']} ليرة إلى {request['phone_number']} ({request['method']})."
+        else:
+            text = (
+                f"🔴 تم رفض طلب السحب #{request['id']} بمبلغ {request['amount']} ليرة.\n"
+                f"السبب: {rejection_reason}\nتمت إعادة المبلغ إلى رصيدك."
+            )
+        notify(request['user_id'], text)
+
+async def handle_withdrawal_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يعالج أزرار طلبات السحب: الصفحة التالية، قبول/رفض طلب، قبول/رفض كل طلبات الصفحة.
+    القبول يتم فوراً بتحديث واحد، والرفض يطلب السبب أولاً.
+    """
+    query = update.callback_query
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await query.answer("هذا الأمر مخصص للمشرفين فقط.")
+        return ConversationHandler.END
+    await query.answer()
+
+    parts = query.data.split('_')
+    action = parts[1]
+    if action == "page":
+        await query.edit_message_reply_markup(reply_markup=None)
+        await send_withdrawals_page(query.message, after_id=int(parts[2]))
+        return ConversationHandler.END
+
+    if action in ("approveall", "rejectall"):
+        request_ids = await get_pending_withdrawal_ids(int(parts[2]), int(parts[3]))
+    else:
+        request_ids = [int(parts[2])]
+    if not request_ids:
+        await query.message.reply_text("لا توجد طلبات معلقة هنا (ربما تم التعامل معها مسبقاً).", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    if action in ("approve", "approveall"):
+        approved = await approve_withdrawals(request_ids)
+        if approved is None:
+            await query.message.reply_text("حدث خطأ أثناء قبول طلبات السحب.", reply_markup=get_admin_keyboard())
+        else:
+            await query.message.reply_text(
+                f"تم تنفيذ {len(approved)} طلب سحب بمجموع {sum(r['amount'] for r in approved)} ليرة.",
+                reply_markup=get_admin_keyboard()
+            )
+            notify_withdrawals_processed(approved, approved=True)
+        return ConversationHandler.END
+
+    context.user_data['withdrawal_ids_to_reject'] = request_ids
+    await query.message.reply_text(
+        f"رفض {len(request_ids)} طلب سحب وإعادة المبالغ لأصحابها.\n"
+        "أدخل سبب الرفض:\nأرسل /cancel للإلغاء."
+    )
+    return WITHDRAWAL_REJECT_REASON
+
+async def process_withdrawal_reject_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل سبب الرفض، يرفض الطلبات ويعيد المبالغ بمعاملة واحدة، ويشعر أصحابها.
+    """
+    request_ids = context.user_data.pop('withdrawal_ids_to_reject', None)
+    rejection_reason = update.message.text.strip()
+    if not request_ids:
+        await update.message.reply_text("خطأ في معالجة طلب الرفض.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    rejected = await reject_withdrawals(request_ids, rejection_reason)
+    if rejected is None:
+        await update.message.reply_text("حدث خطأ أثناء رفض طلبات السحب.", reply_markup=get_admin_keyboard())
+    elif not rejected:
+        await update.message.reply_text("لا توجد طلبات معلقة هنا (ربما تم التعامل معها مسبقاً).", reply_markup=get_admin_keyboard())
+    else:
+        await update.message.reply_text(
+            f"تم رفض {len(rejected)} طلب سحب وإعادة {sum(r['amount'] for r in rejected)} ليرة لأرصدة أصحابها.",
+            reply_markup=get_admin_keyboard()
+        )
+        notify_withdrawals_processed(rejected, approved=False, rejection_reason=rejection_reason)
+    return ConversationHandler.END
+
+async def cancel_withdrawals_review(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.pop('withdrawal_ids_to_reject', None)
+    await update.message.reply_text("تم الإلغاء.", reply_markup=get_admin_keyboard())
+    return ConversationHandler.END
+
+
+# دوال الرسالة الجماعية (للمشرف)
+async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يبدأ عملية الرسالة الجماعية ويطلب من المشرف نص الرسالة.
+    """
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await update.message.reply_text("عذراً، هذا الأمر مخصص للمشرفين فقط.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        "أرسل نص الرسالة التي سيتم إرسالها لجميع مستخدمي البوت.\n\n"
+        "أرسل /cancel للإلغاء.",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return BROADCAST_TEXT
+
+async def receive_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يستقبل نص الرسالة الجماعية ويعرضه على المشرف للتأكيد.
+    """
+    context.user_data['broadcast_text'] = update.message.text
+    total_users = await get_users_count()
+    keyboard = [
+        [KeyboardButton("تأكيد الإرسال")],
+        [KeyboardButton("إلغاء الإرسال")]
+    ]
+    await update.message.reply_text(
+        f"سيتم إرسال الرسالة التالية إلى {total_users} مستخدم:\n\n{update.message.text}",
+        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    )
+    return BROADCAST_CONFIRM
+
+async def broadcast_and_report(application: Application, broadcast) -> None:
+    """يشغل الرسالة الجماعية في الخلفية ويرسل تقرير النتيجة للمشرف عند الانتهاء."""
+    result = await run_broadcast(application.bot, broadcast)
+    if result:
+        notify(
+            DEVELOPER_CHAT_ID,
+            f"📣 انتهت الرسالة الجماعية #{result['id']}:\n"
+            f"   - وصلت: {result['delivered']}\n"
+            f"   - محظور/غير موجود: {result['blocked']}\n"
+            f"   - فشل: {result['failed']}"
+        )
+
+async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يسجل الرسالة الجماعية في قاعدة البيانات ويبدأ إرسالها في الخلفية.
+    """
+    text = context.user_data.pop('broadcast_text', None)
+    broadcast = await create_broadcast(text) if text else None
+    if not broadcast:
+        await update.message.reply_text("حدث خطأ في بدء الرسالة الجماعية. يرجى المحاولة مرة أخرى.", reply_markup=get_admin_keyboard())
+        return ConversationHandler.END
+
+    context.application.create_task(broadcast_and_report(context.application, broadcast))
+    await update.message.reply_text(
+        f"بدأ إرسال الرسالة الجماعية #{broadcast['id']}. سيصلك تقرير بالنتيجة عند الانتهاء.",
+        reply_markup=get_admin_keyboard()
+    )
+    logger.info(f"المشرف {update.effective_user.id} بدأ الرسالة الجماعية {broadcast['id']}.")
+    return ConversationHandler.END
+
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    يلغي عملية الرسالة الجماعية قبل بدء الإرسال.
+    """
+    context.user_data.pop('broadcast_text', None)
+    await update.message.reply_text("تم إلغاء الرسالة الجماعية.", reply_markup=get_admin_keyboard())
     return ConversationHandler.END
 
 
 # دالة عند بدء تشغيل البوت وإرسال رسالة للمشرف
+# مطابقة الأرصدة الدورية
+RECONCILE_INTERVAL = 6 * 60 * 60   # ثواني بين كل مطابقة
+RECONCILE_BATCH_SIZE = 5000        # عدد المستخدمين في كل استعلام (بين الدفعات يتفرغ خيط قاعدة البيانات للمعالجات)
+
+async def reconcile_balances_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يطابق رصيد كل المستخدمين مع سجل الحركات على دفعات، ويبلغ المشرف بأي فرق (بدون تصحيح تلقائي)."""
+    after_user_id, checked, mismatches = 0, 0, []
+    while True:
+        result = await reconcile_balances(after_user_id, RECONCILE_BATCH_SIZE)
+        if result["last_user_id"] is None:
+            break
+        checked += result["checked"]
+        mismatches.extend(result["mismatches"])
+        after_user_id = result["last_user_id"]
+
+    logger.info(f"مطابقة الأرصدة: {checked} مستخدم، {len(mismatches)} فرق.")
+    if mismatches:
+        lines = [f"{m['user_id']}: الرصيد {m['balance']} ≠ السجل {m['ledger_total']}" for m in mismatches[:20]]
+        notify(DEVELOPER_CHAT_ID, f"⚠️ مطابقة الأرصدة: {len(mismatches)} مستخدم رصيده لا يطابق سجل الحركات:\n" + "\n".join(lines))
+
+
+# إنهاء مهلة إعادة بيع الإيميلات الأمريكية (24 ساعة من الاستلام)
+EXPIRY_SWEEP_INTERVAL = 10 * 60   # ثواني بين كل دورة
+EXPIRY_BATCH_SIZE = 1000          # عدد الإيميلات في كل UPDATE (بين الدفعات يتفرغ خيط قاعدة البيانات للمعالجات)
+
+# مقاييس دورات الإنهاء (تظهر في لوحة إحصائيات المشرف)
+expiry_sweep_metrics = {"sweeps": 0, "expired_total": 0, "last_expired": 0, "last_duration_ms": 0.0}
+
+async def expire_stale_claims_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ينهي الإيميلات المباعة التي مرت عليها المهلة على دفعات، ويسجل عددها وزمن الدورة."""
+    started = time.perf_counter()
+    expired = 0
+    while True:
+        count = await expire_stale_claims(EXPIRY_BATCH_SIZE)
+        if not count:
+            break
+        expired += count
+        if count < EXPIRY_BATCH_SIZE:
+            break
+    duration_ms = (time.perf_counter() - started) * 1000
+
+    expiry_sweep_metrics["sweeps"] += 1
+    expiry_sweep_metrics["expired_total"] += expired
+    expiry_sweep_metrics["last_expired"] = expired
+    expiry_sweep_metrics["last_duration_ms"] = duration_ms
+    if expired:
+        logger.info(f"انتهت مهلة {expired} إيميل أمريكي مباع ({duration_ms:.1f} ms).")
+
+
 async def post_init(application: Application) -> None:
     """
     تُنفذ بعد بدء تشغيل البوت مباشرة.
     """
-    initialize_db()
-    add_user(DEVELOPER_CHAT_ID, role='admin')
+    await initialize_db()
+    await add_user(DEVELOPER_CHAT_ID, role='admin')
+    start_notifier(application.bot)
+    if METRICS_PORT:
+        await metrics.start_metrics_server(METRICS_PORT)
+
+    # استكمال أي رسالة جماعية توقفت بسبب إعادة التشغيل من آخر نقطة محفوظة (في عملية المهام الخلفية فقط)
+    if BACKGROUND_JOBS:
+        for broadcast in await get_running_broadcasts():
+            application.create_task(broadcast_and_report(application, broadcast))
 
     try:
         await application.bot.send_message(
@@ -610,107 +1264,257 @@ async def post_init(application: Application) -> None:
     except Exception as e:
         logger.error(f"فشل إرسال رسالة بدء التشغيل للمشرف: {e}")
 
+# دالة عند إيقاف البوت
+async def post_stop(application: Application) -> None:
+    """
+    تُنفذ بعد إيقاف استقبال التحديثات وقبل إغلاق اتصال البوت: ترسل الإشعارات المنتظرة.
+    """
+    await stop_notifier()
 
-# الدالة الرئيسية لتشغيل البوت
-def main() -> None:
-    """تشغيل البوت."""
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+
+async def post_shutdown(application: Application) -> None:
+    """
+    تُنفذ في النهاية (بعد أن يكتب persistence آخر دفعة): تغلق اتصال قاعدة البيانات وخيطها.
+    """
+    await metrics.stop_metrics_server()
+    await async_db.close()
+
+
+# إنشاء التطبيق وتسجيل المعالجات
+def build_application(token=BOT_TOKEN, base_url=None, rate_limit=True, concurrent=True, update_processor=None) -> Application:
+    """
+    ينشئ تطبيق البوت ويسجل كل المعالجات.
+    base_url و rate_limit=False لتوجيه البوت لخادم Bot API محلي بديل (أدوات القياس في loadtest.py).
+    concurrent=False يرجع للمعالجة التسلسلية الافتراضية (للمقارنة فقط).
+    update_processor يستبدل PerChatUpdateProcessor (loadtest.py يمرر نسخة تقيس زمن كل معالج).
+    """
+    persistence = SQLitePersistence()
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .persistence(persistence)  # المحادثات المفتوحة و user_data تبقى بعد إعادة التشغيل
+        .request(metrics.TimedRequest(connection_pool_size=256))  # زمن كل طلب لتيليجرام (نفس حجم المجمع الافتراضي)
+    )
+    if concurrent:
+        # المستخدمون المختلفون بالتوازي، وتحديثات كل مستخدم بالترتيب
+        builder = builder.concurrent_updates(update_processor or PerChatUpdateProcessor())
+    if rate_limit:
+        # كل الرسائل الصادرة تمر على حدود تيليجرام وإعادة المحاولة، والحد العام مقسوم على عمليات البوت
+        rate_limiter = OutboundRateLimiter(global_rate=GLOBAL_RATE / WORKER_COUNT)
+        builder = builder.rate_limiter(rate_limiter)
+        metrics.register_gauges("outbound", rate_limiter.metrics)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     # إضافة معالج المحادثات لإضافة الإيميلات الأمريكية (للمشرف)
     add_emails_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^إضافة إيميلات أمريكية$"), add_american_emails_start)],
+        entry_points=[MessageHandler(filters.Text(["إضافة إيميلات أمريكية"]), add_american_emails_start)],
         states={
             ADD_AMERICAN_EMAILS_STATE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_american_emails)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_american_emails),
+                MessageHandler(filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"), receive_american_emails_file)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_add_emails)],
+        name="add_american_emails",
+        persistent=True
     )
     application.add_handler(add_emails_conv_handler)
 
     # إضافة معالج المحادثات لبيع الإيميلات للمستخدم العادي
     sell_emails_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^بيع إيميلات$"), sell_emails_start)],
+        entry_points=[MessageHandler(filters.Text(["بيع إيميلات"]), sell_emails_start)],
         states={
             SELL_EMAILS_CHOICE: [
-                MessageHandler(filters.Regex("^إيميلات أمريكية$"), choose_american_emails),
-                MessageHandler(filters.Regex("^إيميلات عشوائية$"), sell_random_emails),
-                MessageHandler(filters.Regex("^رجوع للقائمة الرئيسية$"), cancel_sell_emails)
+                MessageHandler(filters.Text(["إيميلات أمريكية"]), choose_american_emails),
+                MessageHandler(filters.Text(["إيميلات عشوائية"]), sell_random_emails),
+                MessageHandler(filters.Text(["رجوع للقائمة الرئيسية"]), cancel_sell_emails)
             ],
             SELL_AMERICAN_COUNT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, receive_american_emails_count)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_sell_emails)],
+        name="sell_emails",
+        persistent=True
     )
     application.add_handler(sell_emails_conv_handler)
 
     # إضافة معالج المحادثات لإدارة الإيميلات الأمريكية للمشرف
     manage_emails_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^إدارة الإيميلات الأمريكية$"), manage_american_emails_start)],
+        entry_points=[MessageHandler(filters.Text(["إدارة الإيميلات الأمريكية"]), manage_american_emails_start)],
         states={
             MANAGE_AMERICAN_EMAILS_CHOICE: [
-                MessageHandler(filters.Regex("^عرض الإيميلات المتاحة$"), display_available_american_emails),
-                MessageHandler(filters.Regex("^حذف إيميل أمريكي$"), delete_american_email_start),
-                MessageHandler(filters.Regex("^رجوع للقائمة الرئيسية \\(إدارة الإيميلات\\)$"), cancel_manage_emails)
+                MessageHandler(filters.Text(["عرض الإيميلات المتاحة"]), display_available_american_emails),
+                MessageHandler(filters.Text(["حذف إيميل أمريكي"]), delete_american_email_start),
+                MessageHandler(filters.Text(["رجوع للقائمة الرئيسية (إدارة الإيميلات)"]), cancel_manage_emails)
             ],
             DELETE_AMERICAN_EMAIL_STATE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_delete_american_email)
             ]
         },
-        fallbacks=[CommandHandler("cancel", cancel_manage_emails)]
+        fallbacks=[CommandHandler("cancel", cancel_manage_emails)],
+        name="manage_american_emails",
+        persistent=True
     )
     application.add_handler(manage_emails_conv_handler)
 
     # إضافة معالج المحادثات لإرسال الإيميلات للمراجعة (للمستخدم العادي)
     submit_emails_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^إرسال الإيميلات$"), submit_emails_start)],
+        entry_points=[MessageHandler(filters.Text(["إرسال الإيميلات"]), submit_emails_start)],
         states={
             SUBMIT_EMAILS_TYPE_CHOICE: [
-                MessageHandler(filters.Regex("^(إيميل أمريكي \(من البوت\)|إيميل عشوائي \(منك\))$"), submit_emails_type_choice)
+                MessageHandler(filters.Text(["إيميل أمريكي (من البوت)", "إيميل عشوائي (منك)"]), submit_emails_type_choice)
             ],
             SUBMIT_EMAILS_STATE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, receive_submitted_emails)
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_submit_emails)],
+        name="submit_emails",
+        persistent=True
     )
     application.add_handler(submit_emails_conv_handler)
 
     # إضافة معالج المحادثات لمراجعة إيميلات البيع (للمشرف)
     review_emails_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^مراجعة إيميلات البيع$"), review_emails_start)],
+        entry_points=[
+            MessageHandler(filters.Text(["مراجعة إيميلات البيع"]), review_emails_start),
+            # أزرار القبول/الرفض هي التي تبدأ حالة إدخال المبلغ أو السبب
+            CallbackQueryHandler(handle_review_callback, pattern=r"^(accept|reject)_\d+$"),
+            CallbackQueryHandler(handle_review_bulk_callback, pattern=r"^(acceptall|acceptmatched|rejectall)_\d+_\d+$")
+        ],
         states={
             REJECT_EMAIL_REASON: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_rejection_reason)
             ],
             ACCEPT_EMAIL_BALANCE_ADJUST: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, process_accepted_email_balance)
+            ],
+            ACCEPT_ALL_BALANCE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_accept_all_balance)
+            ],
+            REJECT_ALL_REASON: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_reject_all_reason)
             ]
         },
-        fallbacks=[CommandHandler("cancel", cancel_manage_emails)]
+        fallbacks=[CommandHandler("cancel", cancel_manage_emails)],
+        allow_reentry=True,
+        # الحالة لكل (محادثة، مستخدم) وليس لكل رسالة: زر القبول يبدأ الحالة ورسالة المبلغ بعده تكملها
+        per_message=False,
+        name="review_emails",
+        persistent=True
     )
     application.add_handler(review_emails_conv_handler)
 
-    # إضافة معالج لـ Inline Keyboard Callbacks (للأزرار قبول/رفض)
-    application.add_handler(CallbackQueryHandler(handle_review_callback, pattern=r"^(accept|reject)_\d+$"))
+    # إضافة معالج المحادثات للرسالة الجماعية (للمشرف)
+    broadcast_conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Text(["رسالة جماعية"]), broadcast_start)],
+        states={
+            BROADCAST_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_broadcast_text)
+            ],
+            BROADCAST_CONFIRM: [
+                MessageHandler(filters.Text(["تأكيد الإرسال"]), confirm_broadcast),
+                MessageHandler(filters.Text(["إلغاء الإرسال"]), cancel_broadcast)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel_broadcast)],
+        name="broadcast",
+        persistent=True
+    )
+    application.add_handler(broadcast_conv_handler)
+
+    # إضافة معالج المحادثات لسحب الأرباح (للمستخدم العادي)
+    withdraw_conv_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Text(["سحب الأرباح"]), withdraw_start)],
+        states={
+            WITHDRAW_AMOUNT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_withdraw_amount)
+            ],
+            WITHDRAW_METHOD: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_withdraw_method)
+            ],
+            WITHDRAW_PHONE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_withdraw_phone)
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_withdraw)],
+        name="withdraw",
+        persistent=True
+    )
+    application.add_handler(withdraw_conv_handler)
+
+    # إضافة معالج المحادثات لمراجعة طلبات السحب (للمشرف)
+    withdrawals_review_conv_handler = ConversationHandler(
+        entry_points=[
+            MessageHandler(filters.Text(["مراجعة طلبات السحب"]), withdrawals_review_start),
+            CallbackQueryHandler(handle_withdrawal_callback, pattern=r"^wd_((approve|reject)_\d+|(approveall|rejectall)_\d+_\d+|page_\d+)$")
+        ],
+        states={
+            WITHDRAWAL_REJECT_REASON: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_withdrawal_reject_reason)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel_withdrawals_review)],
+        allow_reentry=True,
+        # الحالة لكل (محادثة، مستخدم): زر الرفض يبدأ الحالة ورسالة السبب بعده تكملها
+        per_message=False,
+        name="withdrawals_review",
+        persistent=True
+    )
+    application.add_handler(withdrawals_review_conv_handler)
+
+    # إضافة معالج لزر الصفحة التالية في طابور المراجعة
+    application.add_handler(CallbackQueryHandler(handle_review_page_callback, pattern=r"^review_page_\d+$"))
+    # أزرار التنقل بين صفحات الإيميلات الأمريكية المتاحة والتصدير كملف
+    application.add_handler(CallbackQueryHandler(handle_american_emails_page_callback, pattern=r"^amer_(page_(next|prev)_\d+|export)$"))
 
     # إضافة معالج الأوامر (Command Handler) لأمر /start
     application.add_handler(CommandHandler("start", start_command))
     
-    # إضافة معالجات لأزرار المشرف الأخرى (مؤقتاً)
-    application.add_handler(MessageHandler(filters.Regex("^إدارة الرصيد$"), coming_soon_admin))
-    application.add_handler(MessageHandler(filters.Regex("^رسالة جماعية$"), coming_soon_admin))
-    application.add_handler(MessageHandler(filters.Regex("^إحصائيات البوت$"), coming_soon_admin_stats))
+    # باقي أزرار القوائم: معالج واحد بجدول (نص الزر -> الدالة) بدل سلسلة معالجات تُفحص واحداً تلو الآخر
+    application.add_handler(MessageHandler(filters.Text(MENU_BUTTONS), dispatch_menu_button))
+
+    # مطابقة الأرصدة مع سجل الحركات وإنهاء مهلة الإيميلات المباعة دورياً (JobQueue متاح فقط مع python-telegram-bot[job-queue])
+    if application.job_queue and BACKGROUND_JOBS:
+        application.job_queue.run_repeating(reconcile_balances_job, interval=RECONCILE_INTERVAL, first=60)
+        application.job_queue.run_repeating(expire_stale_claims_job, interval=EXPIRY_SWEEP_INTERVAL, first=30)
 
-    # إضافة معالجات لأزرار المستخدم العادي (مؤقتاً)
-    application.add_handler(MessageHandler(filters.Regex("^الرصيد$"), coming_soon_user))
-    application.add_handler(MessageHandler(filters.Regex("^سحب الأرباح$"), coming_soon_user))
-    # ## جديد ## معالج لزر "رجوع للقائمة الرئيسية" من الكيبورد المؤقت بعد استلام الايميلات
-    application.add_handler(MessageHandler(filters.Regex("^رجوع للقائمة الرئيسية$"), go_back_to_main_user_keyboard))
+    # زمن كل معالج واستدعاءات قاعدة البيانات، مع مقاييس باقي الوحدات في نفس التقرير (/metrics)
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    metrics.instrument_dispatch(dispatch_menu_button, MENU_BUTTONS)
+    metrics.instrument_application(application)
+    metrics.instrument_db()
+    metrics.register_gauges("user_cache", database.user_cache_stats)
+    metrics.register_gauges("persistence", lambda: {"batches": persistence.batches, "rows_written": persistence.rows_written})
+    metrics.register_gauges("expiry_sweep", lambda: expiry_sweep_metrics)
+
+    return application
+
+# الدالة الرئيسية لتشغيل البوت
+def main() -> None:
+    """تشغيل البوت."""
+    database.DATABASE_URL = DATABASE_URL
+    application = build_application()
 
     logger.info("البوت بدأ التشغيل...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # وضع الويب هوك: تيليجرام يرسل التحديثات مباشرة لخادم البوت بدل الاستطلاع الطويل
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 # دوال مؤقتة للأزرار (لتوضيح أن الميزة قيد التطوير)
 async def coming_soon_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -721,19 +1525,89 @@ async def coming_soon_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await update.message.reply_text("هذه الميزة قيد التطوير. يرجى الانتظار.", reply_markup=get_user_keyboard())
     logger.info(f"المستخدم {update.effective_user.id} ضغط زر غير مبرمج: {update.message.text}")
 
-async def coming_soon_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(user_id) FROM users")
-    total_users = cursor.fetchone()[0]
-    conn.close()
-    await update.message.reply_text(f"عدد المستخدمين الكلي للبوت: {total_users}", reply_markup=get_admin_keyboard())
-    logger.info(f"المشرف {update.effective_user.id} طلب إحصائيات البوت.")
+def format_stats_dashboard(stats, sweep=None):
+    """نص لوحة الإحصائيات للمشرف من get_stats (ومقاييس آخر دورة إنهاء للمهلة إن وُجدت)."""
+    american = stats["american_emails"]
+    submitted = stats["submitted_emails"]
+    withdrawals = stats["withdrawal_requests"]
+    amounts = stats["withdrawal_amounts"]
+    return (
+        "📊 إحصائيات البوت\n\n"
+        f"👥 المستخدمون: {stats['users']}\n"
+        f"💰 مجموع أرصدة المستخدمين: {stats['balance_total']} ليرة\n\n"
+        "🔴 الإيميلات الأمريكية:\n"
+        f"   - المتاح: {american.get('available', 0)}\n"
+        f"   - المباع: {american.get('sold', 0)}\n"
+        f"   - انتهت مهلتها: {american.get('expired', 0)}\n"
+        f"   - الإجمالي: {sum(american.values())}\n\n"
+        "📨 إيميلات البيع:\n"
+        f"   - بانتظار المراجعة: {submitted.get('pending', 0)}\n"
+        f"   - المقبولة: {submitted.get('approved', 0)}\n"
+        f"   - المرفوضة: {submitted.get('rejected', 0)}\n\n"
+        "💸 طلبات السحب:\n"
+        f"   - المعلقة: {withdrawals.get('pending', 0)} ({amounts.get('pending', 0)} ليرة)\n"
+        f"   - المنفذة: {withdrawals.get('approved', 0)} ({amounts.get('approved', 0)} ليرة)"
+        + (f"\n\n⏱ آخر دورة إنهاء للمهلة: {sweep['last_expired']} إيميل في {sweep['last_duration_ms']:.1f} ms"
+           f" (المجموع {sweep['expired_total']} في {sweep['sweeps']} دورة)" if sweep and sweep["sweeps"] else "")
+    )
+
+async def show_bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """زر "إحصائيات البوت": لوحة كاملة للمشرف، وعدد المستخدمين فقط للمستخدم العادي."""
+    stats = await get_stats()
+    if update.effective_user.id == DEVELOPER_CHAT_ID:
+        await update.message.reply_text(format_stats_dashboard(stats, expiry_sweep_metrics), reply_markup=get_admin_keyboard())
+        logger.info(f"المشرف {update.effective_user.id} طلب إحصائيات البوت.")
+    else:
+        await update.message.reply_text(f"عدد المستخدمين الكلي للبوت: {stats['users']}", reply_markup=get_user_keyboard())
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أمر /metrics: زمن المعالجات وقاعدة البيانات وطلبات تيليجرام (للمشرف فقط)."""
+    if update.effective_user.id != DEVELOPER_CHAT_ID:
+        await update.message.reply_text("عذراً، هذا الأمر مخصص للمشرفين فقط.")
+        return
+    await update.message.reply_text(metrics.format_report(), reply_markup=get_admin_keyboard())
+    logger.info(f"المشرف {update.effective_user.id} طلب مقاييس الأداء.")
+
+async def show_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """زر "دعوة الأصدقاء": رابط الدعوة الشخصي وعدد الدعوات ولوحة المتصدرين."""
+    user_id = update.effective_user.id
+    user_data = await get_user(user_id)
+    leaderboard = await get_referral_leaderboard()
+
+    text = (
+        "👥 ادعُ أصدقاءك للبوت عبر رابطك الخاص:\n"
+        f"https://t.me/{context.bot.username}?start={REFERRAL_PREFIX}{user_id}\n\n"
+        f"عدد دعواتك: {user_data['referral_count'] if user_data else 0}"
+    )
+    if leaderboard:
+        text += "\n\n🏆 أكثر المستخدمين دعوة:\n" + "\n".join(
+            f"{position}. {entry['user_id']} — {entry['referral_count']} دعوة"
+            for position, entry in enumerate(leaderboard, start=1)
+        )
+    await update.message.reply_text(text, reply_markup=get_user_keyboard())
 
 # ## جديد ## دالة للرجوع للقائمة الرئيسية للمستخدم
 async def go_back_to_main_user_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("تم الرجوع للقائمة الرئيسية.", reply_markup=get_user_keyboard())
 
+# أزرار القوائم التي لا تبدأ محادثة: نص الزر -> الدالة
+MENU_BUTTONS = {
+    # لوحة الإحصائيات (للمشرف والمستخدم العادي)
+    "إحصائيات البوت": show_bot_stats,
+    # أزرار المشرف (مؤقتاً)
+    "إدارة الرصيد": coming_soon_admin,
+    # أزرار المستخدم العادي (مؤقتاً)
+    "الرصيد": coming_soon_user,
+    # زر "رجوع للقائمة الرئيسية" من الكيبورد المؤقت بعد استلام الايميلات
+    "رجوع للقائمة الرئيسية": go_back_to_main_user_keyboard,
+    # رابط الدعوة ولوحة المتصدرين
+    "دعوة الأصدقاء": show_referrals,
+}
+
+async def dispatch_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يوجه زر القائمة لدالته ببحث واحد في القاموس (filters.Text يضمن أن النص موجود فيه)."""
+    await MENU_BUTTONS[update.message.text](update, context)
+
 
 if __name__ == "__main__":
     main()
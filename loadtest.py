@@ -0,0 +1,613 @@
+# loadtest.py - قياس أداء البوت كاملاً مقابل خادم Bot API محلي بديل
+#
+# التشغيل:
+#   python loadtest.py modes --users 500
+#   python loadtest.py flows --users 300 [--sequential] [--api-latency 50]
+#   python loadtest.py restart --users 200
+#   python loadtest.py journeys --users 2000 [--reviews 200] [--api-latency 20]
+#   python loadtest.py forged
+#   python loadtest.py --database-url postgresql://... flows --users 300
+#
+# FakeBotAPI يلعب دور api.telegram.org: يقدم التحديثات لوضع polling، ويستقبل ردود البوت
+# (sendMessage ...) ويسجل زمن وصول أول رد لكل تحديث. في وضع الويب هوك يرسل الـ harness
+# التحديثات بطلبات POST مباشرة لخادم الويب هوك الخاص بالبوت.
+# كل شيء يعمل على قاعدة بيانات مؤقتة تُحذف في النهاية، ولا يتصل بتيليجرام الحقيقي أبداً.
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import re
+import time
+import urllib.parse
+
+import httpx
+
+import benchmark
+import database
+import metrics
+from benchmark import remove_temp_dbs, use_temp_db
+from config import DEVELOPER_CHAT_ID
+from update_processor import PerChatUpdateProcessor
+
+FAKE_TOKEN = "123456:LOADTEST"
+API_PORT = 8181
+WEBHOOK_PORT = 8182
+WEBHOOK_PATH = "telegram"
+
+
+class FakeBotAPI:
+    """خادم HTTP صغير يقلّد Bot API بما يكفي لتشغيل البوت وقياس زمن الرد."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency  # زمن ذهاب وعودة مصطنع لكل رد (تيليجرام الحقيقي ليس على نفس الجهاز)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._inflight = collections.defaultdict(collections.deque)  # chat_id -> أوقات إرسال التحديثات
+        self.latencies = []
+        self.calls = collections.Counter()
+        self.watched = {}   # chat_id -> الرسائل المرسلة له (نص، أزرار) لمحاكاة ضغط الأزرار (المشرف)
+        self.last_reply_at = None
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=API_PORT):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    # ---- تحديثات المستخدمين الوهميين ----
+    def make_message_update(self, user_id, text):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def make_callback_update(self, user_id, data):
+        """ضغط زر inline (callback_data) على رسالة سابقة في محادثة المستخدم."""
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "LoadTestBot"},
+            "text": "...",
+        }
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {"id": str(next(self._message_ids)), "from": user, "message": message,
+                               "chat_instance": str(user_id), "data": data},
+        }
+
+    @staticmethod
+    def chat_id(update):
+        message = update["message"] if "message" in update else update["callback_query"]["message"]
+        return message["chat"]["id"]
+
+    def watch(self, chat_id):
+        self.watched[chat_id] = []
+
+    def buttons(self, chat_id):
+        """كل callback_data في الرسائل المرسلة لمحادثة مراقبة منذ آخر استدعاء."""
+        sent, self.watched[chat_id] = self.watched[chat_id], []
+        return [
+            button["callback_data"]
+            for markup in sent if isinstance(markup, dict)
+            for row in markup.get("inline_keyboard", [])
+            for button in row if "callback_data" in button
+        ]
+
+    def track(self, user_id):
+        """يسجل وقت إرسال تحديث لهذا المستخدم، ليُحسب زمن الرد عند وصول أول رسالة له."""
+        self._inflight[user_id].append(time.perf_counter())
+
+    def push_update(self, update):
+        """يضيف تحديثاً لطابور getUpdates (وضع polling)."""
+        self.track(self.chat_id(update))
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def pending_replies(self):
+        return sum(len(q) for q in self._inflight.values())
+
+    # ---- HTTP ----
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                params = self._parse_params(headers.get("content-type", ""), body)
+                result = await self._dispatch(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError: طلب getUpdates طويل ما زال ينتظر عند إيقاف الخادم
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if content_type.startswith("multipart/form-data"):
+            # يكفينا chat_id من الملفات المرسلة (sendDocument)
+            match = re.search(rb'name="chat_id"\r\n\r\n([^\r]+)', body)
+            return {"chat_id": int(match.group(1))} if match else {}
+        params = {}
+        for name, values in urllib.parse.parse_qs(body.decode()).items():
+            try:
+                params[name] = json.loads(values[0])
+            except ValueError:
+                params[name] = values[0]
+        return params
+
+    async def _dispatch(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "load_test_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = params.get("chat_id")
+            if chat_id in self.watched:
+                self.watched[chat_id].append(params.get("reply_markup"))
+            inflight = self._inflight.get(chat_id)
+            if inflight:
+                self.latencies.append(time.perf_counter() - inflight.popleft())
+                self.last_reply_at = time.perf_counter()
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(params.get("text", "")),
+            }
+        # setWebhook, deleteWebhook, answerCallbackQuery ...
+        return True
+
+    async def _get_updates(self, params):
+        offset = params.get("offset", 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=min(params.get("timeout", 0) or 0, 1) or 0.05)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:params.get("limit", 100)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def start_bot(mode, rate_limit=False, concurrent=True, update_processor=None):
+    """يشغل البوت الحقيقي (build_application) موجهاً للخادم البديل، بوضع polling أو webhook."""
+    from hasan_bot import ALLOWED_UPDATES, build_application
+
+    application = build_application(
+        token=FAKE_TOKEN, base_url=f"http://127.0.0.1:{API_PORT}/bot",
+        rate_limit=rate_limit, concurrent=concurrent, update_processor=update_processor
+    )
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if mode == "webhook":
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}", allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=ALLOWED_UPDATES)
+    await application.start()
+    return application
+
+
+async def stop_bot(application):
+    await application.updater.stop()
+    await application.stop()
+    # نفس ترتيب run_polling: post_stop (الإشعارات المنتظرة)، shutdown (آخر دفعة من persistence)، ثم post_shutdown
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def deliver_updates(api, mode, updates, client):
+    """يوصل التحديثات للبوت: عبر طابور getUpdates (polling) أو بطلبات POST للويب هوك."""
+    if mode == "polling":
+        for update in updates:
+            api.push_update(update)
+        return
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+
+    async def post(update):
+        api.track(api.chat_id(update))
+        await client.post(url, json=update)
+
+    await asyncio.gather(*(post(update) for update in updates))
+
+
+async def wait_for_replies(api, timeout):
+    deadline = time.perf_counter() + timeout
+    while api.pending_replies() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def run_mode(mode, args):
+    use_temp_db(initialize=False)   # البوت نفسه يهيئ قاعدة البيانات في post_init
+    api = FakeBotAPI()
+    await api.start()
+    application = await start_bot(mode, rate_limit=args.rate_limit)
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            updates = [api.make_message_update(10_000 + i, "/start") for i in range(args.users)]
+            started = time.perf_counter()
+            await deliver_updates(api, mode, updates, client)
+            await wait_for_replies(api, args.timeout)
+        elapsed = (api.last_reply_at or time.perf_counter()) - started
+        latencies = api.latencies
+        print(f"{mode:>8}: {len(latencies)}/{args.users} replies, {len(latencies) / elapsed:>7.0f} updates/s, "
+              f"p50 {percentile(latencies, 0.50) * 1000:.1f}ms, p95 {percentile(latencies, 0.95) * 1000:.1f}ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    finally:
+        await stop_bot(application)
+        await api.stop()
+
+
+# خطوات مستخدم عادي: تسجيل، شراء إيميلين أمريكيين، ثم إرسال إيميل للمراجعة
+SELL_AND_SUBMIT_STEPS = [
+    "/start",
+    "بيع إيميلات",
+    "إيميلات أمريكية",
+    "2",
+    "إرسال الإيميلات",
+    "إيميل عشوائي (منك)",
+    "{user_id}@example.com:password",
+]
+
+
+async def bench_flows(args):
+    """
+    عدد كبير من المستخدمين يمشون في مسار البيع والإرسال في نفس الوقت. تحديثاتهم تصل متداخلة،
+    وفي النهاية نتحقق من قاعدة البيانات أن حالة كل محادثة بقيت صحيحة (لا معالجة خارج الترتيب).
+    """
+    use_temp_db()
+    database.add_american_emails_bulk([(f"stock{i}@example.com", "pw") for i in range(args.users * 2)])
+    database.close_connection()
+
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+    application = await start_bot("polling", concurrent=not args.sequential)
+    user_ids = [20_000 + i for i in range(args.users)]
+    try:
+        started = time.perf_counter()
+        for step in SELL_AND_SUBMIT_STEPS:
+            for user_id in user_ids:
+                api.push_update(api.make_message_update(user_id, step.format(user_id=user_id)))
+        await wait_for_replies(api, args.timeout)
+        elapsed = (api.last_reply_at or time.perf_counter()) - started
+    finally:
+        await stop_bot(application)
+        await api.stop()
+
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT COUNT(*), COUNT(DISTINCT sold_to_user_id) FROM american_emails WHERE status = 'sold'")
+    sold, buyers = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*), COUNT(DISTINCT seller_user_id) FROM submitted_emails")
+    submitted, sellers = cursor.fetchone()
+
+    total_updates = args.users * len(SELL_AND_SUBMIT_STEPS)
+    latencies = api.latencies
+    mode = "sequential" if args.sequential else "concurrent"
+    print(f"{mode}: {len(latencies)}/{total_updates} updates answered in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.0f} updates/s), p50 {percentile(latencies, 0.50) * 1000:.1f}ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f}ms, p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"sold: {sold} to {buyers} users, submitted: {submitted} from {sellers} users")
+    if (sold, buyers, submitted, sellers) != (args.users * 2, args.users, args.users, args.users):
+        print("FAIL: حالة بعض المحادثات غير صحيحة (تحديثات عولجت خارج الترتيب؟)")
+        raise SystemExit(1)
+    print("OK")
+
+
+async def bench_restart(args):
+    """
+    المستخدمون يتوقفون في منتصف محادثة الإرسال (بعد اختيار نوع الإيميل)، ثم يُعاد تشغيل البوت
+    ويرسلون الإيميل. بدون حفظ حالة المحادثات تضيع كل هذه الرسائل بعد إعادة التشغيل.
+    """
+    use_temp_db(initialize=False)
+    api = FakeBotAPI()
+    await api.start()
+    user_ids = [30_000 + i for i in range(args.users)]
+    try:
+        application = await start_bot("polling")
+        for step in SELL_AND_SUBMIT_STEPS[:1] + SELL_AND_SUBMIT_STEPS[4:6]:
+            for user_id in user_ids:
+                api.push_update(api.make_message_update(user_id, step))
+        await wait_for_replies(api, args.timeout)
+        await stop_bot(application)
+
+        application = await start_bot("polling")
+        for user_id in user_ids:
+            api.push_update(api.make_message_update(user_id, SELL_AND_SUBMIT_STEPS[-1].format(user_id=user_id)))
+        await wait_for_replies(api, args.timeout)
+        persistence = application.persistence
+        await stop_bot(application)
+    finally:
+        await api.stop()
+
+    cursor = database.get_connection().cursor()
+    cursor.execute("SELECT COUNT(DISTINCT seller_user_id) FROM submitted_emails")
+    resumed = cursor.fetchone()[0]
+    print(f"{resumed}/{args.users} conversations resumed after restart "
+          f"(last run: {persistence.batches} write batches, {persistence.rows_written} rows)")
+    if resumed != args.users:
+        print("FAIL: محادثات ضاعت بعد إعادة التشغيل")
+        raise SystemExit(1)
+    print("OK")
+
+
+class TimedUpdateProcessor(PerChatUpdateProcessor):
+    """PerChatUpdateProcessor يسجل زمن تنفيذ المعالج لكل تحديث (بعد انتظار دوره، حتى انتهاء المعالج)."""
+
+    def __init__(self):
+        super().__init__()
+        self.durations = {}   # update_id -> ثواني
+
+    async def do_process_update(self, update, coroutine):
+        async def timed():
+            started = time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                self.durations[update.update_id] = time.perf_counter() - started
+
+        await super().do_process_update(update, timed())
+
+
+def latency_summary(values):
+    return (f"p50 {percentile(values, 0.50) * 1000:7.1f}ms  p95 {percentile(values, 0.95) * 1000:7.1f}ms  "
+            f"p99 {percentile(values, 0.99) * 1000:7.1f}ms")
+
+
+# أسماء خطوات المستخدم في التقرير (الإيميل المرسل يختلف لكل مستخدم)
+JOURNEY_STEP_NAMES = [step if "{" not in step else "email:password" for step in SELL_AND_SUBMIT_STEPS]
+REVIEW_BALANCE = "5"   # الرصيد لكل إيميل الذي يدخله المشرف عند "قبول الكل"
+
+
+async def wait_for_handlers(processor, update_ids, timeout):
+    """ينتظر انتهاء معالجات هذه التحديثات بالكامل (وليس أول رد فقط، فصفحة المراجعة عدة رسائل)."""
+    deadline = time.perf_counter() + timeout
+    while not all(update_id in processor.durations for update_id in update_ids) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def review_as_admin(api, processor, reviews, labels, timeout):
+    """
+    المشرف يفتح طابور المراجعة ويضغط "قبول الكل" لكل بائع في الصفحة ثم "الصفحة التالية"،
+    حتى يراجع reviews بائعاً. يرجع عدد البائعين الذين تمت مراجعتهم.
+    """
+    pushed = []
+
+    def push(update, label):
+        labels[update["update_id"]] = label
+        pushed.append(update["update_id"])
+        api.push_update(update)
+
+    api.watch(DEVELOPER_CHAT_ID)
+    push(api.make_message_update(DEVELOPER_CHAT_ID, "مراجعة إيميلات البيع"), "review: open")
+    reviewed = 0
+    while True:
+        await wait_for_handlers(processor, pushed, timeout)
+        buttons = api.buttons(DEVELOPER_CHAT_ID)
+        accept_all = [data for data in buttons if data.startswith("acceptall_")]
+        next_page = [data for data in buttons if data.startswith("review_page_")]
+        if not accept_all or reviewed >= reviews:
+            return reviewed
+        for data in accept_all[:reviews - reviewed]:
+            push(api.make_callback_update(DEVELOPER_CHAT_ID, data), "review: accept all")
+            push(api.make_message_update(DEVELOPER_CHAT_ID, REVIEW_BALANCE), "review: balance")
+            reviewed += 1
+        if reviewed >= reviews or not next_page:
+            await wait_for_handlers(processor, pushed, timeout)
+            return reviewed
+        push(api.make_callback_update(DEVELOPER_CHAT_ID, next_page[0]), "review: next page")
+
+
+async def bench_journeys(args):
+    """
+    آلاف المستخدمين يمشون في /start والبيع والإرسال بنفس الوقت، ثم المشرف يراجع طابور الإرسال.
+    التقرير: زمن تنفيذ كل معالج (p50/p95/p99 لكل خطوة)، زمن قاعدة البيانات وانشغال خيطها،
+    والتحديثات الواردة والرسائل الصادرة في الثانية، ثم نتحقق من قاعدة البيانات أن كل خطوة تمت.
+    """
+    use_temp_db()
+    database.add_american_emails_bulk([(f"stock{i}@example.com", "pw") for i in range(args.users * 2)])
+    database.close_connection()
+
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+    processor = TimedUpdateProcessor()
+    application = await start_bot("polling", update_processor=processor)
+    # مقاييس قاعدة البيانات من metrics.instrument_db (يلف async_db.run_db داخل build_application)،
+    # من بداية التشغيل فقط، مع الاحتفاظ بكل القياسات لحساب النسب المئوية
+    metrics.RECENT_SAMPLES = 10 ** 6
+    metrics.reset()
+    user_ids = [40_000 + i for i in range(args.users)]
+    labels = {}   # update_id -> اسم الخطوة
+    try:
+        api.calls.clear()
+        started = time.perf_counter()
+        for step, name in zip(SELL_AND_SUBMIT_STEPS, JOURNEY_STEP_NAMES):
+            for user_id in user_ids:
+                update = api.make_message_update(user_id, step.format(user_id=user_id))
+                labels[update["update_id"]] = name
+                api.push_update(update)
+        await wait_for_replies(api, args.timeout)
+        users_elapsed = time.perf_counter() - started
+        reviewed = await review_as_admin(api, processor, min(args.reviews, args.users), labels, args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        await stop_bot(application)
+        await api.stop()
+
+    stats = database.get_stats()
+    sold = stats["american_emails"].get("sold", 0)
+    submitted = sum(stats["submitted_emails"].values())
+    approved = stats["submitted_emails"].get("approved", 0)
+
+    by_step = collections.defaultdict(list)
+    for update_id, duration in processor.durations.items():
+        by_step[labels.get(update_id, "other")].append(duration)
+    handled = sum(len(durations) for durations in by_step.values())
+    sent = sum(api.calls[method] for method in ("sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup"))
+
+    print(f"{args.users} users, {handled} updates in {elapsed:.2f}s (users {users_elapsed:.2f}s, admin review "
+          f"{elapsed - users_elapsed:.2f}s): {handled / elapsed:.0f} updates/s in, {sent / elapsed:.0f} messages/s out")
+    print(f"reply latency (update sent -> first reply): {latency_summary(api.latencies)}")
+    print("handler latency:")
+    for name in JOURNEY_STEP_NAMES + sorted(set(by_step) - set(JOURNEY_STEP_NAMES)):
+        if name in by_step:
+            print(f"  {name:>22} x{len(by_step[name]):<6} {latency_summary(by_step[name])}")
+    db_calls = sum(h.count for h in metrics.db_seconds.values())
+    db_busy = sum(h.sum for h in metrics.db_seconds.values())
+    print(f"db: {db_calls} calls, {db_busy:.2f}s busy ({db_busy / elapsed:.0%} of the run), "
+          f"{db_busy / max(db_calls, 1) * 1000:.2f}ms per call, {db_busy / max(handled, 1) * 1000:.2f}ms per update, "
+          f"queue wait {latency_summary(metrics.db_queue_seconds.recent)}")
+    for name, histogram in sorted(metrics.db_seconds.items(), key=lambda item: item[1].sum, reverse=True)[:5]:
+        print(f"  {name:>34} {histogram.sum * 1000:8.1f}ms")
+    print(f"sold: {sold}, submitted: {submitted}, reviewed sellers: {reviewed}, approved: {approved}")
+
+    expected_reviews = min(args.reviews, args.users)
+    if (sold, submitted, reviewed, approved) != (args.users * 2, args.users, expected_reviews, expected_reviews):
+        print("FAIL: بعض خطوات المستخدمين أو المراجعة لم تكتمل")
+        raise SystemExit(1)
+    print("OK")
+
+
+async def bench_forged(args):
+    """
+    مستخدم عادي يرسل callback مزوراً accept_<id> لإيميله المعلق ثم رصيداً، كأنه المشرف.
+    يجب ألا يتغير رصيده ولا حالة الإيميل، ثم نفس الخطوتين من المشرف تقبل الإيميل (للتأكد أن المسار يعمل).
+    """
+    seller_id = 50_000
+    use_temp_db()
+    database.add_user(seller_id)
+    database.add_submitted_email(seller_id, "forged@example.com", "pw", "american")
+    email_id = database.get_pending_submitted_emails()[0]["id"]
+    database.close_connection()
+
+    def seller_state():
+        cursor = database.get_connection().cursor()
+        cursor.execute("SELECT balance FROM users WHERE user_id = ?", (seller_id,))
+        balance = cursor.fetchone()[0]
+        return balance, database.get_submitted_email_by_id(email_id)["status"]
+
+    api = FakeBotAPI()
+    await api.start()
+    processor = TimedUpdateProcessor()
+    application = await start_bot("polling", update_processor=processor)
+    try:
+        results = {}
+        for user_id, balance in ((seller_id, "1000"), (DEVELOPER_CHAT_ID, REVIEW_BALANCE)):
+            updates = [api.make_callback_update(user_id, f"accept_{email_id}"),
+                       api.make_message_update(user_id, balance)]
+            for update in updates:
+                api.push_update(update)
+            await wait_for_handlers(processor, [update["update_id"] for update in updates], args.timeout)
+            results[user_id] = seller_state()
+    finally:
+        await stop_bot(application)
+        await api.stop()
+
+    print(f"after forged accept from user {seller_id}: balance {results[seller_id][0]}, status {results[seller_id][1]}")
+    print(f"after admin accept: balance {results[DEVELOPER_CHAT_ID][0]}, status {results[DEVELOPER_CHAT_ID][1]}")
+    if results[seller_id] != (0, "pending"):
+        print("FAIL: مستخدم غير مشرف قبل إيميلاً وأضاف لنفسه رصيداً")
+        raise SystemExit(1)
+    if results[DEVELOPER_CHAT_ID] != (float(REVIEW_BALANCE), "approved"):
+        print("FAIL: قبول المشرف لم يكتمل")
+        raise SystemExit(1)
+    print("OK")
+
+
+async def bench_modes(args):
+    for mode in args.modes:
+        await run_mode(mode, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس أداء البوت مقابل خادم Bot API محلي")
+    parser.add_argument("--database-url", default="",
+                        help="postgresql://... لتشغيل البوت على PostgreSQL (كل تشغيل في schema مؤقت خاص به)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("modes", help="مقارنة زمن الرد والتحديثات في الثانية بين polling و webhook")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--modes", nargs="+", default=["polling", "webhook"], choices=["polling", "webhook"])
+    p.add_argument("--timeout", type=float, default=60)
+    p.add_argument("--rate-limit", action="store_true", help="تفعيل OutboundRateLimiter (حدود تيليجرام الحقيقية)")
+    p.set_defaults(func=bench_modes)
+
+    p = sub.add_parser("flows", help="مستخدمون كثيرون في مساري البيع والإرسال بنفس الوقت")
+    p.add_argument("--users", type=int, default=300)
+    p.add_argument("--timeout", type=float, default=120)
+    p.add_argument("--sequential", action="store_true", help="معالجة تسلسلية (بدون PerChatUpdateProcessor) للمقارنة")
+    p.add_argument("--api-latency", type=float, default=50, help="زمن رد Bot API المصطنع بالميلي ثانية")
+    p.set_defaults(func=bench_flows)
+
+    p = sub.add_parser("restart", help="المحادثات المفتوحة تكمل بعد إعادة تشغيل البوت")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=bench_restart)
+
+    p = sub.add_parser("journeys", help="آلاف المستخدمين في مسار التسجيل والبيع والإرسال ثم مراجعة المشرف، مع زمن كل معالج وقاعدة البيانات")
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--reviews", type=int, default=200, help="عدد البائعين الذين يراجعهم المشرف")
+    p.add_argument("--timeout", type=float, default=300)
+    p.add_argument("--api-latency", type=float, default=20, help="زمن رد Bot API المصطنع بالميلي ثانية")
+    p.set_defaults(func=bench_journeys)
+
+    p = sub.add_parser("forged", help="callback قبول مزور من مستخدم غير مشرف لا يغير رصيده")
+    p.add_argument("--timeout", type=float, default=30)
+    p.set_defaults(func=bench_forged)
+
+    args = parser.parse_args()
+    benchmark.DATABASE_URL = args.database_url   # use_temp_db من benchmark.py تنشئ schema مؤقتاً على هذا الخادم
+    try:
+        asyncio.run(args.func(args))
+    finally:
+        remove_temp_dbs()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# metrics.py - مقاييس الأداء: زمن كل معالج، استدعاءات قاعدة البيانات، وطلبات Bot API
+#
+# instrument_application يلف كل معالج مسجل في التطبيق (ومعالجات ConversationHandler بداخله)،
+# و instrument_dispatch يلف الدوال خلف معالج توجيه (أزرار القوائم) لتُقاس كل واحدة باسمها،
+# و instrument_db يلف async_db.run_db الذي تمر عليه كل دوال database.py، و TimedRequest
+# يقيس زمن كل طلب لتيليجرام حسب اسمه (sendMessage ...). كل قياس يُسجل في Histogram.
+#
+# register_gauges يضيف مقاييس موجودة أصلاً في وحدات أخرى (محدد الإرسال، كاش المستخدمين،
+# حفظ المحادثات، إنهاء المهلة) لنفس التقرير. التقرير يظهر للمشرف بأمر /metrics،
+# واختيارياً بصيغة Prometheus على http://127.0.0.1:<المنفذ>/metrics (start_metrics_server).
+
+import asyncio
+import bisect
+import collections
+import contextvars
+import functools
+import inspect
+import logging
+import time
+
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+import async_db
+
+logger = logging.getLogger(__name__)
+
+# حدود الـ buckets بالثواني (نفس حدود Prometheus الافتراضية تقريباً)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_CALLS_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+RECENT_SAMPLES = 1000   # آخر القياسات لكل اسم لحساب p50/p95/p99 بدقة في /metrics
+REPORT_TOP = 10         # عدد الأسطر لكل قسم في /metrics (الأكثر استهلاكاً للوقت)
+
+
+class Histogram:
+    """عدادات تراكمية حسب الحدود (لـ Prometheus) مع آخر القياسات (للنسب المئوية)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)   # الأخير: أكبر من كل الحدود (+Inf)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, p):
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+handler_seconds = collections.defaultdict(Histogram)        # اسم المعالج -> زمن التنفيذ
+db_seconds = collections.defaultdict(Histogram)             # اسم دالة database.py -> زمن التنفيذ على خيط قاعدة البيانات
+api_seconds = collections.defaultdict(Histogram)            # طريقة Bot API -> زمن الطلب
+db_calls_per_update = Histogram(DB_CALLS_BUCKETS)           # عدد استدعاءات قاعدة البيانات في كل معالج
+db_queue_seconds = Histogram()                              # انتظار الاستدعاء في طابور خيط قاعدة البيانات قبل أن يبدأ
+errors = collections.Counter()                              # "handler:<اسم>" أو "api:<طريقة>" -> عدد الأخطاء
+_gauges = {}                                                # اسم المجموعة -> دالة ترجع قاموس أرقام
+_started_at = time.monotonic()
+
+# عداد استدعاءات قاعدة البيانات للمعالج الجاري (كل تحديث يُعالج في مهمة asyncio بسياق خاص)
+_update_db_calls = contextvars.ContextVar("update_db_calls", default=None)
+
+
+def reset():
+    """يمسح كل القياسات (لأدوات القياس بين التشغيلات)."""
+    global db_calls_per_update, db_queue_seconds, _started_at
+    for table in (handler_seconds, db_seconds, api_seconds):
+        table.clear()
+    db_calls_per_update = Histogram(DB_CALLS_BUCKETS)
+    db_queue_seconds = Histogram()
+    errors.clear()
+    _started_at = time.monotonic()
+
+
+def register_gauges(name, collect):
+    """collect() ترجع قاموس {اسم: رقم} يُقرأ عند كل تقرير."""
+    _gauges[name] = collect
+
+
+def collect_gauges():
+    gauges = {}
+    for name, collect in _gauges.items():
+        try:
+            gauges[name] = {key: value for key, value in collect().items() if isinstance(value, (int, float))}
+        except Exception as e:
+            logger.error(f"فشل قراءة مقاييس {name}: {e}")
+    return gauges
+
+
+# ---- المعالجات ----
+def _timed_callback(callback):
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        db_calls = [0]
+        token = _update_db_calls.set(db_calls)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            errors[f"handler:{name}"] += 1
+            raise
+        finally:
+            handler_seconds[name].observe(time.perf_counter() - started)
+            db_calls_per_update.observe(db_calls[0])
+            _update_db_calls.reset(token)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]
+        for inner in nested:
+            _instrument_handler(inner)
+    elif inspect.iscoroutinefunction(handler.callback) and not getattr(handler.callback, "instrumented", False):
+        handler.callback = _timed_callback(handler.callback)
+
+
+def instrument_dispatch(dispatcher, callbacks):
+    """
+    dispatcher معالج واحد يوجه لدوال القاموس callbacks (مثل أزرار القوائم): تُلف كل دالة فيه
+    فتُسجل باسمها، ولا يُلف dispatcher نفسه (وإلا تُحسب كل الأزرار مرتين، مرة تحت اسمه).
+    يُستدعى قبل instrument_application.
+    """
+    for key, callback in callbacks.items():
+        if not getattr(callback, "instrumented", False):
+            callbacks[key] = _timed_callback(callback)
+    dispatcher.instrumented = True
+
+
+def instrument_application(application):
+    """يلف كل المعالجات المسجلة في التطبيق (يُستدعى بعد تسجيلها كلها)."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+# ---- قاعدة البيانات ----
+def instrument_db():
+    """
+    يلف async_db.run_db: زمن كل دالة على خيط قاعدة البيانات، وانتظارها في الطابور قبله
+    (خيط واحد لقاعدة البيانات، فطول الانتظار يعني أنه مشغول بالكامل)، وعدد الاستدعاءات لكل معالج.
+    """
+    run_db = async_db.run_db
+    if getattr(run_db, "instrumented", False):
+        return
+
+    async def timed_run_db(func, *args, **kwargs):
+        queued = time.perf_counter()
+        timing = {}
+
+        @functools.wraps(func)
+        def timed():
+            timing["started"] = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing["finished"] = time.perf_counter()
+
+        db_calls = _update_db_calls.get()
+        if db_calls is not None:
+            db_calls[0] += 1
+        try:
+            return await run_db(timed)
+        finally:
+            if "started" in timing:
+                db_seconds[getattr(func, "__name__", repr(func))].observe(timing["finished"] - timing["started"])
+                db_queue_seconds.observe(timing["started"] - queued)
+
+    timed_run_db.instrumented = True
+    async_db.run_db = timed_run_db
+
+
+# ---- Bot API ----
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest يقيس زمن كل طلب لتيليجرام (بدون انتظار محدد الإرسال)، حسب اسم الطريقة."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            errors[f"api:{endpoint}"] += 1
+            raise
+        finally:
+            api_seconds[endpoint].observe(time.perf_counter() - started)
+
+
+# ---- التقارير ----
+def _top(table):
+    return sorted(table.items(), key=lambda item: item[1].sum, reverse=True)[:REPORT_TOP]
+
+
+def _latency_line(name, histogram):
+    return (f"   - {name}: {histogram.count} | p50 {histogram.percentile(0.50) * 1000:.1f} "
+            f"p95 {histogram.percentile(0.95) * 1000:.1f} p99 {histogram.percentile(0.99) * 1000:.1f} ms")
+
+
+def format_report():
+    """نص /metrics للمشرف: أبطأ المعالجات ودوال قاعدة البيانات وطلبات تيليجرام (حسب مجموع الوقت)."""
+    uptime_minutes = (time.monotonic() - _started_at) / 60
+    lines = [f"📈 مقاييس الأداء (آخر {uptime_minutes:.0f} دقيقة)", "", "⚙️ المعالجات (العدد | الزمن):"]
+    lines += [_latency_line(name, h) for name, h in _top(handler_seconds)] or ["   - لا يوجد"]
+
+    db_calls = sum(h.count for h in db_seconds.values())
+    db_total = sum(h.sum for h in db_seconds.values())
+    lines += ["", f"🗄 قاعدة البيانات: {db_calls} استدعاء، {db_total:.2f} ثانية"
+                  f" (لكل تحديث: متوسط {db_calls_per_update.sum / db_calls_per_update.count if db_calls_per_update.count else 0:.1f}"
+                  f"، p95 {db_calls_per_update.percentile(0.95):.0f}؛ انتظار الطابور p95 "
+                  f"{db_queue_seconds.percentile(0.95) * 1000:.1f} ms)"]
+    lines += [_latency_line(name, h) for name, h in _top(db_seconds)]
+
+    lines += ["", "📡 طلبات تيليجرام:"]
+    lines += [_latency_line(name, h) for name, h in _top(api_seconds)] or ["   - لا يوجد"]
+
+    for name, values in collect_gauges().items():
+        lines += ["", f"📊 {name}: " + "، ".join(
+            f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}" for key, value in values.items())]
+    if errors:
+        lines += ["", "⚠️ الأخطاء: " + "، ".join(f"{name} {count}" for name, count in errors.most_common(REPORT_TOP))]
+    return "\n".join(lines)
+
+
+def _prometheus_histogram(lines, metric, label, table, help_text):
+    lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+    for name, histogram in sorted(table.items()):
+        labels = f'{label}="{name}",' if label else ""
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.bucket_counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines += [f"{metric}_sum{labels} {histogram.sum}", f"{metric}_count{labels} {histogram.count}"]
+
+
+def render_prometheus():
+    """كل المقاييس بصيغة Prometheus النصية."""
+    lines = []
+    _prometheus_histogram(lines, "hasan_handler_seconds", "handler", handler_seconds, "Handler execution time.")
+    _prometheus_histogram(lines, "hasan_db_call_seconds", "function", db_seconds, "database.py call time on the DB thread.")
+    _prometheus_histogram(lines, "hasan_telegram_api_seconds", "method", api_seconds, "Bot API request time.")
+    _prometheus_histogram(lines, "hasan_db_calls_per_update", None, {"": db_calls_per_update},
+                          "database.py calls made by one handler.")
+    _prometheus_histogram(lines, "hasan_db_queue_seconds", None, {"": db_queue_seconds},
+                          "Time a database.py call waited for the DB thread.")
+    lines += ["# HELP hasan_errors_total Exceptions raised by handlers and Bot API requests.",
+              "# TYPE hasan_errors_total counter"]
+    lines += [f'hasan_errors_total{{source="{name}"}} {count}' for name, count in sorted(errors.items())]
+    for group, values in collect_gauges().items():
+        for key, value in values.items():
+            metric = f"hasan_{group}_{key}"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# ---- خادم Prometheus المحلي ----
+_server = None
+
+
+async def _handle_connection(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render_prometheus().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+    """يخدم /metrics بصيغة Prometheus على العنوان المحلي (يُستدعى في post_init إذا حُدد منفذ)."""
+    global _server
+    _server = await asyncio.start_server(_handle_connection, host, port)
+    logger.info(f"مقاييس Prometheus متاحة على http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,247 @@
+# outbox.py - طابور الإرسال الصادر: تحديد معدل الإرسال وإعادة المحاولة ودمج الإشعارات
+#
+# OutboundRateLimiter يُمرر لـ Application.builder().rate_limiter() فيمر عليه كل طلب
+# للـ Bot API (reply_text و send_message و edit_message_text ...). يطبق حدود تيليجرام:
+# حد عام لكل البوت وحد لكل محادثة (Token Bucket)، ويعيد المحاولة تلقائياً عند RetryAfter.
+#
+# notify() للإشعارات (للمشرف أو للبائعين): لا ينتظر الإرسال، ويدمج الإشعارات المتتالية
+# لنفس المحادثة في رسالة واحدة.
+
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# حدود تيليجرام المعروفة
+GLOBAL_RATE = 30              # رسالة في الثانية لكل البوت
+PRIVATE_CHAT_RATE = 1         # رسالة في الثانية لكل محادثة خاصة
+GROUP_CHAT_RATE = 20 / 60     # 20 رسالة في الدقيقة لكل مجموعة
+MAX_RETRIES = 3
+MAX_CHAT_BUCKETS = 10000      # فوق هذا العدد تُحذف دلاء المحادثات الخاملة الأقدم استخداماً
+
+MESSAGE_MAX_LENGTH = 4096
+COALESCE_WINDOW = 1.0         # ثواني انتظار الإشعارات الإضافية لنفس المحادثة قبل الإرسال
+COALESCE_SEPARATOR = "\n\n➖➖➖\n\n"
+
+
+class TokenBucket:
+    """دلو رموز بسيط: rate رمز في الثانية، بحد أقصى capacity (يسمح بدفعة قصيرة)."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        # القفل يرتب المنتظرين حسب وصولهم بدل أن يتسابقوا على نفس الرمز
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """يوقف الدلو (بعد RetryAfter من تيليجرام) بدون أن يخسر باقي الطلبات."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """محدد معدل مركزي لكل طلبات البوت الصادرة، مع مقاييس لعمق الطابور وزمن الإرسال."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, private_chat_rate=PRIVATE_CHAT_RATE,
+                 group_chat_rate=GROUP_CHAT_RATE, max_retries=MAX_RETRIES):
+        self.global_rate = global_rate
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.max_retries = max_retries
+        self._global_bucket = None
+        self._chat_buckets = collections.OrderedDict()   # chat_id -> TokenBucket، الأقدم استخداماً أولاً
+        # مقاييس
+        self.queue_depth = 0
+        self.sent = 0
+        self.retries = 0
+        self.failures = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    async def initialize(self) -> None:
+        self._global_bucket = TokenBucket(self.global_rate, self.global_rate)
+
+    async def shutdown(self) -> None:
+        self._chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is not None:
+            self._chat_buckets.move_to_end(chat_id)
+            return bucket
+        # نحذف الدلاء الخاملة من الطرف الأقدم استخداماً حتى لا يكبر القاموس بلا حد. نتوقف عند أول دلو
+        # غير خامل (كل ما بعده استُخدم أحدث منه)، فالتكلفة ثابتة لكل محادثة جديدة حتى أثناء رسالة جماعية
+        while len(self._chat_buckets) >= MAX_CHAT_BUCKETS and next(iter(self._chat_buckets.values())).is_idle():
+            self._chat_buckets.popitem(last=False)
+        rate = self.group_chat_rate if isinstance(chat_id, int) and chat_id < 0 else self.private_chat_rate
+        bucket = TokenBucket(rate, max(1, rate * 3))
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # طلبات لا ترسل لمحادثة (getUpdates, getMe, answerCallbackQuery ...) لا تخضع للحدود
+            return await callback(*args, **kwargs)
+
+        self.queue_depth += 1
+        started = time.monotonic()
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._global_bucket.acquire()
+                await self._chat_bucket(chat_id).acquire()
+                try:
+                    result = await callback(*args, **kwargs)
+                    self.sent += 1
+                    return result
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, datetime.timedelta):
+                        retry_after = retry_after.total_seconds()
+                    # ننتظر المدة المطلوبة، وتزيد مع كل محاولة (backoff)
+                    delay = retry_after * (2 ** attempt)
+                    self.retries += 1
+                    logger.warning(f"RetryAfter من تيليجرام للمحادثة {chat_id} ({endpoint}): انتظار {delay} ثانية.")
+                    self._chat_bucket(chat_id).pause(delay)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.queue_depth -= 1
+            self.latencies.append(time.monotonic() - started)
+
+    def metrics(self):
+        """لقطة من مقاييس الإرسال (الزمن بالميلي ثانية)."""
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+        return {
+            "queue_depth": self.queue_depth,
+            "sent": self.sent,
+            "retries": self.retries,
+            "failures": self.failures,
+            "latency_p50_ms": percentile(0.50),
+            "latency_p95_ms": percentile(0.95),
+            "latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        }
+
+
+class Notifier:
+    """
+    يرسل الإشعارات في الخلفية. الإشعارات النصية المتتالية لنفس المحادثة (خلال COALESCE_WINDOW)
+    وبنفس الإعدادات تُدمج في رسالة واحدة، فيقل عدد الرسائل ولا تُستهلك حدود تيليجرام.
+    """
+
+    def __init__(self, bot, window=COALESCE_WINDOW):
+        self.bot = bot
+        self.window = window
+        self._pending = {}   # chat_id -> {"texts": [...], "kwargs": {...}, "task": Task}
+        self._deliveries = set()  # نحتفظ بمراجع مهام الإرسال حتى لا يحذفها جامع القمامة
+        self.coalesced = 0
+
+    def send(self, chat_id, text, **kwargs):
+        pending = self._pending.get(chat_id)
+        can_merge = (
+            pending is not None
+            and "reply_markup" not in kwargs and "reply_markup" not in pending["kwargs"]
+            and pending["kwargs"] == kwargs
+            and len(COALESCE_SEPARATOR.join(pending["texts"] + [text])) <= MESSAGE_MAX_LENGTH
+        )
+        if can_merge:
+            pending["texts"].append(text)
+            self.coalesced += 1
+            return
+
+        if pending is not None:
+            # لا يمكن الدمج: نرسل المنتظر فوراً للحفاظ على الترتيب
+            pending["task"].cancel()
+            self._flush(chat_id)
+
+        entry = {"texts": [text], "kwargs": kwargs}
+        self._pending[chat_id] = entry
+        entry["task"] = asyncio.get_running_loop().create_task(self._flush_later(chat_id, entry))
+
+    async def _flush_later(self, chat_id, entry):
+        await asyncio.sleep(self.window)
+        if self._pending.get(chat_id) is entry:
+            self._flush(chat_id)
+
+    def _flush(self, chat_id):
+        entry = self._pending.pop(chat_id)
+        text = COALESCE_SEPARATOR.join(entry["texts"])
+        task = asyncio.get_running_loop().create_task(self._deliver(chat_id, text, entry["kwargs"]))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id, text, kwargs):
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except Exception as e:
+            logger.error(f"فشل إرسال إشعار للمحادثة {chat_id}: {e}")
+
+    async def flush_all(self):
+        """يرسل كل الإشعارات المنتظرة فوراً (عند إيقاف البوت)."""
+        for chat_id in list(self._pending):
+            entry = self._pending.pop(chat_id)
+            entry["task"].cancel()
+            await self._deliver(chat_id, COALESCE_SEPARATOR.join(entry["texts"]), entry["kwargs"])
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    def pending_count(self):
+        return sum(len(entry["texts"]) for entry in self._pending.values()) + len(self._deliveries)
+
+
+_notifier = None
+
+
+def start_notifier(bot):
+    """ينشئ مرسل الإشعارات المشترك (يُستدعى مرة واحدة في post_init)."""
+    global _notifier
+    _notifier = Notifier(bot)
+    return _notifier
+
+
+def notify(chat_id, text, **kwargs):
+    """يضع إشعاراً في طابور الإرسال ويرجع مباشرة بدون انتظار تيليجرام."""
+    if _notifier is None:
+        # قبل post_init لا يوجد bot نرسل به
+        logger.error(f"إشعار للمحادثة {chat_id} قبل تشغيل مرسل الإشعارات (start_notifier)، لم يُرسل: {text[:100]}")
+        return
+    _notifier.send(chat_id, text, **kwargs)
+
+
+async def stop_notifier():
+    if _notifier is not None:
+        await _notifier.flush_all()
@@ -0,0 +1,143 @@
+# persistence.py - حفظ حالة المحادثات و user_data في hasan_bot.db
+#
+# بدونها إعادة تشغيل البوت تمسح كل محادثة مفتوحة (بيع، إرسال للمراجعة، مراجعة المشرف)
+# وكل ما في context.user_data. SQLitePersistence يحفظها في جدولي conversation_states و user_data.
+#
+# الكتابة مؤجلة ومجمّعة: Application يتتبع المحادثات والمستخدمين المتغيرين ويستدعي update_*
+# لهم كلهم معاً كل update_interval ثانية (وعند الإيقاف)، وهنا نجمع هذه الاستدعاءات ونكتبها
+# في معاملة واحدة على خيط قاعدة البيانات. معالجة التحديث نفسها لا تنتظر أي كتابة.
+
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from async_db import initialize_db, get_conversation_states, get_all_user_data, save_persistence_batch
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_UPDATE_INTERVAL = 5   # ثواني بين كل دفعة كتابة (أقصى ما قد يضيع عند توقف مفاجئ)
+
+
+def _encode(value):
+    return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+
+class SQLitePersistence(BasePersistence):
+    """تحفظ المحادثات و user_data فقط (البوت لا يستخدم chat_data و bot_data و callback_data)."""
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._db_ready = False
+        self._saved_user_data = {}            # user_id -> آخر JSON محفوظ (لتجاهل ما لم يتغير فعلاً)
+        self._pending_conversations = {}      # (name, key) -> state أو None للحذف
+        self._pending_user_data = {}          # user_id -> data أو None للحذف
+        self._write_task = None
+        # مقاييس
+        self.batches = 0
+        self.rows_written = 0
+
+    async def _ensure_db(self):
+        # Application.initialize يقرأ المحفوظات قبل post_init، فقد تكون الجداول غير منشأة بعد
+        if not self._db_ready:
+            await initialize_db()
+            self._db_ready = True
+
+    # ---- القراءة (مرة واحدة عند التشغيل) ----
+    async def get_user_data(self):
+        await self._ensure_db()
+        self._saved_user_data = await get_all_user_data()
+        return {user_id: json.loads(data) for user_id, data in self._saved_user_data.items()}
+
+    async def get_conversations(self, name):
+        await self._ensure_db()
+        states = await get_conversation_states(name)
+        return {tuple(json.loads(key)): json.loads(state) for key, state in states.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ---- الكتابة (تتراكم ثم تُكتب كدفعة واحدة) ----
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, _encode(key))] = None if new_state is None else _encode(new_state)
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        # user_data الفارغة لا تُحفظ (تُحذف)، فالجدول يبقى بحجم المستخدمين الذين عندهم حالة فعلاً
+        encoded = _encode(data) if data else None
+        if self._saved_user_data.get(user_id) == encoded:
+            return
+        self._saved_user_data[user_id] = encoded
+        self._pending_user_data[user_id] = encoded
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._saved_user_data.pop(user_id, None)
+        self._pending_user_data[user_id] = None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_write(self):
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Application يشغل كل استدعاءات update_* لنفس الدورة معاً، فننتظر حتى تنتهي كلها ثم نكتبها دفعة واحدة
+        await asyncio.sleep(0)
+        self._write_task = None
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        if not conversations and not user_data:
+            return
+
+        saved = await save_persistence_batch(
+            [(name, key, state) for (name, key), state in conversations.items()],
+            list(user_data.items())
+        )
+        if not saved:
+            # نرجعها للانتظار بدون أن نغطي تغييرات أحدث وصلت أثناء الكتابة، وتُعاد مع الدفعة التالية
+            for item, value in conversations.items():
+                self._pending_conversations.setdefault(item, value)
+            for user_id, value in user_data.items():
+                self._pending_user_data.setdefault(user_id, value)
+            return
+        self.batches += 1
+        self.rows_written += len(conversations) + len(user_data)
+
+    async def flush(self):
+        """يُستدعى عند إيقاف البوت: ينتظر الدفعة الجارية ويكتب ما تبقى."""
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending_conversations or self._pending_user_data:
+            await self._write_pending()
+        logger.info(f"حفظ حالة المحادثات: {self.batches} دفعة، {self.rows_written} سجل.")
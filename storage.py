@@ -0,0 +1,203 @@
+# storage.py - طبقة التخزين خلف دوال database.py: SQLite (ملف محلي) أو PostgreSQL (مشترك)
+#
+# دوال database.py تكتب SQL بلهجة SQLite وتستخدم الاتصال عبر get_connection() و transaction()
+# فقط. كل backend هنا يوفر: فتح الاتصال (بوضع autocommit والمعاملات صريحة)، وجملة BEGIN،
+# ورقم نسخة المخطط وترحيلاته. SQLite هو الافتراضي (عملية واحدة على قرص واحد).
+# PostgreSQL يسمح لعدة عمليات بوت بمشاركة نفس البيانات: الاتصال يترجم لهجة SQLite
+# المستخدمة في database.py (? و INSERT OR IGNORE و json_each و IS NOT) للهجة PostgreSQL.
+#
+# psycopg اختياري: بدونه يعمل SQLite فقط، ورابط postgresql:// يرمي خطأً واضحاً عند التشغيل
+
+import functools
+import re
+import sqlite3
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+# إعدادات اتصال SQLite (تُطبق مرة واحدة عند فتح كل اتصال)
+CACHED_STATEMENTS = 256       # عدد الاستعلامات المحضّرة التي يحتفظ بها كل اتصال
+CACHE_SIZE_KIB = 16 * 1024    # حجم كاش الصفحات بالكيلوبايت
+BUSY_TIMEOUT_MS = 5000        # مدة انتظار القفل قبل رمي خطأ "database is locked"
+
+# قفل استشاري واحد لكل المعاملات "الفورية" في PostgreSQL، بنفس معنى BEGIN IMMEDIATE في SQLite:
+# كاتب واحد فقط في كل لحظة لهذه المعاملات (حجز الإيميلات، الأرصدة، طلبات السحب ...)
+POSTGRES_WRITE_LOCK_ID = 626628
+
+# أخطاء قاعدة البيانات لكل الـ backends (database.py يلتقطها بدل sqlite3.Error)
+DATABASE_ERRORS = (sqlite3.Error,) + ((psycopg.Error,) if psycopg else ())
+INTEGRITY_ERRORS = (sqlite3.IntegrityError,) + ((psycopg.IntegrityError,) if psycopg else ())
+
+
+class SQLiteBackend:
+    """ملف SQLite محلي: اتصال لكل خيط بوضع WAL، ورقم نسخة المخطط في PRAGMA user_version."""
+
+    name = "sqlite"
+    shared = False   # عملية واحدة فقط تكتب في الملف، فالكاش داخل العملية آمن
+
+    def __init__(self, path, migrations):
+        self.path = path
+        self.key = path
+        self.migrations = migrations
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def begin_sql(self, immediate):
+        # BEGIN IMMEDIATE ياخذ قفل الكتابة من البداية
+        return "BEGIN IMMEDIATE" if immediate else "BEGIN"
+
+    def get_schema_version(self, cursor):
+        cursor.execute("PRAGMA user_version")
+        return cursor.fetchone()[0]
+
+    def set_schema_version(self, cursor, version):
+        cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+
+# ---- ترجمة لهجة SQLite المستخدمة في database.py إلى PostgreSQL ----
+_INSERT_OR_IGNORE = re.compile(r"\bINSERT OR IGNORE INTO\b", re.IGNORECASE)
+# json_each(?) alias  ->  json_array_elements_text(...) AS alias(value)  (database.py يعطي كل json_each اسماً)
+_JSON_EACH = re.compile(r"\bjson_each\(\?\)\s+(\w+)", re.IGNORECASE)
+# a IS NOT b (مقارنة تعتبر NULL قيمة) -> IS DISTINCT FROM، مع ترك IS NOT NULL كما هي
+_IS_NOT = re.compile(r"\bIS NOT\s+(?!NULL\b)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_sql(sql, has_params=True):
+    """يحوّل استعلاماً مكتوباً لـ SQLite إلى PostgreSQL (النتيجة محفوظة لكل نص استعلام)."""
+    if sql.strip().upper() == "BEGIN IMMEDIATE":
+        return f"BEGIN; SELECT pg_advisory_xact_lock({POSTGRES_WRITE_LOCK_ID})"
+    if _INSERT_OR_IGNORE.search(sql):
+        sql = _INSERT_OR_IGNORE.sub("INSERT INTO", sql).rstrip().rstrip(";") + " ON CONFLICT DO NOTHING"
+    sql = _JSON_EACH.sub(r"json_array_elements_text(?::json) AS \1(value)", sql)
+    sql = _IS_NOT.sub("IS DISTINCT FROM ", sql)
+    if has_params:
+        # psycopg يستخدم %s للمعاملات، فأي % حرفي يجب مضاعفته
+        sql = sql.replace("%", "%%").replace("?", "%s")
+    return sql
+
+
+class _PostgresCursor:
+    """cursor بنفس استخدام sqlite3 في database.py، يترجم كل استعلام قبل تنفيذه."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=None):
+        if params is None:
+            self._cursor.execute(translate_sql(sql, False))
+        else:
+            self._cursor.execute(translate_sql(sql), params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(translate_sql(sql), list(seq_of_params))
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class _PostgresConnection:
+    """اتصال psycopg بوضع autocommit (مثل isolation_level=None)، والمعاملات بـ BEGIN/COMMIT صريحة."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return _PostgresCursor(self._conn.cursor())
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self._conn.execute("COMMIT")
+
+    def rollback(self):
+        self._conn.execute("ROLLBACK")
+
+    def close(self):
+        self._conn.close()
+
+
+class PostgresBackend:
+    """
+    PostgreSQL مشترك بين عدة عمليات بوت. الرابط بصيغة libpq، مع خيار إضافي schema=<اسم>
+    لتشغيل البوت (أو أدوات القياس) في schema منفصل. رقم نسخة المخطط في جدول schema_version.
+    """
+
+    name = "postgresql"
+    shared = True   # عمليات أخرى تكتب في نفس البيانات، فلا يصلح كاش داخل العملية
+
+    def __init__(self, url, migrations):
+        if psycopg is None:
+            raise RuntimeError("استخدام PostgreSQL يتطلب تثبيت psycopg: pip install 'psycopg[binary]'")
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        self.schema = query.pop("schema", None)
+        self.conninfo = urlunsplit(parts._replace(query=urlencode(query)))
+        self.key = url
+        self.migrations = migrations
+
+    def connect(self):
+        conn = psycopg.connect(self.conninfo, autocommit=True)
+        if self.schema:
+            # IF NOT EXISTS لا يمنع تعارض عمليتين تنشئان نفس الـ schema معاً، فالإنشاء تحت قفل الكتابة
+            with conn.transaction():
+                conn.execute(f"SELECT pg_advisory_xact_lock({POSTGRES_WRITE_LOCK_ID})")
+                conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{self.schema}"')
+            conn.execute(f'SET search_path TO "{self.schema}"')
+        return _PostgresConnection(conn)
+
+    def begin_sql(self, immediate):
+        # تُترجم في translate_sql إلى BEGIN مع القفل الاستشاري
+        return "BEGIN IMMEDIATE" if immediate else "BEGIN"
+
+    def get_schema_version(self, cursor):
+        # بدون DDL (القراءة الأولى في initialize_db قبل قفل الترحيل)، ومن pg_class مباشرة وليس to_regclass:
+        # كاش الكتالوج في الجلسة قد لا يرى جدولاً أنشأته عملية أخرى أثناء انتظارنا للقفل
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = 'schema_version' AND n.nspname = current_schema())"
+        )
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        return cursor.fetchone()[0] or 0
+
+    def set_schema_version(self, cursor, version):
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        cursor.execute("DELETE FROM schema_version")
+        cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+
+
+def open_backend(url, sqlite_path, sqlite_migrations, postgres_migrations):
+    """يختار الـ backend من الرابط: postgresql://... أو sqlite:///<مسار>، أو ملف sqlite_path إذا كان الرابط فارغاً."""
+    if url and url.startswith(("postgres://", "postgresql://")):
+        return PostgresBackend(url, postgres_migrations)
+    if url and url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):], sqlite_migrations)
+    return SQLiteBackend(sqlite_path, sqlite_migrations)
@@ -0,0 +1,61 @@
+# update_processor.py - معالجة التحديثات بالتوازي مع الحفاظ على ترتيب كل محادثة
+#
+# بشكل افتراضي python-telegram-bot يعالج التحديثات واحداً تلو الآخر، فمعالج بطيء
+# (إضافة آلاف الإيميلات أو مراجعة طويلة) يؤخر كل المستخدمين. هذا المعالج يسمح بمعالجة
+# تحديثات المستخدمين المختلفين بالتوازي، لكن تحديثات نفس المحادثة/المستخدم تُعالج بالترتيب
+# وواحداً تلو الآخر، فحالة ConversationHandler لكل مستخدم لا تختلط أبداً.
+
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+# التحديثات المنتظرة لقفل محادثتها تحجز مكاناً من هذا الحد، لذلك نجعله واسعاً
+MAX_CONCURRENT_UPDATES = 256
+# عدد المعالجات التي تعمل فعلاً في نفس الوقت. كل معالج نشط يفتح اتصالاً مع Bot API،
+# وجدولة مجمع اتصالات httpx تصبح أبطأ بكثير مع مئات الاتصالات، لذلك نبقيه صغيراً
+MAX_ACTIVE_UPDATES = 16
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """توازي بين المحادثات، وتسلسل صارم داخل المحادثة الواحدة."""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_active_updates=MAX_ACTIVE_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}   # مفتاح المحادثة -> [القفل، عدد التحديثات التي تستخدمه]
+        self._active = asyncio.Semaphore(max_active_updates)
+
+    @staticmethod
+    def _key(update):
+        # نفس مفتاح ConversationHandler (المحادثة + المستخدم)
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._active:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock يحافظ على ترتيب الوصول، فتحديثات نفس المستخدم تُعالج بنفس ترتيب استلامها
+            # ونأخذ مكاناً من المعالجات النشطة بعد القفل فقط، فالمنتظر خلف تحديث سابق لا يحجز مكاناً
+            async with entry[0], self._active:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass